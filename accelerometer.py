@@ -1,3 +1,11 @@
+########################################################################
+## Imports ##
+#############
+import numpy as np
+from time import monotonic, sleep
+from calibration import MagnetometerCalibration
+from i2c import read_xyz, read_xyz_samples, read_status_xyz
+
 ########################################################################
 ## LSM303D register addresses ##
 ################################
@@ -20,6 +28,10 @@ LSM_CTRL_5 = 0x24 # Turns on temperature sensor
 LSM_CTRL_6 = 0x25 # Magnetic resolution selection, data rate config
 LSM_CTRL_7 = 0x26 # Turns on magnetometer and adjusts mode
 
+# Status registers
+LSM_STATUS_M = 0x07 # Magnetometer status
+LSM_STATUS_A = 0x27 # Accelerometer status
+
 # Magnetometer output registers
 LSM_MAG_X_L = 0x08
 LSM_MAG_X_H = 0x09
@@ -40,8 +52,12 @@ LSM_ACC_Z_H = 0x2D
 LSM_TEMP_L = 0x05
 LSM_TEMP_H = 0x06
 
-# For further control registers (offsets, references, FIFO, interrupts, 
-# etc), see datasheet
+# FIFO registers (accelerometer only)
+LSM_FIFO_CTRL = 0x2E # FIFO mode and watermark
+LSM_FIFO_SRC = 0x2F # FIFO status
+
+# For further control registers (offsets, references, interrupts, etc),
+# see datasheet
 
 ########################################################################
 ## LSM303D Commands ##
@@ -49,12 +65,36 @@ LSM_TEMP_H = 0x06
 # ODR
 LSM_ACC_SET_ODR = {12.5:0b00110111, # 12.5Hz
                    25 : 0b01000111, # 25Hz
-                   50 : 0b01010111} # 50Hz
+                   50 : 0b01010111, # 50Hz
+                   100: 0b01100111, # 100Hz
+                   200: 0b01110111, # 200Hz
+                   400: 0b10000111, # 400Hz
+                   800: 0b10010111} # 800Hz
 
 LSM_MAG_SET_ODR = {12.5:0b01101000, # 12.5Hz
                    25 : 0b01101100, # 25Hz
                    50 : 0b01110000} # 50Hz
 
+# Block data update: output registers are not updated until both the
+# high and low bytes of the previous sample have been read
+LSM_ACC_BDU = 0b00001000
+
+# Status
+LSM_STATUS_DATA_READY = 0b00001000 # STATUS_A/M: new x, y, z sample available
+LSM_STATUS_OVERRUN = 0b10000000 # STATUS_A/M: a sample was overwritten unread
+
+# FIFO
+LSM_FIFO_DEPTH = 32 # samples
+LSM_FIFO_ENABLE = 0b01000000 # CTRL_0
+LSM_FIFO_MODE_BYPASS = 0b00000000 # FIFO_CTRL
+LSM_FIFO_MODE_STREAM = 0b01000000 # FIFO_CTRL: keep newest samples
+LSM_FIFO_WATERMARK_MASK = 0b00011111 # FIFO_CTRL
+LSM_FIFO_SRC_OVERRUN = 0b01000000 # FIFO_SRC: FIFO is full
+LSM_FIFO_SRC_LEVEL_MASK = 0b00011111 # FIFO_SRC: number of unread samples
+
+# Calibration
+MAGNETOMETER_CALIBRATION_FILE = 'magnetometer_calibration.npz'
+
 # Scale
 LSM_ACC_SET_SCALE = {2: 0b00000000, #+/- 2g
                      4: 0b00001000, #+/- 4g
@@ -92,12 +132,19 @@ class Accelerometer:
 		self.mag_scale = mag_scale
 		self.acc_sens = LSM_ACC_SENS[acc_scale]
 		self.mag_sens = LSM_MAG_SENS[mag_scale]
+		# Data-ready counters (see read_acc_new and read_mag_new)
+		self.acc_duplicates_avoided = 0
+		self.acc_overruns = 0
+		self.mag_duplicates_avoided = 0
+		self.mag_overruns = 0
+		# Hard/soft-iron calibration (see calibrate_mag)
+		self.mag_calibration = None
 
 		if self.bus.read_byte_data(LSM, LSM_WHOAMI_ADDRESS) != LSM_WHOAMI_CONTENTS:
 			raise Exception("LSM not found at address {}.".format(LSM))
 		else:
 			# Enable accelerometer axes and set ODR (output data rate) = 50 Hz
-			self.bus.write_byte_data(LSM, LSM_CTRL_1, LSM_ACC_SET_ODR[self.acc_odr])
+			self.bus.write_byte_data(LSM, LSM_CTRL_1, LSM_ACC_SET_ODR[self.acc_odr] | LSM_ACC_BDU)
 			# Set acceleration full-scale to +/-2g
 			self.bus.write_byte_data(LSM, LSM_CTRL_2, LSM_ACC_SET_SCALE[self.acc_scale])
 			# Disable thermometer, set magnetic resolution high, ODR 50Hz
@@ -109,33 +156,123 @@ class Accelerometer:
 			print("Accelerometer/magnetometer set up.")
 
 	def read_acc(self):
-		x_L = self.bus.read_byte_data(LSM, LSM_ACC_X_L)
-		x_H = self.bus.read_byte_data(LSM, LSM_ACC_X_H)
-		y_L = self.bus.read_byte_data(LSM, LSM_ACC_Y_L)
-		y_H = self.bus.read_byte_data(LSM, LSM_ACC_Y_H)
-		z_L = self.bus.read_byte_data(LSM, LSM_ACC_Z_L)
-		z_H = self.bus.read_byte_data(LSM, LSM_ACC_Z_H)
-		self.accx = (x_H << 8 | x_L) * self.acc_sens
-		self.accy = (y_H << 8 | y_L) * self.acc_sens
-		self.accz = (z_H << 8 | z_L) * self.acc_sens
+		# Read all three axes in one transaction
+		self.accx, self.accy, self.accz = read_xyz(self.bus, LSM, LSM_ACC_X_L) * self.acc_sens
 		return (self.accx, self.accy, self.accz)
 
 	def read_mag(self):
-		x_L = self.bus.read_byte_data(LSM, LSM_MAG_X_L)
-		x_H = self.bus.read_byte_data(LSM, LSM_MAG_X_H)
-		y_L = self.bus.read_byte_data(LSM, LSM_MAG_Y_L)
-		y_H = self.bus.read_byte_data(LSM, LSM_MAG_Y_H)
-		z_L = self.bus.read_byte_data(LSM, LSM_MAG_Z_L)
-		z_H = self.bus.read_byte_data(LSM, LSM_MAG_Z_H)
-		self.magx = (x_H << 8 | x_L) * self.mag_sens
-		self.magy = (y_H << 8 | y_L) * self.mag_sens
-		self.magz = (z_H << 8 | z_L) * self.mag_sens
+		# Read all three axes in one transaction
+		self.magx, self.magy, self.magz = self._correct_mag(read_xyz(self.bus, LSM, LSM_MAG_X_L) * self.mag_sens)
 		return (self.magx, self.magy, self.magz)
 
+	def acc_data_ready(self):
+		# True if an accelerometer sample has arrived since the last read
+		return bool(self.bus.read_byte_data(LSM, LSM_STATUS_A) & LSM_STATUS_DATA_READY)
+
+	def acc_overrun(self):
+		# True if an accelerometer sample has been overwritten before it was read
+		return bool(self.bus.read_byte_data(LSM, LSM_STATUS_A) & LSM_STATUS_OVERRUN)
+
+	def mag_data_ready(self):
+		# True if a magnetometer sample has arrived since the last read
+		return bool(self.bus.read_byte_data(LSM, LSM_STATUS_M) & LSM_STATUS_DATA_READY)
+
+	def mag_overrun(self):
+		# True if a magnetometer sample has been overwritten before it was read
+		return bool(self.bus.read_byte_data(LSM, LSM_STATUS_M) & LSM_STATUS_OVERRUN)
+
+	def read_acc_new(self):
+		# Read the status and output registers in one transaction and return
+		# the sample only if it is new, otherwise return None
+		status, counts = read_status_xyz(self.bus, LSM, LSM_STATUS_A)
+		if not status & LSM_STATUS_DATA_READY:
+			self.acc_duplicates_avoided += 1
+			return None
+		if status & LSM_STATUS_OVERRUN:
+			self.acc_overruns += 1
+		self.accx, self.accy, self.accz = counts * self.acc_sens
+		return (self.accx, self.accy, self.accz)
+
+	def read_mag_new(self):
+		# Read the status and output registers in one transaction and return
+		# the sample only if it is new, otherwise return None
+		status, counts = read_status_xyz(self.bus, LSM, LSM_STATUS_M)
+		if not status & LSM_STATUS_DATA_READY:
+			self.mag_duplicates_avoided += 1
+			return None
+		if status & LSM_STATUS_OVERRUN:
+			self.mag_overruns += 1
+		self.magx, self.magy, self.magz = self._correct_mag(counts * self.mag_sens)
+		return (self.magx, self.magy, self.magz)
+
+	def _correct_mag(self, fields):
+		# Remove hard and soft-iron distortion, if calibrated
+		if self.mag_calibration is None:
+			return fields
+		return self.mag_calibration.correct(fields)
+
+	def calibrate_mag(self, num_samples=2000):
+		# Collect `num_samples` magnetometer samples while the sensor is
+		# turned through as many orientations as possible, then fit an
+		# ellipsoid to them
+		samples = np.empty((num_samples, 3))
+		print("Calibrating magnetometer...")
+		print("Slowly rotate the sensor in all directions.")
+		n = 0
+		while n < num_samples:
+			status, counts = read_status_xyz(self.bus, LSM, LSM_STATUS_M)
+			if not status & LSM_STATUS_DATA_READY:
+				sleep(0.25/self.mag_odr)
+				continue
+			samples[n] = counts
+			n += 1
+		self.mag_calibration = MagnetometerCalibration.fit(samples * self.mag_sens)
+		print("Calibration successful.")
+
+	def save_mag_calibration(self, filename):
+		self.mag_calibration.save(filename)
+
+	def load_mag_calibration(self, filename):
+		self.mag_calibration = MagnetometerCalibration.load(filename)
+
+	def enable_fifo(self, watermark=LSM_FIFO_DEPTH//2):
+		# Put the accelerometer FIFO in stream mode, so that it always holds
+		# the most recent samples, with the watermark flag set at
+		# `watermark` samples
+		if not 0 <= watermark <= LSM_FIFO_WATERMARK_MASK:
+			raise ValueError("FIFO watermark must be 0 to {}, not {}".format(LSM_FIFO_WATERMARK_MASK, watermark))
+		self.bus.write_byte_data(LSM, LSM_FIFO_CTRL,
+		                         LSM_FIFO_MODE_STREAM | watermark)
+		self.bus.write_byte_data(LSM, LSM_CTRL_0, LSM_FIFO_ENABLE)
+
+	def disable_fifo(self):
+		self.bus.write_byte_data(LSM, LSM_CTRL_0, 0b00000000)
+		self.bus.write_byte_data(LSM, LSM_FIFO_CTRL, LSM_FIFO_MODE_BYPASS)
+
+	def fifo_level(self):
+		# Number of unread accelerometer samples in the FIFO
+		fifo_src = self.bus.read_byte_data(LSM, LSM_FIFO_SRC)
+		if fifo_src & LSM_FIFO_SRC_OVERRUN:
+			return LSM_FIFO_DEPTH
+		return fifo_src & LSM_FIFO_SRC_LEVEL_MASK
+
+	def read_acc_fifo(self, num_samples=None):
+		# Drain the FIFO (or `num_samples` from it) in as few transactions
+		# as possible. Returns an (N,) array of timestamps and an (N, 3)
+		# array of accelerations. The newest sample is stamped with the
+		# time of the read and the others are spaced back from it at the ODR.
+		if num_samples is None:
+			num_samples = self.fifo_level()
+		counts = read_xyz_samples(self.bus, LSM, LSM_ACC_X_L, num_samples)
+		read_time = monotonic()
+		timestamps = read_time - np.arange(num_samples - 1, -1, -1) / self.acc_odr
+		return timestamps, counts * self.acc_sens
+
 ########################################################################
 ## Main ##
 ##########
 if __name__ == "__main__":
+	import os
 	from smbus import SMBus
 	from time import sleep
 
@@ -146,6 +283,13 @@ if __name__ == "__main__":
 	# Initialise the accelerometer
 	accelerometer1 = Accelerometer(bus)
 
+	# Load the magnetometer calibration, or calibrate if there isn't one
+	if os.path.exists(MAGNETOMETER_CALIBRATION_FILE):
+		accelerometer1.load_mag_calibration(MAGNETOMETER_CALIBRATION_FILE)
+	else:
+		accelerometer1.calibrate_mag()
+		accelerometer1.save_mag_calibration(MAGNETOMETER_CALIBRATION_FILE)
+
 	try:
 		while True:
 			print(accelerometer1.read_acc())
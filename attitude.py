@@ -0,0 +1,451 @@
+########################################################################
+## Imports ##
+#############
+import numpy as np
+try:
+    from scipy.signal import lfilter
+except ImportError:
+    lfilter = None
+
+########################################################################
+## Quaternions ##
+#################
+# Quaternions are (w, x, y, z) arrays, and every function works along the
+# last axis, so it applies equally to one quaternion or an (N, 4) array.
+# An attitude quaternion q rotates body frame vectors into the world
+# frame, which is x north, y west, z up (so a level, stationary
+# accelerometer reads +1 g on z).
+DEG_TO_RAD = np.pi/180
+RAD_TO_DEG = 180/np.pi
+
+
+def quaternion_multiply(p, q, out=None):
+    # Hamilton product p q. out must not overlap p or q.
+    p = np.asarray(p, dtype=float)
+    q = np.asarray(q, dtype=float)
+    if out is None:
+        out = np.empty(np.broadcast(p, q).shape)
+    pw, px, py, pz = p[..., 0], p[..., 1], p[..., 2], p[..., 3]
+    qw, qx, qy, qz = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+    out[..., 0] = pw*qw - px*qx - py*qy - pz*qz
+    out[..., 1] = pw*qx + px*qw + py*qz - pz*qy
+    out[..., 2] = pw*qy - px*qz + py*qw + pz*qx
+    out[..., 3] = pw*qz + px*qy - py*qx + pz*qw
+    return out
+
+
+def quaternion_conjugate(q):
+    q = np.array(q, dtype=float)
+    q[..., 1:] *= -1
+    return q
+
+
+def quaternion_normalise(q):
+    q = np.asarray(q, dtype=float)
+    return q/np.linalg.norm(q, axis=-1, keepdims=True)
+
+
+def quaternion_from_rotation_vector(v):
+    # Rotation by |v| radians about v
+    v = np.asarray(v, dtype=float)
+    angle = np.linalg.norm(v, axis=-1, keepdims=True)
+    q = np.empty(v.shape[:-1] + (4,))
+    q[..., :1] = np.cos(angle/2)
+    # sin(angle/2)/angle, which tends to 1/2 for small angles
+    q[..., 1:] = v*0.5*np.sinc(angle/(2*np.pi))
+    return q
+
+
+def rotation_vector_from_quaternion(q):
+    # Inverse of quaternion_from_rotation_vector, for quaternions with
+    # w >= 0 (rotations of up to 180 degrees)
+    q = np.asarray(q, dtype=float)
+    s = np.linalg.norm(q[..., 1:], axis=-1, keepdims=True)
+    angle = 2*np.arctan2(s, q[..., :1])
+    # angle/s tends to 2 for small angles
+    scale = np.where(s > 1e-12, angle/np.maximum(s, 1e-12), 2.0)
+    return q[..., 1:]*scale
+
+
+def quaternion_from_acc_mag(acc, mag):
+    # Absolute attitude from gravity and magnetic field vectors (TRIAD).
+    # The rows of the body to world rotation matrix are the world axes in
+    # body coordinates: up is along the accelerometer reading, west is
+    # perpendicular to up and the magnetic field, and north completes the
+    # set. Works on contiguous component arrays, which is much quicker
+    # than slicing columns out of (N, 3) arrays.
+    ax, ay, az = _components(acc)
+    mx, my, mz = _components(mag)
+    norm = np.sqrt(ax*ax + ay*ay + az*az)
+    ux, uy, uz = ax/norm, ay/norm, az/norm
+    wx = uy*mz - uz*my
+    wy = uz*mx - ux*mz
+    wz = ux*my - uy*mx
+    norm = np.sqrt(wx*wx + wy*wy + wz*wz)
+    wx /= norm
+    wy /= norm
+    wz /= norm
+    nx = wy*uz - wz*uy
+    ny = wz*ux - wx*uz
+    nz = wx*uy - wy*ux
+    return _quaternion_from_elements(nx, ny, nz, wx, wy, wz, ux, uy, uz)
+
+
+def _components(vectors):
+    # The x, y and z components of (..., 3) vectors as contiguous arrays
+    return np.ascontiguousarray(np.moveaxis(np.asarray(vectors, dtype=float), -1, 0))
+
+
+def quaternion_from_matrix(R):
+    # Quaternion from (..., 3, 3) rotation matrices
+    R = np.asarray(R, dtype=float)
+    return _quaternion_from_elements(*(R[..., i, j] for i in range(3) for j in range(3)))
+
+
+def _quaternion_from_elements(R00, R01, R02, R10, R11, R12, R20, R21, R22):
+    # Each matrix is converted with whichever of the four standard
+    # formulas divides by the largest component, which keeps the
+    # conversion accurate for any rotation. The result has w >= 0.
+    #
+    # 4 w^2, 4 x^2, 4 y^2, 4 z^2
+    squares = (1 + R00 + R11 + R22, 1 + R00 - R11 - R22,
+               1 - R00 + R11 - R22, 1 - R00 - R11 + R22)
+    # The sums and differences of the off-diagonal elements are 4 times
+    # the products of pairs of components
+    wx = R21 - R12
+    wy = R02 - R20
+    wz = R10 - R01
+    xy = R01 + R10
+    xz = R02 + R20
+    yz = R12 + R21
+    # Attitudes are almost never turned by close to 180 degrees, so use the
+    # w formula everywhere first and then redo the rows that need another
+    q = np.empty(np.shape(R00) + (4,))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        four = 2*np.sqrt(squares[0])
+        q[..., 0] = four/4
+        q[..., 1] = wx/four
+        q[..., 2] = wy/four
+        q[..., 3] = wz/four
+    others = np.maximum(np.maximum(squares[1], squares[2]), squares[3])
+    redo = np.flatnonzero(squares[0] < others)
+    if redo.size:
+        q = q.reshape(-1, 4)
+        elements = [np.ravel(element)[redo] for element in (wx, wy, wz, xy, xz, yz)]
+        largest = np.argmax(np.stack([np.ravel(square)[redo] for square in squares]), axis=0)
+        for i, (a, b, c) in ((1, (0, 3, 4)), (2, (1, 3, 5)), (3, (2, 4, 5))):
+            rows = largest == i
+            four = 2*np.sqrt(np.ravel(squares[i])[redo][rows])
+            components = [j for j in range(4) if j != i]
+            q[redo[rows], i] = four/4
+            q[redo[rows], components[0]] = elements[a][rows]/four
+            q[redo[rows], components[1]] = elements[b][rows]/four
+            q[redo[rows], components[2]] = elements[c][rows]/four
+        q = q.reshape(np.shape(R00) + (4,))
+    q[q[..., 0] < 0] *= -1
+    return q
+
+
+def quaternion_to_euler(q):
+    # Roll, pitch and yaw in degrees (z-y-x order) as an (..., 3) array
+    q = np.asarray(q, dtype=float)
+    w, x, y, z = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+    roll = np.arctan2(2*(w*x + y*z), 1 - 2*(x*x + y*y))
+    pitch = np.arcsin(np.clip(2*(w*y - z*x), -1, 1))
+    yaw = np.arctan2(2*(w*z + x*y), 1 - 2*(y*y + z*z))
+    return np.stack((roll, pitch, yaw), axis=-1)*RAD_TO_DEG
+
+
+########################################################################
+## Real-time filter ##
+######################
+def _floats(values):
+    # A reading as a tuple of Python floats (or None)
+    if values is None:
+        return None
+    return tuple(np.asarray(values, dtype=float).tolist())
+
+
+class MahonyFilter:
+    # Mahony's nonlinear complementary filter: the gyroscope rates are
+    # integrated, with a feedback term that turns the estimated attitude
+    # towards the one the accelerometer and magnetometer indicate. kp (in
+    # 1/s) sets how quickly it does so (roughly a time constant of 1/kp)
+    # and ki integrates any remaining gyroscope bias.
+    #
+    # Rates are in degrees per second, as from Gyroscope.read(); only the
+    # directions of the accelerometer and magnetometer vectors are used,
+    # so their units don't matter. The arithmetic for a step is done with
+    # plain floats, which is far quicker than NumPy on a handful of
+    # values, and the result is written into the preallocated
+    # self.quaternion array.
+    #
+    # See Mahony, Hamel & Pflimlin, 'Nonlinear Complementary Filters on
+    # the Special Orthogonal Group', IEEE Trans. Automatic Control, 2008
+    def __init__(self, kp=1.0, ki=0.0):
+        self.kp = kp
+        self.ki = ki
+        self.quaternion = np.array([1.0, 0.0, 0.0, 0.0])
+        self._q = (1.0, 0.0, 0.0, 0.0)
+        self._integral = (0.0, 0.0, 0.0)
+        self.initialised = False
+
+    def initialise(self, acc, mag):
+        # Start from the attitude given by the accelerometer and
+        # magnetometer alone, rather than converging to it from level
+        self._q = tuple(quaternion_from_acc_mag(acc, mag).tolist())
+        self._integral = (0.0, 0.0, 0.0)
+        self.quaternion[:] = self._q
+        self.initialised = True
+
+    def update(self, gyro, dt, acc=None, mag=None):
+        # Advance by one gyroscope sample taken over dt seconds. acc and
+        # mag are the latest readings, or None if there isn't one (with no
+        # magnetometer only roll and pitch are corrected). Returns the
+        # attitude quaternion, which is updated in place.
+        if not self.initialised and acc is not None and mag is not None:
+            self.initialise(acc, mag)
+        # Arithmetic on NumPy scalars is slow, so take plain floats
+        gx, gy, gz = _floats(gyro)
+        self._step(gx, gy, gz, float(dt), _floats(acc), _floats(mag))
+        self.quaternion[:] = self._q
+        return self.quaternion
+
+    def update_batch(self, gyro, dt, acc=None, mag=None, out=None):
+        # Advance over an (N, 3) batch of gyroscope samples (e.g. from
+        # Gyroscope.read_fifo()). dt is a scalar or (N,) array. acc and mag
+        # are None, single (3,) readings used for every sample, or (N, 3)
+        # arrays. Returns the (N, 4) attitude after each sample.
+        gyro = np.asarray(gyro, dtype=float)
+        N = gyro.shape[0]
+        if out is None:
+            out = np.empty((N, 4))
+        dts = np.broadcast_to(np.asarray(dt, dtype=float), (N,)).tolist()
+        accs = self._per_sample(acc, N)
+        mags = self._per_sample(mag, N)
+        if not self.initialised and accs[0] is not None and mags[0] is not None:
+            self.initialise(accs[0], mags[0])
+
+        qs = [None]*N
+        step = self._step
+        for k, (gx, gy, gz) in enumerate(gyro.tolist()):
+            step(gx, gy, gz, dts[k], accs[k], mags[k])
+            qs[k] = self._q
+        if N:
+            out[...] = qs
+            self.quaternion[:] = self._q
+        return out
+
+    @staticmethod
+    def _per_sample(values, N):
+        # A list of N readings (tuples of floats, or None)
+        if values is None:
+            return [None]*N
+        values = np.asarray(values, dtype=float)
+        if values.ndim == 1:
+            return [tuple(values.tolist())]*N
+        return [tuple(value) for value in values.tolist()]
+
+    def _step(self, gx, gy, gz, dt, acc, mag):
+        q0, q1, q2, q3 = self._q
+        gx *= DEG_TO_RAD
+        gy *= DEG_TO_RAD
+        gz *= DEG_TO_RAD
+
+        if acc is not None:
+            ax, ay, az = acc
+            norm = (ax*ax + ay*ay + az*az)**0.5
+        if acc is not None and norm > 0:
+            ax /= norm
+            ay /= norm
+            az /= norm
+            # Direction of gravity (up) in the body frame, halved
+            vx = q1*q3 - q0*q2
+            vy = q0*q1 + q2*q3
+            vz = q0*q0 - 0.5 + q3*q3
+            # Error is the cross product of measured and estimated
+            ex = ay*vz - az*vy
+            ey = az*vx - ax*vz
+            ez = ax*vy - ay*vx
+
+            if mag is not None:
+                mx, my, mz = mag
+                norm = (mx*mx + my*my + mz*mz)**0.5
+                if norm > 0:
+                    mx /= norm
+                    my /= norm
+                    mz /= norm
+                    # Field in the world frame, rotated about up so it has
+                    # no west component
+                    hx = 2*(mx*(0.5 - q2*q2 - q3*q3) + my*(q1*q2 - q0*q3) + mz*(q1*q3 + q0*q2))
+                    hy = 2*(mx*(q1*q2 + q0*q3) + my*(0.5 - q1*q1 - q3*q3) + mz*(q2*q3 - q0*q1))
+                    bx = (hx*hx + hy*hy)**0.5
+                    bz = 2*(mx*(q1*q3 - q0*q2) + my*(q2*q3 + q0*q1) + mz*(0.5 - q1*q1 - q2*q2))
+                    # Estimated direction of that field in the body frame,
+                    # halved
+                    wx = bx*(0.5 - q2*q2 - q3*q3) + bz*(q1*q3 - q0*q2)
+                    wy = bx*(q1*q2 - q0*q3) + bz*(q0*q1 + q2*q3)
+                    wz = bx*(q0*q2 + q1*q3) + bz*(0.5 - q1*q1 - q2*q2)
+                    ex += my*wz - mz*wy
+                    ey += mz*wx - mx*wz
+                    ez += mx*wy - my*wx
+
+            # The error terms are halved, hence the factors of 2
+            if self.ki > 0:
+                ix, iy, iz = self._integral
+                ix += 2*self.ki*ex*dt
+                iy += 2*self.ki*ey*dt
+                iz += 2*self.ki*ez*dt
+                self._integral = (ix, iy, iz)
+                gx += ix
+                gy += iy
+                gz += iz
+            gx += 2*self.kp*ex
+            gy += 2*self.kp*ey
+            gz += 2*self.kp*ez
+
+        # Integrate q_dot = q (0, g)/2
+        gx *= 0.5*dt
+        gy *= 0.5*dt
+        gz *= 0.5*dt
+        q0, q1, q2, q3 = (q0 - q1*gx - q2*gy - q3*gz,
+                          q1 + q0*gx + q2*gz - q3*gy,
+                          q2 + q0*gy - q1*gz + q3*gx,
+                          q3 + q0*gz + q1*gy - q2*gx)
+        norm = (q0*q0 + q1*q1 + q2*q2 + q3*q3)**0.5
+        self._q = (q0/norm, q1/norm, q2/norm, q3/norm)
+
+
+########################################################################
+## Offline filter ##
+####################
+def quaternion_cumulative_product(q, group_size=8):
+    # Prefix products q[0], q[0] q[1], q[0] q[1] q[2], ... along the
+    # second to last axis of an (..., N, 4) array. The quaternions are
+    # split into groups, which are multiplied out one position at a time
+    # in parallel; the prefix products of the group totals (found the
+    # same way, recursively) are then multiplied into every group. That
+    # is a handful of full length vectorised products, however long q is.
+    q = np.array(q, dtype=float)
+    N = q.shape[-2]
+    if N <= group_size:
+        for k in range(1, N):
+            q[..., k, :] = quaternion_multiply(q[..., k - 1, :], q[..., k, :])
+        return q
+
+    # Pad with identity quaternions to a whole number of groups
+    groups = -(-N//group_size)
+    padded = np.zeros(q.shape[:-2] + (groups*group_size, 4))
+    padded[..., 0] = 1
+    padded[..., :N, :] = q
+    grouped = padded.reshape(q.shape[:-2] + (groups, group_size, 4))
+    for k in range(1, group_size):
+        grouped[..., k, :] = quaternion_multiply(grouped[..., k - 1, :], grouped[..., k, :])
+    totals = quaternion_cumulative_product(grouped[..., :-1, -1, :], group_size)
+    grouped[..., 1:, :, :] = quaternion_multiply(totals[..., np.newaxis, :], grouped[..., 1:, :, :])
+    return padded[..., :N, :]
+
+
+def complementary_filter(gyro, acc, mag, dt, kp=1.0, initial=None, block_size=4096):
+    # Reprocess recorded (N, 3) gyroscope, accelerometer and magnetometer
+    # arrays (all at the gyroscope rate) into (N, 4) attitude quaternions,
+    # vectorised over time. This is the linear counterpart of
+    # MahonyFilter with ki = 0: the difference between the integrated
+    # gyroscope attitude and the accelerometer/magnetometer attitude is
+    # low-pass filtered with time constant 1/kp and fed back.
+    #
+    # The log is processed in blocks. Within a block the gyroscope rates
+    # are integrated with a prefix product of rotation quaternions, the
+    # drift against the absolute attitude is expressed as a small
+    # rotation vector and filtered with a first order IIR, and the
+    # corrected attitude at the end of the block starts the next one, so
+    # the drift being filtered always stays small. dt is a scalar or (N,)
+    # array (the filter coefficient uses its mean).
+    gyro = np.asarray(gyro, dtype=float)
+    N = gyro.shape[0]
+    dt = np.broadcast_to(np.asarray(dt, dtype=float), (N,))
+    absolute = quaternion_from_acc_mag(acc, mag)
+    rotations = quaternion_from_rotation_vector(gyro*(DEG_TO_RAD*dt)[:, np.newaxis])
+    alpha = 1 - np.exp(-kp*dt.mean())
+
+    out = np.empty((N, 4))
+    start = absolute[0] if initial is None else quaternion_normalise(initial)
+    for i in range(0, N, block_size):
+        block = slice(i, min(i + block_size, N))
+        # Gyroscope-only attitude, starting from the last corrected one
+        integrated = quaternion_multiply(start, quaternion_cumulative_product(rotations[block]))
+        # World frame rotation taking it to the absolute attitude
+        drift = quaternion_multiply(absolute[block], quaternion_conjugate(integrated))
+        drift *= np.where(drift[:, :1] < 0, -1, 1)
+        drift = rotation_vector_from_quaternion(drift)
+        # y_k = alpha x_k + (1 - alpha) y_{k-1}, from y = 0 as the start
+        # of the block is already corrected
+        if lfilter is not None:
+            correction = lfilter([alpha], [1, alpha - 1], drift, axis=0)
+        else:
+            correction = np.empty_like(drift)
+            previous = np.zeros(3)
+            for k in range(drift.shape[0]):
+                previous = correction[k] = alpha*drift[k] + (1 - alpha)*previous
+        quaternion_multiply(quaternion_from_rotation_vector(correction), integrated, out=out[block])
+        start = quaternion_normalise(out[block.stop - 1])
+    return quaternion_normalise(out)
+
+
+########################################################################
+## Main ##
+##########
+if __name__ == "__main__":
+    import time
+
+    # Simulate a sensor spinning about a tilted axis, with gyroscope bias
+    # and noise, and check both filters follow the true attitude
+    rng = np.random.default_rng(0)
+    rate = 100
+    N = 60*rate
+    dt = 1/rate
+    axis = np.array([0.3, -0.2, 1.0])/np.linalg.norm([0.3, -0.2, 1.0])
+    true_rates = 30*axis*np.sin(np.arange(N)*dt)[:, np.newaxis]
+    true_rotations = quaternion_from_rotation_vector(true_rates*DEG_TO_RAD*dt)
+    start = quaternion_normalise([0.9, 0.1, -0.2, 0.3])
+    truth = quaternion_multiply(start, quaternion_cumulative_product(true_rotations))
+    inverse = quaternion_conjugate(truth)
+
+    def to_body(vector):
+        # World vector as seen in the body frame at every step
+        world = np.zeros((N, 4))
+        world[:, 1:] = vector
+        return quaternion_multiply(quaternion_multiply(inverse, world), truth)[:, 1:]
+
+    gyro = true_rates + 0.5 + rng.normal(0, 0.2, (N, 3))
+    acc = to_body([0, 0, 1]) + rng.normal(0, 0.01, (N, 3))
+    mag = to_body([0.2, 0, -0.4]) + rng.normal(0, 0.005, (N, 3))
+
+    def error(q):
+        # Angle between estimated and true attitudes, in degrees
+        difference = quaternion_multiply(quaternion_conjugate(truth), q)
+        return 2*np.arccos(np.clip(np.abs(difference[:, 0]), 0, 1))*RAD_TO_DEG
+
+    mahony = MahonyFilter(kp=1.0, ki=0.05)
+    times = np.empty(N)
+    real_time = np.empty((N, 4))
+    for k in range(N):
+        start_time = time.perf_counter()
+        real_time[k] = mahony.update(gyro[k], dt, acc[k], mag[k])
+        times[k] = time.perf_counter() - start_time
+    print("MahonyFilter.update: {:.1f} us per step (max {:.1f} us), mean error {:.2f} deg"
+          .format(np.median(times)*1e6, times.max()*1e6, error(real_time)[rate:].mean()))
+
+    batch = MahonyFilter(kp=1.0, ki=0.05)
+    start_time = time.perf_counter()
+    batch_result = np.concatenate([batch.update_batch(gyro[i:i + 32], dt, acc[i:i + 32][-1], mag[i:i + 32][-1])
+                                   for i in range(0, N, 32)])
+    elapsed = time.perf_counter() - start_time
+    print("MahonyFilter.update_batch (32 sample FIFO batches): {:.1f} us per sample, mean error {:.2f} deg"
+          .format(elapsed/N*1e6, error(batch_result)[rate:].mean()))
+
+    start_time = time.perf_counter()
+    offline = complementary_filter(gyro, acc, mag, dt, kp=1.0)
+    elapsed = time.perf_counter() - start_time
+    print("complementary_filter: {:.2f} million samples/s, mean error {:.2f} deg"
+          .format(N/elapsed/1e6, error(offline)[rate:].mean()))
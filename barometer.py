@@ -2,6 +2,9 @@
 ## Imports ##
 #############
 import numpy as np
+from time import sleep
+from calibration import RunningStatistics
+from i2c import read_block, decode_int16, decode_int24
 
 ########################################################################
 ## LPS331AP register addresses ##
@@ -40,6 +43,11 @@ LPS_PRESS_OUT_H = 0x2A # MSB
 LPS_TEMP_OUT_L = 0x2B # LSB
 LPS_TEMP_OUT_H = 0x2C # MSB
 
+# Pressure and temperature output registers are contiguous, and follow
+# straight on from the status register
+LPS_OUTPUT_BLOCK_LENGTH = 5
+LPS_STATUS_BLOCK_LENGTH = 6
+
 # Other
 LPS_AMP_CTRL = 0x30
 
@@ -51,50 +59,197 @@ LPS_AMP_CTRL = 0x30
 LPS_SET_ODR = {12.5:0b11100000, # 12.5Hz
                25 : 0b11110000} # 25Hz
 
+# Block data update: output registers are not updated until all bytes
+# of the previous sample have been read
+LPS_BDU = 0b00000100
+
+# Status
+LPS_STATUS_TEMP_READY = 0b00000001 # New temperature sample available
+LPS_STATUS_PRESS_READY = 0b00000010 # New pressure sample available
+LPS_STATUS_TEMP_OVERRUN = 0b00010000 # Temperature sample overwritten unread
+LPS_STATUS_PRESS_OVERRUN = 0b00100000 # Pressure sample overwritten unread
+
 ########################################################################
-## Conversion function ##
-#########################
+## Conversion functions ##
+##########################
 sealevel_pressure = 1013.25 # hPa or mbar
+# Constants of the hypsometric formula
+ALTITUDE_EXPONENT = 1/5.257
+KELVIN_OFFSET = 273.15 # deg C to K
+LAPSE_RATE = 0.0065 # K/m
+# Operating range of the LPS331AP
+LPS_MIN_PRESSURE = 260 # mbar
+LPS_MAX_PRESSURE = 1260 # mbar
+LPS_MAX_TEMPERATURE = 85 # deg C
+
 # See https://keisan.casio.com/has10/SpecExec.cgi?path=06000000.Science%252F02100100.Earth%2520science%252F12000300.Altitude%2520from%2520atmospheric%2520pressure%252Fdefault.xml&charset=utf-8
-def pressure_to_altitude(pressure, temperature):
-    return (((pressure/1013.25)**(1/5.257) - 1) * (temperature + 273.15))/0.0065
+def pressure_to_altitude(pressure, temperature, sealevel_pressure=sealevel_pressure):
+    # Accepts scalars, or arrays (or lists) of pressures (mbar) and
+    # temperatures (deg C) that broadcast together
+    if isinstance(pressure, (int, float)) and isinstance(temperature, (int, float)):
+        # Plain float arithmetic is quickest for single samples
+        return ((sealevel_pressure/pressure)**ALTITUDE_EXPONENT - 1) * (temperature + KELVIN_OFFSET) / LAPSE_RATE
+    pressure = np.asarray(pressure, dtype=float)
+    temperature = np.asarray(temperature, dtype=float)
+    # Work in place in a single output array, of the broadcast shape, to
+    # avoid temporaries
+    altitude = np.empty(np.broadcast_shapes(pressure.shape, temperature.shape))
+    np.divide(sealevel_pressure, pressure, out=altitude)
+    np.power(altitude, ALTITUDE_EXPONENT, out=altitude)
+    altitude -= 1
+    altitude *= temperature + KELVIN_OFFSET
+    altitude *= 1/LAPSE_RATE
+    # Zero-dimensional inputs give a scalar, as plain floats do
+    return altitude if altitude.ndim else altitude[()]
+
+
+class AltitudeTable:
+    # Linearly interpolated lookup table for pressure_to_altitude, which
+    # avoids the fractional power. The altitude is
+    #    g(pressure) * (temperature + 273.15)
+    # so only g needs tabulating. The table is spaced finely enough that
+    # the interpolation error is below max_error (m) for any pressure in
+    # range and any temperature up to max_temperature. Pressures outside
+    # the table fall back to the exact formula.
+    def __init__(self, min_pressure=LPS_MIN_PRESSURE, max_pressure=LPS_MAX_PRESSURE,
+                 max_error=0.01, max_temperature=LPS_MAX_TEMPERATURE,
+                 sealevel_pressure=sealevel_pressure):
+        self.min_pressure = min_pressure
+        self.max_pressure = max_pressure
+        self.sealevel_pressure = sealevel_pressure
+
+        # Linear interpolation error is at most step^2/8 * max|g''|, and
+        # |g''| is largest at the lowest pressure
+        max_g_error = max_error / (max_temperature + KELVIN_OFFSET)
+        max_curvature = (sealevel_pressure**ALTITUDE_EXPONENT / LAPSE_RATE
+                         * ALTITUDE_EXPONENT * (ALTITUDE_EXPONENT + 1)
+                         * min_pressure**(-ALTITUDE_EXPONENT - 2))
+        max_step = np.sqrt(8 * max_g_error / max_curvature)
+        num_points = int(np.ceil((max_pressure - min_pressure) / max_step)) + 1
+
+        self.pressures = np.linspace(min_pressure, max_pressure, num_points)
+        # g is the altitude at an absolute temperature of 1 K
+        self.g = pressure_to_altitude(self.pressures, 1 - KELVIN_OFFSET, sealevel_pressure)
+        self.g_step = np.diff(self.g)
+        self.inverse_step = (num_points - 1) / (max_pressure - min_pressure)
+        # Python lists are quicker to index with a single value
+        self.g_list = self.g.tolist()
+        self.g_step_list = self.g_step.tolist()
+
+    def __call__(self, pressure, temperature):
+        if isinstance(pressure, (int, float)) and isinstance(temperature, (int, float)):
+            if not self.min_pressure <= pressure < self.max_pressure:
+                return pressure_to_altitude(pressure, temperature, self.sealevel_pressure)
+            position = (pressure - self.min_pressure) * self.inverse_step
+            i = int(position)
+            return ((self.g_list[i] + (position - i) * self.g_step_list[i])
+                    * (temperature + KELVIN_OFFSET))
+
+        # As pressure_to_altitude: the result has the broadcast shape
+        temperature = np.asarray(temperature, dtype=float)
+        pressure = np.asarray(pressure, dtype=float)
+        pressure = np.broadcast_to(pressure, np.broadcast_shapes(pressure.shape, temperature.shape))
+        in_range = (pressure >= self.min_pressure) & (pressure < self.max_pressure)
+        position = np.subtract(np.where(in_range, pressure, self.min_pressure),
+                               self.min_pressure, dtype=float)
+        position *= self.inverse_step
+        i = position.astype(np.intp)
+        position -= i
+        position *= self.g_step[i]
+        position += self.g[i]
+        position *= temperature + KELVIN_OFFSET
+        if not in_range.all():
+            out_of_range = ~in_range
+            position[out_of_range] = pressure_to_altitude(
+                pressure[out_of_range],
+                np.broadcast_to(temperature, pressure.shape)[out_of_range],
+                self.sealevel_pressure)
+        return position if position.ndim else position[()]
+
 
 ########################################################################
 ## Barometer class ##
 #####################
 class Barometer:
-    def __init__(self, bus, odr=12.5, calibration_num_datapoints=1000):
+    def __init__(self, bus, odr=12.5, calibration_num_datapoints=1000,
+                 calibration_standard_error=0.05, calibration_min_datapoints=20,
+                 calibration_max_missed_polls=100, sealevel_pressure=sealevel_pressure,
+                 use_altitude_table=False, sleep=sleep):
         self.bus = bus
         self.odr = odr
+        # Used while waiting for samples; can be replaced (e.g. with a
+        # simulated clock's) for testing
+        self.sleep = sleep
+        self.sealevel_pressure = sealevel_pressure
+        # Pressure to altitude conversion, either exact or by table lookup
+        if use_altitude_table:
+            self.pressure_to_altitude = AltitudeTable(sealevel_pressure=sealevel_pressure)
+        else:
+            self.pressure_to_altitude = lambda pressure, temperature: pressure_to_altitude(
+                pressure, temperature, sealevel_pressure)
+        # Calibration stops once the standard error of the altitude datum
+        # (in m) reaches calibration_standard_error, or after
+        # calibration_num_datapoints samples, whichever is first
         self.calibration_num_datapoints = calibration_num_datapoints
+        self.calibration_standard_error = calibration_standard_error
+        self.calibration_min_datapoints = calibration_min_datapoints
+        # calibrate() gives up after this many polls in a row without a new
+        # sample, rather than waiting forever on a sensor that isn't running
+        self.calibration_max_missed_polls = calibration_max_missed_polls
         self.pressure_datum = 0
         self.altitude_datum = 0
+        # Measurement noise variances, found by calibrate()
+        self.pressure_variance = None
+        self.altitude_variance = None
+        # Data-ready counters (see read_new)
+        self.duplicates_avoided = 0
+        self.overruns = 0
 
         if self.bus.read_byte_data(LPS, LPS_WHOAMI_ADDRESS) != LPS_WHOAMI_CONTENTS:
             raise Exception("LPS not found at address {}.".format(LPS))
         else:
             # Enable barometer and set ODR 25 Hz
-            self.bus.write_byte_data(LPS, LPS_CTRL_1, LPS_SET_ODR[self.odr])
+            self.bus.write_byte_data(LPS, LPS_CTRL_1, LPS_SET_ODR[self.odr] | LPS_BDU)
             print("Barometer set up.")
 
     def read(self):
-        # Read pressure from registers
-        pressure_XL = self.bus.read_byte_data(LPS, LPS_PRESS_OUT_XL)
-        pressure_L = self.bus.read_byte_data(LPS, LPS_PRESS_OUT_L)
-        pressure_H = self.bus.read_byte_data(LPS, LPS_PRESS_OUT_H)
-        # Read temperature from registers
-        temp_l = self.bus.read_byte_data(LPS, LPS_TEMP_OUT_L)
-        temp_h = self.bus.read_byte_data(LPS, LPS_TEMP_OUT_H)
+        # Read pressure and temperature registers in one transaction
+        self._update(read_block(self.bus, LPS, LPS_PRESS_OUT_XL, LPS_OUTPUT_BLOCK_LENGTH))
+        # Return absolute pressure value
+        return self.pressure
+
+    def data_ready(self):
+        # True if a pressure sample has arrived since the last read
+        return bool(self.bus.read_byte_data(LPS, LPS_STATUS) & LPS_STATUS_PRESS_READY)
+
+    def overrun(self):
+        # True if a pressure sample has been overwritten before it was read
+        return bool(self.bus.read_byte_data(LPS, LPS_STATUS) & LPS_STATUS_PRESS_OVERRUN)
+
+    def read_new(self):
+        # Read the status, pressure and temperature registers in one
+        # transaction and update the stored values only if the pressure
+        # sample is new. Returns the absolute pressure, or None if there
+        # is no new sample.
+        block = read_block(self.bus, LPS, LPS_STATUS, LPS_STATUS_BLOCK_LENGTH)
+        status = block[0]
+        if not status & LPS_STATUS_PRESS_READY:
+            self.duplicates_avoided += 1
+            return None
+        if status & LPS_STATUS_PRESS_OVERRUN:
+            self.overruns += 1
+        self._update(block[1:])
+        return self.pressure
+
+    def _update(self, block):
         # Update stored pressure values in mbar see datasheet for formula
-        self.pressure = (pressure_H << 16 | pressure_L << 8 | pressure_XL) / 4096.0
+        self.pressure = int(decode_int24(block[:3])[0]) / 4096.0
         self.relative_pressure = self.pressure - self.pressure_datum
         # Update stored temperature values in deg C see datasheet for formula
-        self.temperature = 42.5 + (temp_h << 8 | temp_l) / 480.0
+        self.temperature = 42.5 + int(decode_int16(block[3:5])[0]) / 480.0
         # Update the stored altitude value
-        self.altitude = pressure_to_altitude(self.pressure, self.temperature)
+        self.altitude = self.pressure_to_altitude(self.pressure, self.temperature)
         self.relative_altitude = self.altitude - self.altitude_datum
-        # Return absolute pressure value
-        return self.pressure
 
     def read_relative_pressure(self):
         # Update all stored pressure/altitude values
@@ -115,20 +270,39 @@ class Barometer:
         return self.relative_altitude
 
     def calibrate(self):
-        pressure_data = np.zeros(self.calibration_num_datapoints)
-        altitude_data = np.zeros(self.calibration_num_datapoints)
+        pressure_statistics = RunningStatistics()
+        altitude_statistics = RunningStatistics()
 
         print("Calibrating barometer...")
         print("Place the sensor on the ground.")
-        for i in np.arange(self.calibration_num_datapoints):
-            pressure_data[i] = self.read()
-            altitude_data[i] = self.read_altitude()
-        # Calculate average value (TODO: replace with a fancy filter)
-        self.pressure_datum = np.mean(pressure_data)
-        self.altitude_datum = np.mean(altitude_data)
+        missed_polls = 0
+        while pressure_statistics.n < self.calibration_num_datapoints:
+            # Wait for a new sample rather than re-reading the last one
+            if self.read_new() is None:
+                missed_polls += 1
+                if missed_polls > self.calibration_max_missed_polls:
+                    raise Exception("No new barometer sample after {} polls."
+                                    .format(self.calibration_max_missed_polls))
+                self.sleep(0.25/self.odr)
+                continue
+            missed_polls = 0
+            pressure_statistics.update(self.pressure)
+            altitude_statistics.update(self.altitude)
+            # Stop as soon as the datum is known well enough
+            if (altitude_statistics.n >= self.calibration_min_datapoints and
+                    altitude_statistics.standard_error() <= self.calibration_standard_error):
+                break
+
+        self.pressure_datum = pressure_statistics.mean
+        self.altitude_datum = altitude_statistics.mean
+        # The spread of the samples is the measurement noise, which is the
+        # R to use in a Kalman filter on the relative altitude
+        self.pressure_variance = pressure_statistics.variance()
+        self.altitude_variance = altitude_statistics.variance()
         # Update stored values
         self.read()
-        print("Calibration successful.")
+        print("Calibration successful ({} samples, altitude datum standard error {:.3f} m)."
+              .format(altitude_statistics.n, altitude_statistics.standard_error()))
 
 
 ########################################################################
@@ -0,0 +1,156 @@
+########################################################################
+## Imports ##
+#############
+import numpy as np
+
+########################################################################
+## Running statistics ##
+########################
+class RunningStatistics:
+    # Online mean and variance using Welford's algorithm, so calibration
+    # data can be summarised as it streams in rather than stored. Works
+    # element-wise on arrays as well as on scalars.
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0  # Sum of squared differences from the mean
+
+    def update(self, value):
+        self.n += 1
+        delta = value - self.mean
+        self.mean = self.mean + delta/self.n
+        self.m2 = self.m2 + delta*(value - self.mean)
+
+    def variance(self):
+        # Unbiased sample variance
+        if self.n < 2:
+            return np.inf
+        return self.m2/(self.n - 1)
+
+    def standard_deviation(self):
+        return np.sqrt(self.variance())
+
+    def standard_error(self):
+        # Standard error of the mean
+        if self.n < 2:
+            return np.inf
+        return np.sqrt(self.variance()/self.n)
+
+
+########################################################################
+## Gyroscope bias calibration ##
+################################
+class GyroscopeCalibration:
+    # Table of per-axis gyroscope bias against die temperature. Each
+    # stationary batch adds (or refines) one row; the bias at any other
+    # temperature is linearly interpolated between rows, and held
+    # constant beyond the ends of the table.
+    def __init__(self, temperatures=(), biases=(), counts=()):
+        self.temperatures = np.asarray(temperatures, dtype=float)
+        self.biases = np.asarray(biases, dtype=float).reshape(-1, 3)
+        self.counts = np.asarray(counts, dtype=int)
+
+    def add_batch(self, temperature, samples):
+        # Add a batch of (N, 3) stationary samples taken at `temperature`.
+        # The temperature sensor has 1 degree resolution, so batches at the
+        # same (rounded) temperature are pooled into one row.
+        samples = np.asarray(samples, dtype=float)
+        temperature = float(np.round(temperature))
+        n = samples.shape[0]
+        bias = samples.mean(axis=0)
+
+        i = np.searchsorted(self.temperatures, temperature)
+        if i < self.temperatures.size and self.temperatures[i] == temperature:
+            total = self.counts[i] + n
+            self.biases[i] = (self.biases[i]*self.counts[i] + bias*n)/total
+            self.counts[i] = total
+        else:
+            self.temperatures = np.insert(self.temperatures, i, temperature)
+            self.biases = np.insert(self.biases, i, bias, axis=0)
+            self.counts = np.insert(self.counts, i, n)
+
+    def bias(self, temperature):
+        # Bias at `temperature`, which may be a scalar (giving a (3,)
+        # array) or an (N,) array (giving an (N, 3) array)
+        if self.temperatures.size == 0:
+            return np.zeros(np.shape(temperature) + (3,))
+        if self.temperatures.size == 1:
+            return np.broadcast_to(self.biases[0], np.shape(temperature) + (3,))
+        temperature = np.asarray(temperature, dtype=float)
+        i = np.clip(np.searchsorted(self.temperatures, temperature) - 1,
+                    0, self.temperatures.size - 2)
+        t0 = self.temperatures[i]
+        t1 = self.temperatures[i + 1]
+        weight = np.clip((temperature - t0)/(t1 - t0), 0, 1)[..., np.newaxis]
+        return self.biases[i] + weight*(self.biases[i + 1] - self.biases[i])
+
+    def correct(self, values, temperature):
+        # Remove the bias from (3,) or (N, 3) rates
+        return values - self.bias(temperature)
+
+    def save(self, filename):
+        np.savez(filename, temperatures=self.temperatures, biases=self.biases,
+                 counts=self.counts)
+
+    @classmethod
+    def load(cls, filename):
+        data = np.load(filename)
+        return cls(data['temperatures'], data['biases'], data['counts'])
+
+
+########################################################################
+## Magnetometer hard/soft-iron calibration ##
+#############################################
+def fit_ellipsoid(samples):
+    # Least squares fit of a general ellipsoid
+    #    a x^2 + b y^2 + c z^2 + 2d xy + 2e xz + 2f yz + 2g x + 2h y + 2i z = 1
+    # to (N, 3) samples. Returns the centre (the hard-iron offset) and a
+    # 3x3 matrix W that maps the ellipsoid onto a sphere (the soft-iron
+    # correction). W is scaled to preserve the mean radius, so corrected
+    # values keep their units.
+    samples = np.asarray(samples, dtype=float)
+    x = samples[:, 0]
+    y = samples[:, 1]
+    z = samples[:, 2]
+    design = np.column_stack((x*x, y*y, z*z, 2*x*y, 2*x*z, 2*y*z, 2*x, 2*y, 2*z))
+    v = np.linalg.lstsq(design, np.ones(samples.shape[0]), rcond=None)[0]
+
+    quadratic = np.array([[v[0], v[3], v[4]],
+                          [v[3], v[1], v[5]],
+                          [v[4], v[5], v[2]]])
+    linear = v[6:]
+    offset = -np.linalg.solve(quadratic, linear)
+
+    # Shifted to the centre, the ellipsoid is (x-o)^T M (x-o) = 1
+    M = quadratic/(1 + offset.dot(quadratic).dot(offset))
+    eigenvalues, eigenvectors = np.linalg.eigh(M)
+    if np.any(eigenvalues <= 0):
+        raise Exception("Samples do not lie on an ellipsoid; rotate the sensor through more orientations.")
+    # W = radius * M^(1/2), where radius is the geometric mean semi-axis
+    radius = np.prod(eigenvalues)**(-1/6)
+    W = radius*(eigenvectors*np.sqrt(eigenvalues)).dot(eigenvectors.T)
+    return offset, W
+
+
+class MagnetometerCalibration:
+    # Hard-iron offset and soft-iron correction matrix, applied as
+    #    corrected = W (raw - offset)
+    def __init__(self, offset=(0, 0, 0), matrix=np.eye(3)):
+        self.offset = np.asarray(offset, dtype=float)
+        self.matrix = np.asarray(matrix, dtype=float)
+
+    @classmethod
+    def fit(cls, samples):
+        return cls(*fit_ellipsoid(samples))
+
+    def correct(self, values):
+        # Correct (3,) or (N, 3) field values with one matrix multiply
+        return (values - self.offset).dot(self.matrix.T)
+
+    def save(self, filename):
+        np.savez(filename, offset=self.offset, matrix=self.matrix)
+
+    @classmethod
+    def load(cls, filename):
+        data = np.load(filename)
+        return cls(data['offset'], data['matrix'])
@@ -3,6 +3,8 @@ import struct
 import numpy as np
 import errno
 import time
+from accelerometer import LSM_ACC_SENS, LSM_MAG_SENS
+from gyroscope import LGD_SENS
 
 ########################################################################
 ## Data encoding ##
@@ -29,20 +31,146 @@ BAROMETER_ID = 4
 BAROMETER_UNFILTERED_ID = 5
 GPS_POS_ID = 6
 GPS_ALT_ID = 7
-DATA_SOURCE_BYTES = [ACCELEROMETER_ID, MAGNETOMETER_ID, GYROSCOPE_ID, BAROMETER_ID, BAROMETER_UNFILTERED_ID, GPS_POS_ID, GPS_ALT_ID]
+BAROMETER_VARIANCE_ID = 8  # Measured altitude noise variance, sent once after calibration
+ALTITUDE_ID = 9  # Fused altitude and climb rate
+DATA_SOURCE_BYTES = [ACCELEROMETER_ID, MAGNETOMETER_ID, GYROSCOPE_ID, BAROMETER_ID, BAROMETER_UNFILTERED_ID, GPS_POS_ID, GPS_ALT_ID,
+                     BAROMETER_VARIANCE_ID, ALTITUDE_ID]
+FRAME_ID = 10  # Not a data source: marks a frame of several records (see below)
 
 VALUE_SIZE = 4  # Number of bytes used to store a float
+MAX_PACKET_LENGTH = 255  # Largest length the length byte can hold
 
 READ_BUFFER_SIZE = 1024
+RECEIVE_BUFFER_SIZE = 65536  # Ring buffer that received data is parsed from
+DECODE_CHUNK_SIZE = 1 << 20  # Bytes of packets decode_buffer() works on at a time
 
+# Frame format
+# '!BBdB' then count records of '!BBff...'
+#
+# B: Packet length byte (of the whole frame)
+# B: FRAME_ID, in place of the data source byte
+# d: Timestamp shared by all the records (seconds, double)
+# B: Number of records
+# Each record:
+#    B: Data source byte
+#    B: Number of values
+#    f..: Data (floats)
+#
+# A frame carries everything read in one sensor tick, so it goes out in a
+# single send. Single-record packets are still sent and decoded as before;
+# the two are told apart by the second byte.
+#
+# The records cost the same as single-record packets, but each frame adds
+# its 11 byte header: for the sensor loop's usual mix (accelerometer,
+# magnetometer and gyroscope every tick, barometer every 4th, GPS every
+# 50th) that is about 57 bytes a tick against 46 as separate packets. The
+# extra bytes buy a sender timestamp in absolute time.time() seconds,
+# which single-record packets don't have, and one send per tick rather
+# than several. Where bandwidth matters more, use compact frames (below).
+FRAME_HEADER = struct.Struct('!BBdB')
+RECORD_HEADER_LENGTH = 2
+MAX_RECORDS_LENGTH = MAX_PACKET_LENGTH - FRAME_HEADER.size
+
+# Extended packet format
+# '!BBBBI' then the values
+#
+# B: 0 (EXTENDED_PACKET), in place of the length byte, which can't be 0
+#    in the formats above
+# B: Protocol version (PROTOCOL_VERSION)
+# B: Data source byte
+# B: Element type code (see DTYPE_CODES)
+# I: Packet length (32 bit)
+# ..: Data, big-endian elements of the given type
+#
+# For arrays too large for the length byte (over 63 floats), such as
+# sensor FIFO batches, calibration matrices or covariance blocks, and for
+# values that aren't 32 bit floats. encode() only uses it when it has to,
+# so small packets are still readable by older receivers.
+EXTENDED_PACKET = 0
+PROTOCOL_VERSION = 2
+EXTENDED_HEADER = struct.Struct('!BBBBI')
+MAX_EXTENDED_PACKET_LENGTH = 2**32 - 1
+DTYPE_CODES = {'f4': 1, 'f8': 2, 'i2': 3}
+WIRE_DTYPES = {1: np.dtype('>f4'), 2: np.dtype('>f8'), 3: np.dtype('>i2')}
+
+# Compact frame format
+# '!BBH' then records of 'B' and int16 counts (or floats)
+#
+# B: Packet length byte
+# B: COMPACT_FRAME_ID
+# H: Timestamp, in ms modulo 2^16 (it wraps every 65.536 s; receivers
+#    unwrap it, see StreamingSocket.read and decode_buffer)
+# Each record, up to the end of the packet:
+#    B: Descriptor, data source << 4 | scale id (see SCALES)
+#    h.. (or f.. for scale id 0): DATA_SOURCE_SIZES[data source] values
+#
+# Sensor values are sent as 16 bit counts, which is what the sensors
+# produce; multiplying by the scale (the sensor's sensitivity) gives the
+# physical value back. The record's size comes from its data source, so
+# a whole record header is one byte. For the sensor loop's usual mix (see
+# Frame format) a tick takes about 28 bytes: 49% of a frame, and 61% of
+# the same readings sent as single-record packets.
+#
+# Counts batch format
+# '!BBHHBBB' then the samples
+#
+# B: Packet length byte
+# B: COUNTS_BATCH_ID
+# H: Timestamp of the first sample, as for compact frames
+# H: Sample period, in units of 10 us (so at most 0.65535 s)
+# B: Descriptor, as for compact frames (the scale id can't be 0)
+# B: Number of samples
+# B: Delta width: 0 for plain int16 counts, 1 or 2 if every sample after
+#    the first is sent as its difference from the one before, as int8 or
+#    int16
+# h..: The first sample, then the rest as counts or differences
+#
+# For sensor FIFO batches, whose samples change little from one to the
+# next.
+COMPACT_FRAME_ID = 11
+COUNTS_BATCH_ID = 12
+COMPACT_FRAME_HEADER = struct.Struct('!BBH')
+COUNTS_BATCH_HEADER = struct.Struct('!BBHHBBB')
+COMPACT_TIME_PERIOD = 65.536  # s
+BATCH_PERIOD_UNIT = 1e-5  # s
+DATA_SOURCE_SIZES = {ACK_ID: 1, ACCELEROMETER_ID: 3, MAGNETOMETER_ID: 3, GYROSCOPE_ID: 3, BAROMETER_ID: 1,
+                     BAROMETER_UNFILTERED_ID: 1, GPS_POS_ID: 2, GPS_ALT_ID: 1, BAROMETER_VARIANCE_ID: 1,
+                     ALTITUDE_ID: 2}
+# Scale ids. 0 means the values are floats; the rest are the sensors'
+# sensitivities and a few decimal steps. The ids are never renumbered, or
+# old captures would decode wrongly. A scale id is 4 bits, so the table
+# is full: a new scale needs a new descriptor format.
+SCALES = ([None] + [LSM_ACC_SENS[scale] for scale in sorted(LSM_ACC_SENS)]
+          + [LSM_MAG_SENS[scale] for scale in sorted(LSM_MAG_SENS)]
+          + [LGD_SENS[scale] for scale in sorted(LGD_SENS)] + [1e-2, 1e-3, 1.0])
+if len(SCALES) > 16:
+    raise Exception("{} scales don't fit in a 4 bit scale id".format(len(SCALES)))
+_SCALE_VALUES = np.array([1.0] + SCALES[1:])
+_SOURCE_SIZES = np.array([DATA_SOURCE_SIZES.get(source, 0) for source in range(16)])
+
+# Compiled formats for every number of values a packet can hold, so that
+# decoding doesn't build and parse a format string for each one
+_VALUE_STRUCTS = [struct.Struct('!' + n*'f') for n in range(MAX_PACKET_LENGTH//VALUE_SIZE + 1)]
+# Likewise for each compact record descriptor: (data source, format, scale)
+_COMPACT_RECORDS = {source << 4 | scale: (source,
+                                          struct.Struct('!' + DATA_SOURCE_SIZES[source]*('h' if scale else 'f')),
+                                          SCALES[scale])
+                    for source in DATA_SOURCE_SIZES for scale in range(len(SCALES))}
+
+
+def _source_byte(data_source):
+    if data_source in DATA_SOURCE_BYTES or data_source == ACK_ID:
+        return data_source
+    raise Exception("Data source {} not recognised (must be one of {}, or ACK bit ({}))"
+                    .format(data_source, DATA_SOURCE_BYTES, ACK_ID))
 
-def encode(data_source, data):
+
+def encode(data_source, data, dtype=None):
+    # Single-record packet. If the data is too large for the length byte,
+    # or an element type ('f4', 'f8' or 'i2') is given, it is sent as an
+    # extended packet instead.
     # Set source byte
-    if data_source in DATA_SOURCE_BYTES or data_source == ACK_ID:
-        source_byte = data_source
-    else:
-        raise Exception("Data source {} not recognised (must be one of {}, or ACK bit ({}}))"
-                        .format(data_source, DATA_SOURCE_BYTES, ACK_ID))
+    source_byte = _source_byte(data_source)
 
     # If it's a scalar, size is 1
     if np.ndim(data) == 0:
@@ -53,6 +181,9 @@ def encode(data_source, data):
     else:
         raise Exception("Data type not recognised (must be scalar or ndarray)")
 
+    if dtype is not None or HEADER_LENGTH + size*VALUE_SIZE > MAX_PACKET_LENGTH:
+        return encode_extended(data_source, data, dtype or 'f4')
+
     # Create format string: '!BBfffff...'
     format_string = HEADER_FORMAT + size*'f'
 
@@ -74,6 +205,9 @@ def encode(data_source, data):
 
 def decode(packet):
     if packet:
+        if packet[PACKET_LENGTH_BYTE] == EXTENDED_PACKET:
+            return decode_extended(packet)
+
         # Extract header data
         packet_length = packet[PACKET_LENGTH_BYTE]
         data_source = packet[DATA_SOURCE_BYTE]
@@ -81,19 +215,575 @@ def decode(packet):
         number_of_values = (packet_length - HEADER_LENGTH)//VALUE_SIZE
 
         # Extract the data
-        format_string = '!' + 'f'*number_of_values
-        data = struct.unpack(format_string, packet[FIRST_DATA_BYTE:])
+        data = _VALUE_STRUCTS[number_of_values].unpack_from(packet, FIRST_DATA_BYTE)
 
         return packet_length, data_source, np.asarray(data)
 
 
+def encode_extended(data_source, data, dtype='f4'):
+    # Extended packet, with elements of type dtype ('f4', 'f8' or 'i2')
+    source_byte = _source_byte(data_source)
+    if dtype not in DTYPE_CODES:
+        raise Exception("Element type '{}' not recognised (must be one of {})"
+                        .format(dtype, list(DTYPE_CODES)))
+    code = DTYPE_CODES[dtype]
+    wire_dtype = WIRE_DTYPES[code]
+    if wire_dtype.kind == 'i':
+        # Casting would silently truncate and wrap, so the values must be
+        # whole numbers in range
+        data = np.asarray(data)
+        limits = np.iinfo(wire_dtype)
+        if data.dtype.kind not in 'iub' and not np.all(np.mod(data, 1) == 0):
+            raise Exception("Values sent as '{}' must be whole numbers".format(dtype))
+        if data.size and (data.min() < limits.min or data.max() > limits.max):
+            raise Exception("Values sent as '{}' must be from {} to {}".format(dtype, limits.min, limits.max))
+    values = np.asarray(data, dtype=wire_dtype)
+    packet_length = EXTENDED_HEADER.size + values.nbytes
+    if packet_length > MAX_EXTENDED_PACKET_LENGTH:
+        raise Exception("Too much data ({} bytes) for one packet".format(values.nbytes))
+    return EXTENDED_HEADER.pack(EXTENDED_PACKET, PROTOCOL_VERSION, source_byte, code,
+                                packet_length) + values.tobytes()
+
+
+def decode_extended(packet):
+    # Returns the packet length, data source and values, in native byte
+    # order but otherwise of the type they were sent as
+    _, version, data_source, code, packet_length = EXTENDED_HEADER.unpack_from(packet)
+    if packet_length < EXTENDED_HEADER.size:
+        raise Exception("Corrupt extended packet (length {})".format(packet_length))
+    if version != PROTOCOL_VERSION:
+        raise Exception("Unsupported protocol version {} (expected {})".format(version, PROTOCOL_VERSION))
+    if code not in WIRE_DTYPES:
+        raise Exception("Element type code {} not recognised".format(code))
+    dtype = WIRE_DTYPES[code]
+    values = np.frombuffer(packet, dtype=dtype, count=(packet_length - EXTENDED_HEADER.size)//dtype.itemsize,
+                           offset=EXTENDED_HEADER.size)
+    return packet_length, data_source, values.astype(dtype.newbyteorder('='))
+
+
+def encode_record(data_source, data):
+    # One record of a frame: source and value count bytes, then the values
+    source_byte = _source_byte(data_source)
+    if np.ndim(data) != 0 and not isinstance(data, np.ndarray):
+        raise Exception("Data type not recognised (must be scalar or ndarray)")
+    values = np.asarray(data, dtype='>f4')
+    if RECORD_HEADER_LENGTH + values.size*VALUE_SIZE > MAX_RECORDS_LENGTH:
+        raise Exception("Too many values ({}) for one record".format(values.size))
+    return bytes((source_byte, values.size)) + values.tobytes()
+
+
+def encode_frames(timestamp, records):
+    # Pack encoded records (from encode_record()) into frames stamped with
+    # `timestamp`. Normally they all fit in one; if not, they are split
+    # over as many as needed. Returns the frames joined together, ready to
+    # send at once.
+    frames = []
+    start = 0
+    while start < len(records):
+        length = 0
+        end = start
+        while end < len(records) and length + len(records[end]) <= MAX_RECORDS_LENGTH:
+            length += len(records[end])
+            end += 1
+        frames.append(FRAME_HEADER.pack(FRAME_HEADER.size + length, FRAME_ID, timestamp, end - start))
+        frames.extend(records[start:end])
+        start = end
+    return b''.join(frames)
+
+
+def encode_frame(timestamp, records):
+    # Frame(s) from a list of (data_source, data) pairs
+    return encode_frames(timestamp, [encode_record(data_source, data) for data_source, data in records])
+
+
+def decode_frame(packet):
+    # Returns the timestamp and a list of (data_source, values) records
+    _, _, timestamp, count = FRAME_HEADER.unpack_from(packet)
+    offset = FRAME_HEADER.size
+    records = []
+    for _ in range(count):
+        data_source = packet[offset]
+        size = packet[offset + 1]
+        offset += RECORD_HEADER_LENGTH
+        values = np.array(_VALUE_STRUCTS[size].unpack_from(packet, offset))
+        offset += size*VALUE_SIZE
+        records.append((data_source, values))
+    return timestamp, records
+
+
+def scale_id(scale):
+    # The id of a scale in SCALES (None for floats)
+    if scale not in SCALES:
+        raise Exception("Scale {} not recognised (must be one of {})".format(scale, SCALES))
+    return SCALES.index(scale)
+
+
+def to_counts(data, scale):
+    # Values as int16 multiples of `scale`, or None if any don't fit
+    counts = np.rint(np.asarray(data, dtype=float)/scale)
+    if not np.all(np.abs(counts) <= 32767):
+        return None
+    return counts.astype('>i2')
+
+
+def encode_compact_record(data_source, data, scale=None):
+    # One record of a compact frame. The values are sent as counts of
+    # `scale` (which must be in SCALES), or as floats if scale is None or
+    # they are out of range for it.
+    source_byte = _source_byte(data_source)
+    if np.size(data) != DATA_SOURCE_SIZES.get(source_byte):
+        raise Exception("Compact records from source {} must have {} values, not {}"
+                        .format(data_source, DATA_SOURCE_SIZES.get(source_byte), np.size(data)))
+    counts = None if scale is None else to_counts(data, scale)
+    if counts is None:
+        return bytes((source_byte << 4,)) + np.asarray(data, dtype='>f4').tobytes()
+    return bytes((source_byte << 4 | scale_id(scale),)) + counts.tobytes()
+
+
+def compact_timestamp(timestamp):
+    # Seconds to the wrapping ms count sent in compact packets
+    return int(round(timestamp*1000)) & 0xFFFF
+
+
+def encode_compact_frames(timestamp, records):
+    # As encode_frames(), for records from encode_compact_record()
+    frames = []
+    start = 0
+    while start < len(records):
+        length = COMPACT_FRAME_HEADER.size
+        end = start
+        while end < len(records) and length + len(records[end]) <= MAX_PACKET_LENGTH:
+            length += len(records[end])
+            end += 1
+        frames.append(COMPACT_FRAME_HEADER.pack(length, COMPACT_FRAME_ID, compact_timestamp(timestamp)))
+        frames.extend(records[start:end])
+        start = end
+    return b''.join(frames)
+
+
+def decode_compact_frame(packet):
+    # Returns the timestamp (modulo COMPACT_TIME_PERIOD) and a list of
+    # (data_source, values) records, in physical units
+    packet_length, _, milliseconds = COMPACT_FRAME_HEADER.unpack_from(packet)
+    offset = COMPACT_FRAME_HEADER.size
+    records = []
+    while offset < packet_length:
+        if packet[offset] not in _COMPACT_RECORDS:
+            raise Exception("Compact record descriptor {} not recognised".format(packet[offset]))
+        data_source, values_struct, scale = _COMPACT_RECORDS[packet[offset]]
+        values = values_struct.unpack_from(packet, offset + 1)
+        if scale is not None:
+            values = [value*scale for value in values]
+        records.append((data_source, np.array(values)))
+        offset += 1 + values_struct.size
+    return milliseconds/1000, records
+
+
+def encode_batch(data_source, samples, scale, timestamp, period, delta=True):
+    # Counts batch packet(s) for an (N, size) array of samples taken every
+    # `period` seconds from `timestamp`. With delta set, samples after the
+    # first are sent as differences, in one byte each if they all fit.
+    # Batches too long for one packet are split.
+    source_byte = _source_byte(data_source)
+    period_units = int(round(period/BATCH_PERIOD_UNIT))
+    if not 1 <= period_units <= 0xFFFF:
+        raise Exception("Batch sample period {:g} s out of range ({:g} to {:g} s)"
+                        .format(period, BATCH_PERIOD_UNIT, 0xFFFF*BATCH_PERIOD_UNIT))
+    samples = np.asarray(samples, dtype=float).reshape(len(samples), -1)
+    counts = to_counts(samples, scale)
+    if counts is None:
+        raise Exception("Samples out of range for scale {}".format(scale))
+    counts = counts.astype(np.int32)
+    size = counts.shape[1]
+    width = 0
+    differences = None
+    if delta and len(counts) > 1:
+        differences = np.diff(counts, axis=0)
+        largest = np.abs(differences).max()
+        width = 1 if largest <= 127 else 2 if largest <= 32767 else 0
+    rest_dtype = {0: '>i2', 1: 'i1', 2: '>i2'}[width]
+    rest_size = size*np.dtype(rest_dtype).itemsize
+    per_packet = 1 + (MAX_PACKET_LENGTH - COUNTS_BATCH_HEADER.size - 2*size)//rest_size
+    if per_packet < 1:
+        raise Exception("Samples of {} values are too large for a batch".format(size))
+    per_packet = min(per_packet, 255)
+
+    packets = []
+    for start in range(0, len(counts), per_packet):
+        end = min(start + per_packet, len(counts))
+        if width:
+            rest = differences[start:end - 1]
+        else:
+            rest = counts[start + 1:end]
+        body = counts[start].astype('>i2').tobytes() + rest.astype(rest_dtype).tobytes()
+        packets.append(COUNTS_BATCH_HEADER.pack(COUNTS_BATCH_HEADER.size + len(body), COUNTS_BATCH_ID,
+                                                compact_timestamp(timestamp + start*period),
+                                                period_units,
+                                                source_byte << 4 | scale_id(scale), end - start, width)
+                       + body)
+    return b''.join(packets)
+
+
+def decode_batch(packet):
+    # Returns the sample timestamps (modulo COMPACT_TIME_PERIOD, though
+    # they may run past it), the data source and the (N, size) samples,
+    # in physical units
+    _, _, milliseconds, period, descriptor, number, width = COUNTS_BATCH_HEADER.unpack_from(packet)
+    data_source = descriptor >> 4
+    size = DATA_SOURCE_SIZES[data_source]
+    counts = np.empty((number, size), dtype=np.int32)
+    offset = COUNTS_BATCH_HEADER.size
+    counts[0] = np.frombuffer(packet, dtype='>i2', count=size, offset=offset)
+    offset += 2*size
+    rest_dtype = {0: '>i2', 1: 'i1', 2: '>i2'}[width]
+    rest = np.frombuffer(packet, dtype=rest_dtype, count=(number - 1)*size, offset=offset).reshape(-1, size)
+    if width:
+        counts[1:] = counts[0] + np.cumsum(rest, axis=0, dtype=np.int32)
+    else:
+        counts[1:] = rest
+    timestamps = milliseconds/1000 + np.arange(number)*period*BATCH_PERIOD_UNIT
+    return timestamps, data_source, counts*_SCALE_VALUES[descriptor & 0x0F]
+
+
+def unwrap_timestamp(timestamp, previous):
+    # A compact timestamp (modulo COMPACT_TIME_PERIOD) as the time closest
+    # to `previous`, a full timestamp (None for the first)
+    if previous is None:
+        return timestamp
+    half = COMPACT_TIME_PERIOD/2
+    return previous + (timestamp - previous + half) % COMPACT_TIME_PERIOD - half
+
+
+def decode_records(packet):
+    # Every record in a packet of any kind, as (timestamp, data_source,
+    # values). Single-record packets have no timestamp, so it is None;
+    # those of compact frames and batches are modulo COMPACT_TIME_PERIOD.
+    if not packet:
+        return []
+    if packet[PACKET_LENGTH_BYTE] != EXTENDED_PACKET:
+        kind = packet[DATA_SOURCE_BYTE]
+        if kind == FRAME_ID:
+            timestamp, records = decode_frame(packet)
+            return [(timestamp, data_source, values) for data_source, values in records]
+        if kind == COMPACT_FRAME_ID:
+            timestamp, records = decode_compact_frame(packet)
+            return [(timestamp, data_source, values) for data_source, values in records]
+        if kind == COUNTS_BATCH_ID:
+            timestamps, data_source, samples = decode_batch(packet)
+            return [(timestamp, data_source, values) for timestamp, values in zip(timestamps.tolist(), samples)]
+    _, data_source, data = decode(packet)
+    return [(None, data_source, data)]
+
+
+########################################################################
+## Bulk decoding ##
+###################
+def decode_buffer(buffer):
+    # Decode a whole buffer of back-to-back packets (e.g. a capture of the
+    # stream) at once. Returns a dict mapping each data source to a
+    # structured array with a 'timestamp' field (NaN for single-record
+    # packets, which don't carry one) and a 'values' field, in the order
+    # they were received, along with the number of bytes decoded (any
+    # partial packet at the end is left for later). Values are big-endian,
+    # of the type they were sent as ('>f4' unless extended packets said
+    # otherwise); a source whose records differ in length or type, or were
+    # sent as counts, gets float64 values in physical units, padded with
+    # NaN. Compact timestamps are unwrapped, so they are only continuous if
+    # the buffer has no gaps of more than half COMPACT_TIME_PERIOD. They
+    # are then anchored to the absolute (time.time()) timestamps of the
+    # frames, if there are any: each run of compact records goes on the
+    # timebase of the latest frame before it (or the first frame, for
+    # records before any), so a capture mixing both encodings has a single
+    # timebase. Without any frames they start from the first one's value
+    # modulo COMPACT_TIME_PERIOD.
+    #
+    # Packets are length prefixed, so finding where each starts is a loop,
+    # but it only reads one byte per packet (five for extended packets).
+    # Everything else is done with array operations on the buffer, which
+    # isn't copied, DECODE_CHUNK_SIZE bytes of packets at a time (so the
+    # working arrays stay small next to the result): the headers and
+    # values of every packet in a chunk are gathered at once, and frames
+    # are walked one record index at a time across all of its frames
+    # together. The chunks' values are joined up at the end.
+    data = memoryview(buffer).cast('B')
+    raw = np.frombuffer(data, dtype=np.uint8)
+    end = len(data)
+    blocks = {}
+    # Compact timestamp state carried from chunk to chunk: the last one
+    # received and its unwrapped value, the number of frames so far and
+    # the last one's timestamp, the run of compact records being anchored
+    # (its frame and first unwrapped timestamp), and the timestamps still
+    # waiting for a first frame to anchor them
+    clock = {'last': None, 'unwrapped': None, 'frames': 0, 'anchor': np.nan,
+             'run': None, 'run_first': None, 'pending': []}
+    position = 0
+    while True:
+        starts = []
+        limit = min(position + DECODE_CHUNK_SIZE, end)
+        complete = True
+        while position < limit:
+            length = data[position]
+            if length < HEADER_LENGTH:
+                if length != EXTENDED_PACKET:
+                    raise Exception("Corrupt packet at byte {} (length {})".format(position, length))
+                if position + EXTENDED_HEADER.size > end:
+                    complete = False
+                    break
+                length = EXTENDED_HEADER.unpack_from(data, position)[4]
+                if length < EXTENDED_HEADER.size:
+                    raise Exception("Corrupt extended packet at byte {} (length {})".format(position, length))
+            starts.append(position)
+            position += length
+        if position > end:
+            # The last packet isn't all there yet
+            position = starts.pop()
+            complete = False
+        if starts:
+            _decode_chunk(raw, data, np.array(starts, dtype=np.int64), blocks, clock)
+        if not complete or position >= end:
+            break
+
+    arrays = {}
+    for data_source in sorted(blocks):
+        source_blocks = blocks.pop(data_source)
+        dtypes = {values.dtype for _, values in source_blocks}
+        widths = {values.shape[1] for _, values in source_blocks}
+        uniform = len(dtypes) == 1 and len(widths) == 1
+        dtype = dtypes.pop() if uniform else np.dtype('f8')
+        array = np.empty(sum(timestamps.size for timestamps, _ in source_blocks),
+                         dtype=[('timestamp', 'f8'), ('values', dtype, (max(widths),))])
+        if not uniform:
+            array['values'] = np.nan
+        row = 0
+        while source_blocks:
+            timestamps, values = source_blocks.pop(0)
+            array['timestamp'][row:row + timestamps.size] = timestamps
+            array['values'][row:row + timestamps.size, :values.shape[1]] = values
+            row += timestamps.size
+        arrays[data_source] = array
+    return arrays, position
+
+
+def _decode_chunk(raw, data, starts, blocks, clock):
+    # decode_buffer() for the packets starting at `starts`, appending a
+    # (timestamps, values) block for each data source to blocks
+    is_extended = raw[starts + PACKET_LENGTH_BYTE] == EXTENDED_PACKET
+    sources = raw[starts + DATA_SOURCE_BYTE]
+    is_frame = ~is_extended & (sources == FRAME_ID)
+    is_compact = ~is_extended & (sources == COMPACT_FRAME_ID)
+    is_batch = ~is_extended & (sources == COUNTS_BATCH_ID)
+    is_single = ~is_extended & ~is_frame & ~is_compact & ~is_batch
+    float_code = DTYPE_CODES['f4']
+
+    # Single-record packets
+    singles = starts[is_single]
+    record_sources = [sources[is_single]]
+    record_codes = [np.full(singles.size, float_code)]
+    record_sizes = [(raw[singles + PACKET_LENGTH_BYTE].astype(np.int64) - HEADER_LENGTH)//VALUE_SIZE]
+    record_offsets = [singles + FIRST_DATA_BYTE]
+    record_timestamps = [np.full(singles.size, np.nan)]
+    record_scales = [np.ones(singles.size)]
+    record_compact = [np.zeros(singles.size, dtype=bool)]
+
+    # Extended packets
+    extended = starts[is_extended]
+    codes = raw[extended + 3]
+    if np.any(raw[extended + 1] != PROTOCOL_VERSION) or not np.all(np.isin(codes, list(WIRE_DTYPES))):
+        raise Exception("Extended packet of an unsupported version or element type")
+    lengths = _gather(raw, extended + 4, 1, '>u4')[:, 0].astype(np.int64)
+    itemsizes = np.array([0] + [WIRE_DTYPES[code].itemsize for code in sorted(WIRE_DTYPES)])[codes]
+    record_sources.append(raw[extended + 2])
+    record_codes.append(codes)
+    record_sizes.append((lengths - EXTENDED_HEADER.size)//itemsizes)
+    record_offsets.append(extended + EXTENDED_HEADER.size)
+    record_timestamps.append(np.full(extended.size, np.nan))
+    record_scales.append(np.ones(extended.size))
+    record_compact.append(np.zeros(extended.size, dtype=bool))
+
+    # Frames, one record index at a time
+    frames = starts[is_frame]
+    timestamps = _gather(raw, frames + FIRST_DATA_BYTE, 1, '>f8')[:, 0]
+    counts = raw[frames + FRAME_HEADER.size - 1]
+    positions = frames + FRAME_HEADER.size
+    for index in range(counts.max() if counts.size else 0):
+        active = counts > index
+        record = positions[active]
+        sizes = raw[record + 1].astype(np.int64)
+        record_sources.append(raw[record])
+        record_codes.append(np.full(record.size, float_code))
+        record_sizes.append(sizes)
+        record_offsets.append(record + RECORD_HEADER_LENGTH)
+        record_timestamps.append(timestamps[active])
+        record_scales.append(np.ones(record.size))
+        record_compact.append(np.zeros(record.size, dtype=bool))
+        positions[active] = record + RECORD_HEADER_LENGTH + sizes*VALUE_SIZE
+
+    # Compact frames, likewise, until each frame's records run out
+    frames = starts[is_compact]
+    timestamps = _gather(raw, frames + FIRST_DATA_BYTE, 1, '>u2')[:, 0]/1000
+    ends = frames + raw[frames + PACKET_LENGTH_BYTE]
+    positions = frames + COMPACT_FRAME_HEADER.size
+    active = positions < ends
+    while np.any(active):
+        record = positions[active]
+        descriptors = raw[record]
+        scales = descriptors & 0x0F
+        sizes = _SOURCE_SIZES[descriptors >> 4]
+        if np.any(sizes == 0):
+            raise Exception("Compact record from an unknown data source")
+        record_sources.append(descriptors >> 4)
+        record_codes.append(np.where(scales, DTYPE_CODES['i2'], float_code))
+        record_sizes.append(sizes)
+        record_offsets.append(record + 1)
+        record_timestamps.append(timestamps[active])
+        record_scales.append(_SCALE_VALUES[scales])
+        record_compact.append(np.ones(record.size, dtype=bool))
+        positions[active] = record + 1 + sizes*np.where(scales, 2, VALUE_SIZE)
+        active = positions < ends
+
+    # Counts batches, a packet at a time, each decoded with array
+    # operations. Their samples get element type code 0, and their offset
+    # is the row in batch_values.
+    raw_groups = len(record_offsets)
+    batch_keys = []
+    batch_values = []
+    for start in starts[is_batch].tolist():
+        timestamps, data_source, samples = decode_batch(data[start:start + data[start]])
+        number = len(samples)
+        batch_keys.append(start + np.arange(number)/number)
+        record_sources.append(np.full(number, data_source))
+        record_codes.append(np.zeros(number, dtype=np.int64))
+        record_sizes.append(np.full(number, samples.shape[1]))
+        record_offsets.append(np.arange(len(batch_values), len(batch_values) + number))
+        record_timestamps.append(timestamps)
+        record_scales.append(np.ones(number))
+        record_compact.append(np.ones(number, dtype=bool))
+        batch_values.extend(samples)
+
+    # Put the records back in stream order (batch samples go at their
+    # packet's offset), then split them by source
+    order = np.argsort(np.concatenate(record_offsets[:raw_groups] + batch_keys), kind='stable')
+    record_offsets = np.concatenate(record_offsets)[order]
+    record_sources = np.concatenate(record_sources)[order]
+    record_codes = np.concatenate(record_codes)[order]
+    record_sizes = np.concatenate(record_sizes)[order]
+    record_timestamps = np.concatenate(record_timestamps)[order]
+    record_scales = np.concatenate(record_scales)[order]
+    record_compact = np.concatenate(record_compact)[order]
+
+    # Unwrap the compact timestamps, taking each step between them (and
+    # from the last one in the chunk before) as the shortest one modulo
+    # the period
+    pending = np.zeros(record_timestamps.size, dtype=bool)
+    compact_timestamps = record_timestamps[record_compact]
+    absolute = ~record_compact & ~np.isnan(record_timestamps)
+    if compact_timestamps.size:
+        half = COMPACT_TIME_PERIOD/2
+        first = compact_timestamps[0]
+        if clock['last'] is not None:
+            first = clock['unwrapped'] + (first - clock['last'] + half) % COMPACT_TIME_PERIOD - half
+        steps = (np.diff(compact_timestamps) + half) % COMPACT_TIME_PERIOD - half
+        unwrapped = first + np.concatenate(([0], np.cumsum(steps)))
+        clock['last'] = compact_timestamps[-1]
+        clock['unwrapped'] = unwrapped[-1]
+
+        # The frame each compact record is anchored to: the latest before
+        # it, counting frames from the start of the buffer, or the first
+        # for records before any. frame_times holds the last frame's
+        # timestamp from earlier chunks, then this chunk's, then NaN for
+        # the first frame if it hasn't arrived yet.
+        runs_frames = np.maximum(np.cumsum(absolute) - 1 + clock['frames'], 0)[record_compact]
+        frame_times = np.concatenate(([clock['anchor']], record_timestamps[absolute], [np.nan]))
+        runs = np.flatnonzero(np.concatenate(([True], runs_frames[1:] != runs_frames[:-1])))
+        run_frames = runs_frames[runs]
+        run_first = unwrapped[runs]
+        if run_frames[0] == clock['run']:
+            # Carrying on from the last chunk
+            run_first[0] = clock['run_first']
+        anchors = frame_times[np.minimum(run_frames - clock['frames'] + 1, frame_times.size - 1)]
+        # Each run is shifted by the whole number of periods that puts its
+        # first record nearest its frame's timestamp. Runs whose frame
+        # hasn't arrived yet are left as they are until it does.
+        shifts = COMPACT_TIME_PERIOD*np.round((anchors - run_first)/COMPACT_TIME_PERIOD)
+        run_lengths = np.diff(np.append(runs, unwrapped.size))
+        waiting = np.isnan(shifts)
+        if clock['pending'] and not waiting[0]:
+            for timestamps, rows in clock['pending']:
+                timestamps[rows] += shifts[0]
+            clock['pending'] = []
+        shifts[waiting] = 0
+        unwrapped += np.repeat(shifts, run_lengths)
+        record_timestamps[record_compact] = unwrapped
+        pending[record_compact] = np.repeat(waiting, run_lengths)
+        clock['run'] = run_frames[-1]
+        clock['run_first'] = run_first[-1]
+    if np.any(absolute):
+        clock['frames'] += np.count_nonzero(absolute)
+        clock['anchor'] = record_timestamps[absolute][-1]
+
+    for data_source in np.unique(record_sources).tolist():
+        selected = record_sources == data_source
+        offsets = record_offsets[selected]
+        codes = record_codes[selected]
+        sizes = record_sizes[selected]
+        scales = record_scales[selected]
+        size = int(sizes.max())
+        uniform = (np.all(sizes == size) and np.all(codes == codes[0]) and codes[0] != 0
+                   and np.all(scales == 1))
+        timestamps = record_timestamps[selected]
+        if uniform:
+            values = _gather(raw, offsets, size, WIRE_DTYPES[int(codes[0])])
+        else:
+            values = np.full((offsets.size, size), np.nan)
+            for code in np.unique(codes).tolist():
+                for record_size in np.unique(sizes[codes == code]).tolist():
+                    same = (codes == code) & (sizes == record_size)
+                    if code == 0:
+                        values[same, :record_size] = [batch_values[row] for row in offsets[same].tolist()]
+                    else:
+                        values[same, :record_size] = (_gather(raw, offsets[same], record_size, WIRE_DTYPES[code])
+                                                      * scales[same, np.newaxis])
+        rows = np.flatnonzero(pending[selected])
+        if rows.size:
+            clock['pending'].append((timestamps, rows))
+        blocks.setdefault(data_source, []).append((timestamps, values))
+
+
+def _gather(raw, offsets, count, dtype):
+    # `count` values of dtype from each offset into raw, as (N, count)
+    rows = raw[offsets[:, np.newaxis] + np.arange(count*np.dtype(dtype).itemsize)]
+    return rows.view(dtype)
+
+
+def decode_capture(filename):
+    # decode_buffer() for a file of captured packets
+    with open(filename, 'rb') as f:
+        return decode_buffer(f.read())[0]
+
+
 ########################################################################
 ## Streaming socket ##
 ######################
 class StreamingSocket:
     def __init__(self):
-        self.part_packet = b''
-        self.read_buffer = b''
+        # Received data goes straight into a preallocated buffer, with
+        # recv_into, and packets are decoded from memoryview slices of it.
+        # Bytes receive_start:receive_end haven't been parsed yet; a
+        # partial packet just waits there for the rest of it to arrive.
+        # Space is reclaimed by starting again at the front once everything
+        # has been parsed, or, when the end gets too close, by moving the
+        # (less than one packet of) unparsed bytes back to the front.
+        self.receive_buffer = bytearray(RECEIVE_BUFFER_SIZE)
+        self.receive_view = memoryview(self.receive_buffer)
+        self.receive_start = 0
+        self.receive_end = 0
+        self.receive_needed = 0  # Length of a partly received packet
+        self.queued_records = []
+        self.queued_packets = []
+        # Send compact frames (see queue()), and the last compact timestamp
+        # received, unwrapped (or the last frame timestamp, if later)
+        self.compact = False
+        self.compact_time = None
         self.create_socket()
 
     def create_socket(self):
@@ -105,10 +795,48 @@ class StreamingSocket:
         self.connection = self.socket
 
     def read(self):
+        # Returns every record received, from frames and single-record
+        # packets alike, as a list of (timestamp, data_source, values);
+        # see decode_records(). Compact timestamps are unwrapped, so they
+        # carry on increasing past COMPACT_TIME_PERIOD, from the last frame
+        # timestamp received if there was one, so that they share its
+        # timebase (as in decode_buffer()).
+        self.receive()
+        self.received_records = []
+        packet = self.read_packet_from_buffer()
+        while packet is not None:
+            records = decode_records(packet)
+            if packet[PACKET_LENGTH_BYTE] != EXTENDED_PACKET and packet[DATA_SOURCE_BYTE] in (COMPACT_FRAME_ID,
+                                                                                               COUNTS_BATCH_ID):
+                for k, (timestamp, data_source, values) in enumerate(records):
+                    self.compact_time = unwrap_timestamp(timestamp, self.compact_time)
+                    records[k] = (self.compact_time, data_source, values)
+            elif records and records[-1][0] is not None:
+                self.compact_time = records[-1][0]
+            self.received_records.extend(records)
+            packet = self.read_packet_from_buffer()
+        return self.received_records
+
+    def receive(self):
+        # Receive whatever has arrived into the receive buffer
+        if self.receive_start == self.receive_end:
+            self.receive_start = self.receive_end = 0
+        elif (len(self.receive_buffer) - self.receive_end < READ_BUFFER_SIZE
+              or self.receive_start + self.receive_needed > len(self.receive_buffer)):
+            remaining = self.receive_end - self.receive_start
+            if self.receive_needed + READ_BUFFER_SIZE > len(self.receive_buffer):
+                # An extended packet larger than the buffer: grow it
+                buffer = bytearray(self.receive_needed + READ_BUFFER_SIZE)
+                buffer[:remaining] = self.receive_view[self.receive_start:self.receive_end]
+                self.receive_buffer = buffer
+                self.receive_view = memoryview(buffer)
+            else:
+                self.receive_buffer[:remaining] = self.receive_view[self.receive_start:self.receive_end]
+            self.receive_start = 0
+            self.receive_end = remaining
         try:
-            self.buffer = self.connection.recv(READ_BUFFER_SIZE)
+            self.receive_end += self.connection.recv_into(self.receive_view[self.receive_end:])
         except socket.error as e:
-            self.buffer = b''
             # Connection reset error
             # TODO: I don't think this works
             if e.errno == errno.ECONNRESET or e.errno == errno.EPIPE:
@@ -118,44 +846,75 @@ class StreamingSocket:
             else:
                 raise
 
-        self.received_packets = []
-        while self.buffer:
-            self.received_packets.append(decode(self.read_packet_from_buffer()))
-        return self.received_packets
-
     def read_packet_from_buffer(self):
-        # If the buffer's empty, return empty
-        if not self.buffer:
-            return b''
-
-        # Append any existing part packet to the beginning of the buffer
-        if self.part_packet:
-            self.buffer = b''.join([self.part_packet, self.buffer])
-            # Clear the part_packet variable
-            self.part_packet = b''
+        # A view of the next whole packet in the receive buffer, or None if
+        # there isn't one yet. The view is only valid until the next
+        # receive().
+        start = self.receive_start
+        available = self.receive_end - start
+        if available < HEADER_LENGTH:
+            return None
 
         # Extract the length of the first packet from the buffer
-        packet_length = self.buffer[PACKET_LENGTH_BYTE]
-
-        # If the whole packet is in the buffer, extract it
-        if len(self.buffer) >= packet_length:
-            # Remove the packet from the buffer
-            packet = self.buffer[:packet_length]
-            self.buffer = self.buffer[packet_length:]
-            return packet
-
+        packet_length = self.receive_buffer[start + PACKET_LENGTH_BYTE]
+        if packet_length == EXTENDED_PACKET:
+            if available < EXTENDED_HEADER.size:
+                return None
+            packet_length = EXTENDED_HEADER.unpack_from(self.receive_buffer, start)[4]
+            if packet_length < EXTENDED_HEADER.size:
+                raise Exception("Corrupt extended packet (length {})".format(packet_length))
+        elif packet_length < HEADER_LENGTH:
+            raise Exception("Corrupt packet (length {})".format(packet_length))
+        if available < packet_length:
+            self.receive_needed = packet_length
+            return None
+        self.receive_needed = 0
+        self.receive_start = start + packet_length
+        return self.receive_view[start:self.receive_start]
+
+    def write(self, data_source, data, dtype=None):
+        # Send one packet now; see encode()
+        self.send(encode(data_source, data, dtype))
+
+    def queue(self, data_source, data, scale=None):
+        # Add a record to the next frame. Nothing is sent until flush().
+        # Data too large for a frame (e.g. a FIFO batch) is queued as an
+        # extended packet instead, and sent after the frame. If
+        # self.compact is set, frames are compact frames and the values are
+        # sent as counts of `scale` (the sensor's sensitivity, or another
+        # of SCALES), or as floats if it is None; see
+        # encode_compact_record(). Set compact before queueing anything.
+        if RECORD_HEADER_LENGTH + np.size(data)*VALUE_SIZE > MAX_RECORDS_LENGTH:
+            self.queued_packets.append(encode_extended(data_source, data))
+        elif self.compact:
+            self.queued_records.append(encode_compact_record(data_source, data, scale))
         else:
-            # Save the part packet for later
-            self.part_packet = self.buffer
-            # Empty the buffer
-            self.buffer = b''
-            # Return empty
-            return b''
-
-    def write(self, data_source, data):
+            self.queued_records.append(encode_record(data_source, data))
+
+    def queue_batch(self, data_source, samples, scale, timestamp, period, delta=True):
+        # Queue a batch of samples (e.g. a sensor FIFO) as counts batch
+        # packets, sent after the next frame; see encode_batch()
+        self.queued_packets.append(encode_batch(data_source, samples, scale, timestamp, period, delta))
+
+    def flush(self, timestamp=None):
+        # Send everything queued since the last flush as one frame, with a
+        # single send. The timestamp defaults to now.
+        if not self.queued_records and not self.queued_packets:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        if self.compact:
+            packet = encode_compact_frames(timestamp, self.queued_records)
+        else:
+            packet = encode_frames(timestamp, self.queued_records)
+        packet += b''.join(self.queued_packets)
+        self.queued_records = []
+        self.queued_packets = []
+        self.send(packet)
+
+    def send(self, packet):
         try:
-            packet = encode(data_source, data)
-            self.connection.send(packet)
+            self.connection.sendall(packet)
         except socket.error as e:
             # Connection reset error
             # TODO: I don't think this works
@@ -241,7 +1000,10 @@ if __name__ == '__main__':
             server.connect()
             a = 1
             while True:
-                print(server.write(ACCELEROMETER_ID, np.asarray(a)))
+                server.queue(ACCELEROMETER_ID, np.asarray([a, a, a]))
+                server.queue(GYROSCOPE_ID, np.asarray([a, a, a]))
+                server.queue(BAROMETER_UNFILTERED_ID, np.asarray(a))
+                server.flush()
                 a = (a+1) % 32768
                 print(server.read())
 
@@ -4,6 +4,7 @@ from gps3.agps3threaded import AGPS3mechanism as GPSSensor
 # For example, enable us to access the lat property using gps1.lat rather than
 # gps1.data_stream.lat
 GPSSensor.mode = property(lambda self: self.data_stream.mode) # 0 = none seen, 1 = no fix, 2 = 2D, 3= 3D
+GPSSensor.time = property(lambda self: self.data_stream.time) # Time of the fix (ISO 8601)
 
 GPSSensor.lat = property(lambda self: self.data_stream.lat) # Lat in degrees +/- = N/S
 GPSSensor.epy = property(lambda self: self.data_stream.epy) # Error in lat (m)
@@ -1,3 +1,11 @@
+########################################################################
+## Imports ##
+#############
+import numpy as np
+from time import monotonic, sleep
+from calibration import GyroscopeCalibration
+from i2c import read_block, read_xyz_samples, decode_int8, decode_int16
+
 ########################################################################
 ## L3GD20H register addresses ##
 ################################
@@ -32,7 +40,18 @@ LGD_OUT_Y_H = 0x2B
 LGD_OUT_Z_L = 0x2C
 LGD_OUT_Z_H = 0x2D
 
-# For further control registers (FIFO, interrupts, etc), see datasheet
+# FIFO registers
+LGD_FIFO_CTRL = 0x2E # FIFO mode and watermark
+LGD_FIFO_SRC = 0x2F # FIFO status
+
+# Low ODR register (selects between the low and high ODR ranges)
+LGD_LOW_ODR = 0x39
+
+# The temperature and status registers come directly before the output
+# registers, so all three can be read in one block
+LGD_OUTPUT_BLOCK_LENGTH = 8
+
+# For further control registers (interrupts, etc), see datasheet
 
 ########################################################################
 ## L3GD20H Commands ##
@@ -40,12 +59,47 @@ LGD_OUT_Z_H = 0x2D
 # ODR
 LGD_SET_ODR = {12.5:0b00001111, # 12.5Hz
                25 : 0b01001111, # 25Hz
-               50 : 0b10001111} # 50Hz
+               50 : 0b10001111, # 50Hz
+               100: 0b00001111, # 100Hz
+               200: 0b01001111, # 200Hz
+               400: 0b10001111, # 400Hz
+               800: 0b11001111} # 800Hz
+# The same CTRL_1 values give different rates depending on LOW_ODR
+LGD_SET_LOW_ODR = {12.5:0b00000001,
+                   25 : 0b00000001,
+                   50 : 0b00000001,
+                   100: 0b00000000,
+                   200: 0b00000000,
+                   400: 0b00000000,
+                   800: 0b00000000}
 # Scale
 LGD_SET_SCALE = {245: 0b00000000, #+/- 245dps
                  500: 0b00010000, #+/- 500dps
                  2000:0b00100000} #+/- 2000dps
 
+# Block data update: output registers are not updated until both the
+# high and low bytes of the previous sample have been read
+LGD_BDU = 0b10000000
+
+# Status
+LGD_STATUS_DATA_READY = 0b00001000 # STATUS: new x, y, z sample available
+LGD_STATUS_OVERRUN = 0b10000000 # STATUS: a sample was overwritten unread
+
+# FIFO
+LGD_FIFO_DEPTH = 32 # samples
+LGD_FIFO_ENABLE = 0b01000000 # CTRL_5
+LGD_FIFO_MODE_BYPASS = 0b00000000 # FIFO_CTRL
+LGD_FIFO_MODE_STREAM = 0b01000000 # FIFO_CTRL: keep newest samples
+LGD_FIFO_WATERMARK_MASK = 0b00011111 # FIFO_CTRL
+LGD_FIFO_SRC_OVERRUN = 0b01000000 # FIFO_SRC: FIFO is full
+LGD_FIFO_SRC_LEVEL_MASK = 0b00011111 # FIFO_SRC: number of unread samples
+
+# Calibration
+# Largest per-axis standard deviation (dps) of a batch that still counts
+# as stationary
+LGD_STATIONARY_MAX_STD = 0.5
+GYROSCOPE_CALIBRATION_FILE = 'gyroscope_calibration.npz'
+
 # Sensitivity
 # raw value * sensitivity = value
 LGD_SENS = {245: 8.75e-3, # dps/digit # for 245dps scale
@@ -57,37 +111,167 @@ LGD_SENS = {245: 8.75e-3, # dps/digit # for 245dps scale
 ## Gyroscope Class ##
 #####################
 class Gyroscope:
-	def __init__(self, bus, odr=50, scale=245):
+	def __init__(self, bus, odr=50, scale=245, clock=monotonic, sleep=sleep):
 		self.bus = bus
 		self.odr = odr
+		# Timestamps FIFO samples and waits for samples; can be replaced
+		# (e.g. with a simulated clock) for testing
+		self.clock = clock
+		self.sleep = sleep
 		self.scale = scale
 		self.sens = LGD_SENS[scale]
+		# Data-ready counters (see read_new)
+		self.duplicates_avoided = 0
+		self.overruns = 0
+		# Bias calibration (see calibrate)
+		self.calibration = None
+		self.temperature = 0
 
 		if self.bus.read_byte_data(LGD, LGD_WHOAMI_ADDRESS) != LGD_WHOAMI_CONTENTS:
 			raise Exception("LGD not found at address {}.".format(LGD))
 		else:
 			# Enable gyro axes and set ODR
+			self.bus.write_byte_data(LGD, LGD_LOW_ODR, LGD_SET_LOW_ODR[self.odr])
 			self.bus.write_byte_data(LGD, LGD_CTRL_1, LGD_SET_ODR[self.odr])
 			# Set scale
-			self.bus.write_byte_data(LGD, LGD_CTRL_4, LGD_SET_SCALE[self.scale])
+			self.bus.write_byte_data(LGD, LGD_CTRL_4, LGD_SET_SCALE[self.scale] | LGD_BDU)
 			print("Gyroscope set up.")
 
 	def read(self):
-		x_L = self.bus.read_byte_data(LGD, LGD_OUT_X_L)
-		x_H = self.bus.read_byte_data(LGD, LGD_OUT_X_H)
-		y_L = self.bus.read_byte_data(LGD, LGD_OUT_Y_L)
-		y_H = self.bus.read_byte_data(LGD, LGD_OUT_Y_H)
-		z_L = self.bus.read_byte_data(LGD, LGD_OUT_Z_L)
-		z_H = self.bus.read_byte_data(LGD, LGD_OUT_Z_H)
-		self.x = (x_H << 8 | x_L) * self.sens
-		self.y = (y_H << 8 | y_L) * self.sens
-		self.z = (z_H << 8 | z_L) * self.sens
+		# Read all three axes in one transaction
+		status, rates = self._read_output()
+		self.x, self.y, self.z = self._correct(rates)
+		return (self.x, self.y, self.z)
+
+	def read_temperature(self):
+		# Die temperature in degrees C, relative to an unknown offset (the
+		# sensor is only meant for tracking temperature changes)
+		self.temperature = -decode_int8(self.bus.read_byte_data(LGD, LGD_OUT_TEMP))
+		return self.temperature
+
+	def data_ready(self):
+		# True if a sample has arrived since the output registers were last read
+		return bool(self.bus.read_byte_data(LGD, LGD_STATUS) & LGD_STATUS_DATA_READY)
+
+	def overrun(self):
+		# True if a sample has been overwritten before it was read
+		return bool(self.bus.read_byte_data(LGD, LGD_STATUS) & LGD_STATUS_OVERRUN)
+
+	def read_new(self):
+		# Read the status and output registers in one transaction and return
+		# the sample only if it is new, otherwise return None
+		rates = self._read_new_uncorrected()
+		if rates is None:
+			return None
+		self.x, self.y, self.z = self._correct(rates)
 		return (self.x, self.y, self.z)
 
+	def _read_output(self):
+		# Read the temperature, status and output registers in one
+		# transaction. Returns the status and the uncorrected rates.
+		block = read_block(self.bus, LGD, LGD_OUT_TEMP, LGD_OUTPUT_BLOCK_LENGTH)
+		self.temperature = -decode_int8(block[0])
+		return block[1], decode_int16(block, offset=2) * self.sens
+
+	def _read_new_uncorrected(self):
+		status, rates = self._read_output()
+		if not status & LGD_STATUS_DATA_READY:
+			self.duplicates_avoided += 1
+			return None
+		if status & LGD_STATUS_OVERRUN:
+			self.overruns += 1
+		return rates
+
+	def _correct(self, rates):
+		# Remove the temperature-dependent bias, if calibrated
+		if self.calibration is None:
+			return rates
+		return self.calibration.correct(rates, self.temperature)
+
+	def calibrate(self, num_batches=10, batch_size=100, max_std=LGD_STATIONARY_MAX_STD,
+	              max_missed_polls=100):
+		# Estimate the bias from `num_batches` batches of stationary samples.
+		# Each batch adds a point to the bias-temperature table at the
+		# current die temperature, so calibrating while the sensor warms up
+		# (or calling this again later) fills in the temperature dependence.
+		# Batches where the sensor moved are discarded and repeated. Gives
+		# up after `max_missed_polls` polls in a row without a new sample.
+		if self.calibration is None:
+			self.calibration = GyroscopeCalibration()
+
+		print("Calibrating gyroscope...")
+		print("Keep the sensor still.")
+		samples = np.empty((batch_size, 3))
+		temperatures = np.empty(batch_size)
+		batch = 0
+		missed_polls = 0
+		while batch < num_batches:
+			n = 0
+			while n < batch_size:
+				rates = self._read_new_uncorrected()
+				if rates is None:
+					missed_polls += 1
+					if missed_polls > max_missed_polls:
+						raise Exception("No new gyroscope sample after {} polls.".format(max_missed_polls))
+					self.sleep(0.25/self.odr)
+					continue
+				missed_polls = 0
+				samples[n] = rates
+				temperatures[n] = self.temperature
+				n += 1
+			if np.any(samples.std(axis=0) > max_std):
+				print("Movement detected, repeating batch.")
+				continue
+			self.calibration.add_batch(temperatures.mean(), samples)
+			batch += 1
+		print("Calibration successful.")
+
+	def save_calibration(self, filename):
+		self.calibration.save(filename)
+
+	def load_calibration(self, filename):
+		self.calibration = GyroscopeCalibration.load(filename)
+
+	def enable_fifo(self, watermark=LGD_FIFO_DEPTH//2):
+		# Put the FIFO in stream mode, so that it always holds the most
+		# recent samples, with the watermark flag set at `watermark` samples
+		if not 0 <= watermark <= LGD_FIFO_WATERMARK_MASK:
+			raise ValueError("FIFO watermark must be 0 to {}, not {}".format(LGD_FIFO_WATERMARK_MASK, watermark))
+		self.bus.write_byte_data(LGD, LGD_FIFO_CTRL,
+		                         LGD_FIFO_MODE_STREAM | watermark)
+		self.bus.write_byte_data(LGD, LGD_CTRL_5, LGD_FIFO_ENABLE)
+
+	def disable_fifo(self):
+		self.bus.write_byte_data(LGD, LGD_CTRL_5, 0b00000000)
+		self.bus.write_byte_data(LGD, LGD_FIFO_CTRL, LGD_FIFO_MODE_BYPASS)
+
+	def fifo_level(self):
+		# Number of unread samples in the FIFO
+		fifo_src = self.bus.read_byte_data(LGD, LGD_FIFO_SRC)
+		if fifo_src & LGD_FIFO_SRC_OVERRUN:
+			return LGD_FIFO_DEPTH
+		return fifo_src & LGD_FIFO_SRC_LEVEL_MASK
+
+	def read_fifo(self, num_samples=None):
+		# Drain the FIFO (or `num_samples` from it) in as few transactions
+		# as possible. Returns an (N,) array of timestamps and an (N, 3)
+		# array of rates. The newest sample is stamped with the time of the
+		# read and the others are spaced back from it at the ODR.
+		if num_samples is None:
+			num_samples = self.fifo_level()
+		counts = read_xyz_samples(self.bus, LGD, LGD_OUT_X_L, num_samples)
+		read_time = self.clock()
+		timestamps = read_time - np.arange(num_samples - 1, -1, -1) / self.odr
+		if self.calibration is not None:
+			# The temperature changes slowly, so one reading covers the batch
+			self.read_temperature()
+		return timestamps, self._correct(counts * self.sens)
+
 ########################################################################
 ## Main ##
 ##########
 if __name__ == "__main__":
+	import os
 	from smbus import SMBus
 	from time import sleep
 
@@ -98,6 +282,13 @@ if __name__ == "__main__":
 	# Initialise the gyroscope
 	gyroscope1 = Gyroscope(bus)
 
+	# Load the bias calibration, or calibrate if there isn't one
+	if os.path.exists(GYROSCOPE_CALIBRATION_FILE):
+		gyroscope1.load_calibration(GYROSCOPE_CALIBRATION_FILE)
+	else:
+		gyroscope1.calibrate()
+		gyroscope1.save_calibration(GYROSCOPE_CALIBRATION_FILE)
+
 	try:
 		while True:
 			print(gyroscope1.read())
@@ -0,0 +1,158 @@
+########################################################################
+## Imports ##
+#############
+import numpy as np
+
+########################################################################
+## Register block access ##
+###########################
+# The LSM303D, L3GD20H and LPS331AP all step the register address on
+# after every byte if the MSB of the register sub-address is set. This
+# means a whole output block can be read in a single i2c transaction,
+# which is much faster than reading it one byte at a time and means all
+# of the bytes come from the same conversion.
+AUTO_INCREMENT = 0x80
+
+# SMBus block transfers are limited to 32 bytes
+MAX_BLOCK_LENGTH = 32
+
+# Output blocks of three little-endian 16 bit values (x, y, z)
+XYZ_BLOCK_LENGTH = 6
+
+# A status register directly followed by an x, y, z output block
+STATUS_XYZ_BLOCK_LENGTH = 7
+
+
+def read_block(bus, address, register, length):
+    # Read `length` consecutive registers starting at `register` in one
+    # transaction
+    if length > MAX_BLOCK_LENGTH:
+        raise Exception("Cannot read {} bytes in one transaction (maximum is {})."
+                        .format(length, MAX_BLOCK_LENGTH))
+    return bytes(bus.read_i2c_block_data(address, register | AUTO_INCREMENT, length))
+
+
+def read_xyz(bus, address, register):
+    # Read an x, y, z output block and return the raw counts as an array
+    return decode_int16(read_block(bus, address, register, XYZ_BLOCK_LENGTH))
+
+
+def read_status_xyz(bus, address, status_register):
+    # Read a status register and the x, y, z output block that follows it
+    # in one transaction, so that the status describes the returned data.
+    # Returns (status, counts).
+    block = read_block(bus, address, status_register, STATUS_XYZ_BLOCK_LENGTH)
+    return block[0], decode_int16(block, offset=1)
+
+
+def read_xyz_samples(bus, address, register, num_samples):
+    # Drain `num_samples` x, y, z samples from a FIFO. While the FIFO is
+    # enabled the register address rolls back to the start of the output
+    # block after the z axis, so every transaction can carry as many whole
+    # samples as fit in a block transfer. Returns an (N, 3) array of counts.
+    samples_per_block = MAX_BLOCK_LENGTH // XYZ_BLOCK_LENGTH
+    blocks = []
+    remaining = num_samples
+    while remaining > 0:
+        block_samples = min(remaining, samples_per_block)
+        blocks.append(read_block(bus, address, register,
+                                 block_samples*XYZ_BLOCK_LENGTH))
+        remaining -= block_samples
+    return decode_int16(b''.join(blocks)).reshape(num_samples, 3)
+
+
+########################################################################
+## Decoding ##
+##############
+# All of the output registers are little-endian two's complement
+INT16_DTYPE = np.dtype('<i2')
+INT32_DTYPE = np.dtype('<i4')
+
+
+def decode_int8(value):
+    # Decode a single 8 bit register value
+    return value - 256 if value & 0x80 else value
+
+
+def decode_int16(raw, offset=0):
+    # Decode a buffer of 16 bit values in one go. Returns an int16 array,
+    # which can be scaled to physical units with a single multiply.
+    return np.frombuffer(raw, dtype=INT16_DTYPE, offset=offset)
+
+
+def decode_int24(raw, offset=0):
+    # Decode a buffer of 24 bit values (e.g. barometer pressure). Each
+    # value is sign extended into a fourth byte so the whole buffer can be
+    # reinterpreted as int32.
+    data = np.frombuffer(raw, dtype=np.uint8, offset=offset).reshape(-1, 3)
+    padded = np.empty((data.shape[0], 4), dtype=np.uint8)
+    padded[:, :3] = data
+    padded[:, 3] = np.where(data[:, 2] & 0x80, 0xFF, 0x00)
+    return padded.view(INT32_DTYPE).ravel()
+
+
+########################################################################
+## Transaction counter ##
+#########################
+class CountingBus:
+    # Wraps an SMBus-like object and counts the i2c transactions that go
+    # through it, so that the bus cost of a driver can be measured
+    def __init__(self, bus):
+        self.bus = bus
+        self.reset()
+
+    def reset(self):
+        self.transactions = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def read_byte_data(self, address, register):
+        self.transactions += 1
+        self.bytes_read += 1
+        return self.bus.read_byte_data(address, register)
+
+    def write_byte_data(self, address, register, value):
+        self.transactions += 1
+        self.bytes_written += 1
+        return self.bus.write_byte_data(address, register, value)
+
+    def read_i2c_block_data(self, address, register, length):
+        self.transactions += 1
+        self.bytes_read += length
+        return self.bus.read_i2c_block_data(address, register, length)
+
+    def write_i2c_block_data(self, address, register, data):
+        self.transactions += 1
+        self.bytes_written += len(data)
+        return self.bus.write_i2c_block_data(address, register, data)
+
+    def __getattr__(self, name):
+        # Pass anything else (close, etc) straight through to the bus
+        return getattr(self.bus, name)
+
+
+########################################################################
+## Main ##
+##########
+if __name__ == "__main__":
+    from smbus import SMBus
+    from gyroscope import Gyroscope
+    from accelerometer import Accelerometer
+    from barometer import Barometer
+
+    # Initialise the i2c bus
+    I2CBUS_NUMBER = 1
+    bus = CountingBus(SMBus(I2CBUS_NUMBER))
+
+    gyroscope1 = Gyroscope(bus)
+    accelerometer1 = Accelerometer(bus)
+    barometer1 = Barometer(bus)
+
+    # Count the transactions needed for one read of every sensor
+    bus.reset()
+    gyroscope1.read()
+    accelerometer1.read_acc()
+    accelerometer1.read_mag()
+    barometer1.read()
+    print("Transactions per tick: {}".format(bus.transactions))
+    print("Bytes read per tick: {}".format(bus.bytes_read))
@@ -1,11 +1,20 @@
+from time import perf_counter
 import numpy as np
+try:
+    from scipy.signal import lfilter
+    from scipy.linalg.lapack import dpotrf, dpotrs, dtrtrs
+except ImportError:
+    lfilter = None
+    dpotrf = dpotrs = dtrtrs = None
 
 
 class KalmanFilter:
     # For an explanation of this algorithm, see Welch & Bishop, 'An
     # Introduction to the Kalman Filter', University of North Carolina,
     # Jul 2006
-    def __init__(self, x_prior, P_prior, A, B, H, Q, R):
+    def __init__(self, x_prior, P_prior, A, B, H, Q, R, steady_state=False,
+                 steady_state_tolerance=1e-12, joseph=False, sequential=False, gate=None,
+                 max_rejections=10, recovery_passes=3):
         # State equation:
         # x_next = Ax + Bu + w
         # where:
@@ -31,46 +40,1088 @@ class KalmanFilter:
         self.Q = np.asarray(Q)
         self.R = np.asarray(R)
 
-    def update(self, u_input, z_measurement):
+        # For time-invariant systems the gain converges to a constant, after
+        # which only the state needs updating. steady_state can be:
+        #    False: always run the full filter
+        #    True: solve for the steady-state gain now and use it throughout
+        #    'auto': run the full filter until the gain stops changing (to
+        #            within steady_state_tolerance), then fix it
+        self.steady_state = steady_state
+        self.steady_state_tolerance = steady_state_tolerance
+
+        # The covariance update P = (I - KH) P_prior is cheap but can lose
+        # symmetry and positive definiteness to rounding. The Joseph form
+        #    P = (I - KH) P_prior (I - KH)^T + K R K^T
+        # costs two more matrix products and is stable for any gain.
+        self.joseph = joseph
+
+        # With a diagonal R the measurement elements are independent and can
+        # be incorporated one at a time as scalars. In sequential mode, NaN
+        # elements of a measurement are treated as missing and skipped, so
+        # partial measurements (e.g. a GPS fix without altitude) can be
+        # passed straight in, and each element is gated on its own (see
+        # below). This is for partial measurements and per-channel gating,
+        # not speed: complete measurements that pass the gate take the
+        # joint update (which gives the same result), and only the others
+        # are done element by element, which is slower. The gain is
+        # different for every combination of missing elements, so this
+        # can't be combined with a steady-state gain.
+        self.sequential = sequential
+        if sequential and steady_state:
+            raise Exception("Sequential updates cannot be used with a steady-state gain")
+
+        # Innovation gate. A measurement whose normalised innovation squared
+        #    NIS = (z - H x_prior)^T S^-1 (z - H x_prior)
+        # is above `gate` is rejected as an outlier and the step keeps just
+        # the prediction. For a consistent filter the NIS is chi-square
+        # distributed with m degrees of freedom, so chi_square_gate() gives
+        # a threshold for a chosen false rejection rate. In sequential mode
+        # each element is gated on its own (one degree of freedom), so only
+        # the bad elements are dropped. None turns gating off.
+        #
+        # After max_rejections steps in a row with rejections the estimate
+        # is taken to be what's wrong (the filter may have started from a
+        # bad value, or missed a real step, and with a steady-state gain it
+        # would never widen its gate to catch up), so the filter re-seeds
+        # from the next measurement that fails the gate: the prior
+        # covariance is widened along the measured directions by the
+        # innovation, so the measurement is taken almost as it is (with a
+        # fixed gain the state is moved on to the measurement instead).
+        # Measurements are then accepted ungated, re-seeding again from any
+        # that fail, until recovery_passes in a row have passed the gate.
+        # None never stops gating.
+        self.gate = gate
+        self.max_rejections = max_rejections
+        self.recovery_passes = recovery_passes
+        self._rejections = 0
+        self._recovering = 0  # Passes still needed before gating again
+
+        # Running statistics of update(), see FilterHealth
+        self.health = FilterHealth()
+
+        # Buffers for update(), allocated on the first step
+        self._workspace = None
+        self.K_steady = None
+        self.P_steady = None
+        if steady_state is True:
+            self.solve_steady_state()
+
+    def update(self, u_input, z_measurement, in_place=False):
+        # One predict/correct step. Returns copies of the new state and
+        # covariance, so results can be kept from step to step. With
+        # in_place set the step allocates nothing: it returns the filter's
+        # own x and P, which the next step overwrites.
+        self._step(u_input, z_measurement)
+        if in_place:
+            return self.x, self.P
+        return self.x.copy(), self.P.copy()
+
+    def _step(self, u_input, z_measurement):
+        # The step itself. All of the arithmetic writes into preallocated
+        # buffers, and self.x and self.P are updated in place.
+        start = perf_counter()
         self.u = np.asarray(u_input)
         self.z = np.asarray(z_measurement)
+        work = self._workspace
+        if work is None or work.x_owner is not self.x or work.P_owner is not self.P or work.m != self.z.size:
+            work = self._allocate(self.z.size)
+        z = self.z.reshape(work.m)
+        ungated = self._recovering > 0 or (self.max_rejections is not None
+                                           and self._rejections >= self.max_rejections)
+
+        if self.sequential:
+            work.predict(work.x, work.P, work.input_term(self.u))
+            nis, degrees_of_freedom, outliers = work.correct_sequential(z, work.x, work.P, self.joseph,
+                                                                        self.gate, ungated)
+            self._count_rejections(outliers > 0, ungated)
+            self.health.record(nis, degrees_of_freedom, 0 if ungated else outliers,
+                               perf_counter() - start)
+            return
+
+        steady = self.K_steady is not None
+        if steady:
+            # Fixed gain: only the state needs updating
+            work.predict_state(work.x, work.input_term(self.u))
+        else:
+            work.predict(work.x, work.P, work.input_term(self.u))
+            work.innovation_covariance()
+            work.gain()
+        work.innovate(z)
+        nis = work.normalised_innovation_squared()
+        outlier = self.gate is not None and nis > self.gate
+        self._count_rejections(outlier, ungated)
+        if outlier and not ungated:
+            # Keep the prediction
+            work.x[...] = work.x_prior
+            if not steady:
+                work.P[...] = work.P_prior
+            self.health.record(nis, 0, 1, perf_counter() - start)
+            return
+        if outlier:
+            # Re-seed from this measurement. The NIS recorded is the one
+            # after re-seeding, so one outlier doesn't swamp the statistics.
+            work.reseed(steady)
+            if steady:
+                work.innovate(z)
+            else:
+                work.innovation_covariance()
+                work.gain()
+            nis = work.normalised_innovation_squared()
+
+        if steady:
+            work.correct_state(work.K_steady, work.x)
+        else:
+            work.correct_state(work.K, work.x)
+            work.correct_covariance(work.P, self.joseph)
+            if self.steady_state == 'auto':
+                if work.gain_converged(self.steady_state_tolerance):
+                    self._fix_gain()
+        self.health.record(nis, work.m, 0, perf_counter() - start)
+
+    def _count_rejections(self, outlier, ungated):
+        # Track consecutive rejections, and recovery after re-seeding
+        if not outlier:
+            self._rejections = 0
+            if self._recovering:
+                self._recovering -= 1
+        elif ungated:
+            self._rejections = 0
+            self._recovering = self.recovery_passes
+        else:
+            self._rejections += 1
+
+    def _allocate(self, m):
+        # Take private float copies of the state and covariance (they may
+        # be views into arrays returned by filter()) and set up the work
+        # buffers for an m-element measurement
+        self.x = np.array(self.x, dtype=float)
+        self.P = np.array(self.P, dtype=float)
+        work = _Workspace(self, m)
+        self.x_prior = work.x_prior.reshape(self.x.shape)
+        self.P_prior = work.P_prior.reshape(self.P.shape)
+        self.K = work.K.reshape(self._gain_shape())
+        self._workspace = work
+        return work
+
+    def filter(self, zs, us=None):
+        # Run the filter over a whole array of measurements in one call.
+        # zs is (N, m) (or (N,) if m = 1) and us is (N, p) (or (N,), or
+        # None for no input). Returns (N, n) states and (N, n, n)
+        # covariances, and leaves the filter in its final state so that
+        # update() can carry on from there.
+        #
+        # Whether each measurement is rejected depends on the ones before,
+        # so with a gate set every step goes through _step(), as update()
+        # does (and is counted in self.health), rather than the batch
+        # recursions.
+        zs = np.asarray(zs, dtype=float)
+        N = zs.shape[0]
+        zs = zs.reshape(N, -1)
+        if us is not None:
+            us = np.asarray(us, dtype=float).reshape(N, -1)
+        n = self.x.size
+
+        xs = np.empty((N, n))
+        Ps = np.empty((N, n, n))
+        if self.gate is not None:
+            no_input = np.zeros(max(self.B.size//n, 1))
+            for k in range(N):
+                self._step(no_input if us is None else us[k], zs[k])
+                xs[k] = self.x.reshape(n)
+                Ps[k] = self.P.reshape(n, n)
+            return xs, Ps
+        # Run the full filter until the gain is fixed (if it ever is),
+        # then switch to the cheaper steady-state recursion
+        k = 0
+        if self.K_steady is None:
+            if self._is_scalar() and not self.sequential:
+                k = self._filter_scalar(zs[:, 0], us, xs[:, 0], Ps[:, 0, 0])
+            else:
+                k = self._filter_general(zs, us, xs, Ps)
+        if k < N:
+            self._filter_steady(zs[k:], None if us is None else us[k:], xs[k:], Ps[k:])
+        return xs, Ps
+
+    def _is_scalar(self):
+        return all(np.size(a) == 1 for a in (self.x, self.P, self.A, self.B, self.H, self.Q, self.R))
+
+    def _matrices(self, m):
+        # The model as 2D arrays, for a measurement of size m
+        n = self.x.size
+        return (self.A.reshape(n, n), self.H.reshape(m, n),
+                self.Q.reshape(n, n), self.R.reshape(m, m))
+
+    def _input_term(self, us):
+        # Bu for every step, or None if there's no input
+        if us is None:
+            return None
+        return us.dot(self.B.reshape(self.x.size, us.shape[1]).T)
+
+    def _filter_general(self, zs, us, xs, Ps):
+        # Full filter, writing into xs and Ps. Returns the number of steps
+        # run, which is less than N if the gain converged part way.
+        N, m = zs.shape
+        Bu = self._input_term(us)
+        auto = self.steady_state == 'auto'
+        work = _Workspace(self, m)
+
+        k = 0
+        x = work.x.astype(float)
+        P = work.P.astype(float)
+        while k < N:
+            work.predict(x, P, None if Bu is None else Bu[k])
+            x = xs[k]
+            P = Ps[k]
+            if self.sequential:
+                work.correct_sequential(zs[k], x, P, self.joseph)
+            else:
+                work.innovation_covariance()
+                work.gain()
+                work.innovate(zs[k])
+                work.correct_state(work.K, x)
+                work.correct_covariance(P, self.joseph)
+            k += 1
+            if auto and work.gain_converged(self.steady_state_tolerance):
+                break
+
+        if k:
+            self.x_prior = work.x_prior.reshape(self.x.shape)
+            self.P_prior = work.P_prior.reshape(self.P.shape)
+            self.K = work.K.reshape(self._gain_shape())
+            self.x = x.reshape(self.x.shape)
+            self.P = P.reshape(self.P.shape)
+            if auto and k < N:
+                self._fix_gain()
+        return k
+
+    def _filter_scalar(self, zs, us, xs, Ps):
+        # Fast path for one-state, one-measurement filters: plain float
+        # arithmetic is much quicker than NumPy on single values
+        A = self.A.item()
+        H = self.H.item()
+        Q = self.Q.item()
+        R = self.R.item()
+        x = self.x.item()
+        P = self.P.item()
+        N = zs.size
+        Bu = [0.0]*N if us is None else self._input_term(us)[:, 0].tolist()
+        auto = self.steady_state == 'auto'
+        tolerance = self.steady_state_tolerance
+
+        x_list = [0.0]*N
+        P_list = [0.0]*N
+        K = np.inf
+        k = 0
+        for z in zs.tolist():
+            K_previous = K
+            x_prior = A*x + Bu[k]
+            P_prior = A*P*A + Q
+            K = P_prior*H/(H*P_prior*H + R)
+            x = x_prior + K*(z - H*x_prior)
+            P = (1 - K*H)*P_prior
+            x_list[k] = x
+            P_list[k] = P
+            k += 1
+            if auto and abs(K - K_previous) <= tolerance:
+                break
+
+        if k:
+            xs[:k] = x_list[:k]
+            Ps[:k] = P_list[:k]
+            self.x_prior = np.asarray(x_prior)
+            self.P_prior = np.asarray(P_prior)
+            self.K = np.asarray(K)
+            self.x = np.asarray(x)
+            self.P = np.asarray(P)
+            if auto and k < N:
+                self._fix_gain()
+        return k
+
+    def _filter_steady(self, zs, us, xs, Ps):
+        # With a fixed gain the filter is a linear recursion
+        #    x_k = F x_{k-1} + G_k
+        # where F = (I - KH)A and G_k = (I - KH)Bu_k + K z_k. Everything
+        # except the recursion itself is computed for all steps at once.
+        N, m = zs.shape
+        n = self.x.size
+        A, H, Q, R = self._matrices(m)
+        K = self.K_steady.reshape(n, m)
+        I_KH = np.eye(n) - K.dot(H)
+        F = I_KH.dot(A)
+        G = zs.dot(K.T)
+        Bu = self._input_term(us)
+        if Bu is not None:
+            G += Bu.dot(I_KH.T)
+
+        x_initial = self.x.reshape(n).astype(float)
+        if n == 1 and lfilter is not None:
+            # First order IIR filter
+            xs[:, 0] = lfilter([1.0], [1.0, -F[0, 0]], G[:, 0], zi=F.dot(x_initial))[0]
+        else:
+            x = x_initial
+            for k in range(N):
+                np.dot(F, x, out=xs[k])
+                xs[k] += G[k]
+                x = xs[k]
+        Ps[...] = self.P_steady.reshape(n, n)
+
+        if N:
+            x_prior = A.dot(xs[-2] if N > 1 else x_initial)
+            if Bu is not None:
+                x_prior += Bu[-1]
+            self.x_prior = x_prior.reshape(self.x.shape)
+            self.x = xs[-1].reshape(self.x.shape)
+
+    ## Smoothing ##
+    def smooth(self, xs, Ps, us=None, chunk_size=None, in_place=False):
+        # Fixed-interval Rauch-Tung-Striebel smoother. Takes the (N, n)
+        # states and (N, n, n) covariances from a forward run of filter()
+        # (and the same inputs, if any) and runs backwards over them:
+        #    C_k = P_k A^T P_prior_{k+1}^-1
+        #    xs_k = x_k + C_k (xs_{k+1} - x_prior_{k+1})
+        #    Ps_k = P_k + C_k (Ps_{k+1} - P_prior_{k+1}) C_k^T
+        # Everything except the recursion itself is computed for a chunk
+        # of steps at once. By default the whole log is one chunk; set
+        # chunk_size to bound the working memory for very long logs, and
+        # in_place to write the smoothed values over xs and Ps (which can
+        # then be np.memmap arrays). Returns the smoothed states and
+        # covariances.
+        N, n = xs.shape
+        A = self.A.reshape(n, n).astype(float)
+        Q = self.Q.reshape(n, n).astype(float)
+        Bu = None
+        if us is not None:
+            Bu = self._input_term(np.asarray(us, dtype=float).reshape(N, -1))
+        if in_place:
+            xs_smooth, Ps_smooth = xs, Ps
+        else:
+            xs_smooth = np.empty((N, n))
+            Ps_smooth = np.empty((N, n, n))
+            xs_smooth[-1] = xs[-1]
+            Ps_smooth[-1] = Ps[-1]
+
+        # Work back from the end a chunk at a time. Each chunk only needs
+        # the filtered values for its own steps and the smoothed values for
+        # the step after it.
+        chunk_size = chunk_size or N
+        end = N - 1
+        while end > 0:
+            start = max(end - chunk_size, 0)
+            self._smooth_chunk(A, Q, None if Bu is None else Bu[start + 1:end + 1],
+                               np.asarray(xs[start:end], dtype=float),
+                               np.asarray(Ps[start:end], dtype=float),
+                               xs_smooth[start:end + 1], Ps_smooth[start:end + 1])
+            end = start
+        return xs_smooth, Ps_smooth
+
+    def _smooth_chunk(self, A, Q, Bu, x, P, xs_smooth, Ps_smooth):
+        # Smooth L steps, given their filtered x and P, writing into the
+        # first L rows of xs_smooth and Ps_smooth. Row L holds the smoothed
+        # values for the step after the chunk.
+        L, n = x.shape
+        x_prior = x.dot(A.T)
+        if Bu is not None:
+            x_prior += Bu
+        AP = np.matmul(A, P)
+        P_prior = np.matmul(AP, A.T) + Q
+        # C = P A^T P_prior^-1 = (P_prior^-1 A P)^T, as P and P_prior are
+        # symmetric. With this the recursion is
+        #    xs_k = d_k + C_k xs_{k+1},  d_k = x_k - C_k x_prior_k
+        #    Ps_k = E_k + C_k Ps_{k+1} C_k^T,  E_k = P_k - C_k P_prior_k C_k^T
+        # (the priors here being those of step k+1)
+        if n == 1:
+            C = AP[:, 0, 0]/P_prior[:, 0, 0]
+            d = x[:, 0] - C*x_prior[:, 0]
+            E = P[:, 0, 0] - C*C*P_prior[:, 0, 0]
+            self._smooth_scalar(C, d, E, xs_smooth[:, 0], Ps_smooth[:, 0, 0])
+            return
+        C = np.swapaxes(np.linalg.solve(P_prior, AP), -1, -2)
+        d = x - np.matmul(C, x_prior[..., np.newaxis])[..., 0]
+        E = P - np.matmul(np.matmul(C, P_prior), np.swapaxes(C, -1, -2))
+        CP = np.empty((n, n))
+        for k in range(L - 1, -1, -1):
+            np.dot(C[k], xs_smooth[k + 1], out=xs_smooth[k])
+            xs_smooth[k] += d[k]
+            np.dot(C[k], Ps_smooth[k + 1], out=CP)
+            np.dot(CP, C[k].T, out=Ps_smooth[k])
+            Ps_smooth[k] += E[k]
+
+    def _smooth_scalar(self, C, d, E, xs_smooth, Ps_smooth):
+        # One-state recursion. Once the forward filter has reached steady
+        # state C is constant, and that part of the log (at the end, where
+        # the backward pass starts) is a first order IIR filter run in
+        # reverse. The rest is done with plain floats.
+        L = C.size
+        x_next = xs_smooth[L]
+        P_next = Ps_smooth[L]
+        constant = L
+        if lfilter is not None:
+            changed = np.flatnonzero(C != C[-1])
+            constant = changed[-1] + 1 if changed.size else 0
+        if constant < L:
+            c = C[-1]
+            xs_smooth[constant:L] = lfilter([1.0], [1.0, -c], d[constant:][::-1], zi=[c*x_next])[0][::-1]
+            Ps_smooth[constant:L] = lfilter([1.0], [1.0, -c*c], E[constant:][::-1], zi=[c*c*P_next])[0][::-1]
+            x_next = xs_smooth[constant]
+            P_next = Ps_smooth[constant]
+
+        C = C[:constant].tolist()
+        d = d[:constant].tolist()
+        E = E[:constant].tolist()
+        x_list = [0.0]*constant
+        P_list = [0.0]*constant
+        for k in range(constant - 1, -1, -1):
+            c = C[k]
+            x_next = d[k] + c*x_next
+            P_next = E[k] + c*c*P_next
+            x_list[k] = x_next
+            P_list[k] = P_next
+        xs_smooth[:constant] = x_list
+        Ps_smooth[:constant] = P_list
+
+    ## Steady state ##
+    def solve_steady_state(self, max_iterations=100000):
+        # Iterate the discrete algebraic Riccati equation
+        #    P_prior = A P A^T + Q,  P = (I - KH) P_prior
+        # to its fixed point, and fix the gain there
+        m = self.H.size // self.x.size
+        n = self.x.size
+        A, H, Q, R = self._matrices(m)
+        P = self.P.reshape(n, n).astype(float)
+        K_previous = np.full((n, m), np.inf)
+        for _ in range(max_iterations):
+            P_prior = A.dot(P).dot(A.T) + Q
+            HP = H.dot(P_prior)
+            K = np.linalg.solve(HP.dot(H.T) + R, HP).T
+            P = P_prior - K.dot(HP)
+            if np.abs(K - K_previous).max() <= self.steady_state_tolerance:
+                break
+            K_previous = K
+        else:
+            raise Exception("Riccati equation did not converge in {} iterations".format(max_iterations))
+        self.P_prior = P_prior.reshape(self.P.shape)
+        self.P = P.reshape(self.P.shape)
+        self.K = K.reshape(self._gain_shape())
+        self._fix_gain()
+
+    def set_noise(self, Q=None, R=None):
+        # Change the noise covariances. A fixed gain is no longer valid, so
+        # it is re-solved (steady_state=True) or re-learned ('auto').
+        if Q is not None:
+            self.Q = np.asarray(Q)
+        if R is not None:
+            self.R = np.asarray(R)
+        self.K_steady = None
+        self.P_steady = None
+        self._workspace = None
+        if self.steady_state is True:
+            self.solve_steady_state()
+
+    def _gain_shape(self):
+        # K has the shape of P H^T, so that it works with update()
+        return np.shape(np.dot(self.P, np.transpose(self.H)))
+
+    def _fix_gain(self):
+        # Freeze the current gain and covariance
+        self.K_steady = np.array(self.K)
+        self.P_steady = np.array(self.P)
+        # update() picks the fixed gain up when it reallocates
+        self._workspace = None
+
+def chi_square_gate(probability, degrees_of_freedom=1):
+    # Innovation gate that a consistent filter's NIS stays below with the
+    # given probability, e.g. chi_square_gate(0.999, m) for an m-element
+    # measurement (or 1 in sequential mode) rejects 1 in 1000 good
+    # measurements. Common values for one degree of freedom are 9 (3
+    # sigma) and 16 (4 sigma).
+    try:
+        from scipy.stats import chi2
+    except ImportError:
+        raise Exception("chi_square_gate() needs scipy; pass the gate threshold directly instead")
+    return float(chi2.ppf(probability, degrees_of_freedom))
+
+
+class FilterHealth:
+    # Running statistics of a filter's measurement updates. Keeping them
+    # costs a few float operations and two clock reads a step, so they are
+    # always on, and they can be read at any time while the filter runs
+    # (summary() takes a snapshot of them all at once):
+    #    steps: measurement updates so far
+    #    rejected: measurements rejected by the gate (measurement elements,
+    #              in sequential mode)
+    #    nis: normalised innovation squared of the last measurement
+    #    nis_ratio: NIS per measurement element, averaged over everything
+    #               accepted. For a consistent filter this is close to 1;
+    #               well above means Q or R is too small, well below too
+    #               large.
+    #    nis_recent: the same, exponentially weighted over roughly the last
+    #                1/smoothing updates, to show drift
+    #    step_time, step_time_mean, step_time_max: seconds per update
+    def __init__(self, smoothing=0.01):
+        self.smoothing = smoothing
+        self.reset()
+
+    def reset(self):
+        self.steps = 0
+        self.rejected = 0
+        self.nis = np.nan
+        self.nis_total = 0.0
+        self.degrees_of_freedom_total = 0
+        self.nis_recent = np.nan
+        self.step_time = 0.0
+        self.step_time_total = 0.0
+        self.step_time_max = 0.0
+
+    def record(self, nis, degrees_of_freedom, rejected, step_time):
+        # One update: the NIS of the accepted measurement elements and how
+        # many there were, how many were rejected, and how long it took
+        self.steps += 1
+        self.rejected += rejected
+        self.nis = nis
+        if degrees_of_freedom:
+            self.nis_total += nis
+            self.degrees_of_freedom_total += degrees_of_freedom
+            ratio = nis/degrees_of_freedom
+            if self.nis_recent != self.nis_recent:
+                self.nis_recent = ratio
+            else:
+                self.nis_recent += self.smoothing*(ratio - self.nis_recent)
+        self.step_time = step_time
+        self.step_time_total += step_time
+        if step_time > self.step_time_max:
+            self.step_time_max = step_time
+
+    @property
+    def nis_ratio(self):
+        if not self.degrees_of_freedom_total:
+            return np.nan
+        return self.nis_total/self.degrees_of_freedom_total
 
-        ## Predict step:
-        # Project state forward one step
+    @property
+    def step_time_mean(self):
+        if not self.steps:
+            return np.nan
+        return self.step_time_total/self.steps
+
+    def summary(self):
+        return {'steps': self.steps, 'rejected': self.rejected, 'nis': float(self.nis),
+                'nis_ratio': float(self.nis_ratio), 'nis_recent': float(self.nis_recent),
+                'step_time': self.step_time, 'step_time_mean': float(self.step_time_mean),
+                'step_time_max': self.step_time_max}
+
+
+class _Workspace:
+    # Preallocated buffers for the steps of an n-state filter with an
+    # m-element measurement. Every operation writes into these (or into
+    # the given outputs) with out= arguments, so a step allocates no new
+    # arrays.
+    def __init__(self, kalman_filter, m):
+        n = kalman_filter.x.size
+        self.n = n
+        self.m = m
+        self.A, self.H, self.Q, self.R = (matrix.astype(float) for matrix in kalman_filter._matrices(m))
+        B = np.asarray(kalman_filter.B, dtype=float)
+        self.B = B.reshape(()) if B.size == 1 else B.reshape(n, -1)
+
+        # The filter's own state and covariance, updated in place by
+        # update(). The owners are kept so the filter can tell if they have
+        # since been replaced (by filter(), or by the user).
+        self.x_owner = kalman_filter.x
+        self.P_owner = kalman_filter.P
+        self.x = kalman_filter.x.reshape(n)
+        self.P = kalman_filter.P.reshape(n, n)
+        self.x_prior = np.empty(n)
+        self.P_prior = np.empty((n, n))
+        self.K_steady = None
+        if kalman_filter.K_steady is not None:
+            self.K_steady = np.asarray(kalman_filter.K_steady, dtype=float).reshape(n, m)
+            # With a fixed gain the covariances are fixed at the Riccati
+            # solution, and never written by a step, so they are filled in
+            # here. S is fixed too, so for the NIS it is inverted once.
+            self.P[...] = np.asarray(kalman_filter.P_steady, dtype=float).reshape(n, n)
+            np.dot(self.A.dot(self.P), self.A.T, out=self.P_prior)
+            self.P_prior += self.Q
+            self.S_steady_inverse = np.linalg.inv(self.H.dot(self.P_prior).dot(self.H.T) + self.R)
+        self.Bu = np.empty(n)
+        self.AP = np.empty((n, n))
+        self.HP = np.empty((m, n))
+        self.S = np.empty((m, m))
+        # The gain is solved for as S^-1 H P_prior in a Fortran ordered
+        # buffer, which LAPACK can work on in place; its transpose is the
+        # C ordered gain K = P_prior H^T S^-1
+        self.solution = np.empty((m, n), order='F')
+        self.K = self.solution.T
+        self.K_previous = np.full((n, m), np.inf)
+        self.K_difference = np.empty((n, m))
+        self.innovation = np.empty(m)
+        self.whitened = np.empty(m)
+        self.factor = None
+        self.I = np.eye(n)
+        self.I_KH = np.empty((n, n))
+        self.KR = np.empty((n, m))
+        # For re-seeding: H_pinv maps an innovation to the smallest change
+        # of state that explains it
+        self.H_pinv = np.linalg.pinv(self.H)
+        self.direction = np.empty(n)
+        self.direction_column = self.direction.reshape(n, 1)
+
+        if kalman_filter.sequential:
+            self.R_diagonal = np.diag(self.R).copy()
+            if np.any(self.R != np.diag(self.R_diagonal)):
+                raise Exception("Sequential updates need a diagonal R")
+            self.Ph = np.empty(n)
+            self.k = np.empty(n)
+            self.k_innovation = np.empty(n)
+            # Column and row views, so outer products are a broadcast
+            # multiply (np.outer itself is slow on small vectors)
+            self.k_column = self.k.reshape(n, 1)
+            self.Ph_row = self.Ph.reshape(1, n)
+
+    def input_term(self, u):
+        # Bu for one step
+        if self.B.ndim == 0:
+            np.multiply(self.B, u.reshape(-1), out=self.Bu)
+        else:
+            np.dot(self.B, u.reshape(-1), out=self.Bu)
+        return self.Bu
+
+    def predict_state(self, x, Bu):
         # x_prior = Ax + Bu
-        self.x_prior = np.asarray(self.A.dot(self.x) + self.B.dot(self.u))
-        # Project covariance forward one step
+        np.dot(self.A, x, out=self.x_prior)
+        if Bu is not None:
+            self.x_prior += Bu
+
+    def predict(self, x, P, Bu):
+        self.predict_state(x, Bu)
         # P_prior = APA^T + Q
-        self.P_prior = np.asarray(self.A.dot(self.P.dot(self.A.T)) + self.Q)
-
-        ## Update step:
-        # Compute Kalman gain
-        # K = P_prior H^T (H P_prior H^T + R)^-1
-        # We have to do the inverse differently if it's a scalar
-        denominator = self.H.dot(self.P_prior.dot(self.H.T) + self.R)
-        if denominator.shape is ():
-            self.K = np.asarray(self.P_prior.dot(self.H.T) / denominator)
+        np.dot(self.A, P, out=self.AP)
+        np.dot(self.AP, self.A.T, out=self.P_prior)
+        self.P_prior += self.Q
+
+    def innovation_covariance(self):
+        # S = H P_prior H^T + R
+        np.dot(self.H, self.P_prior, out=self.HP)
+        np.dot(self.HP, self.H.T, out=self.S)
+        self.S += self.R
+
+    def gain(self):
+        # K = P_prior H^T S^-1 = (S^-1 H P_prior)^T, as S is symmetric.
+        # S is positive definite, so rather than inverting it we solve
+        # through its Cholesky factorisation, which is cheaper and better
+        # conditioned. A single measurement is just a divide.
+        if self.m == 1:
+            np.divide(self.HP.T, self.S, out=self.K)
+        elif dpotrf is not None:
+            self.solution[...] = self.HP
+            # S is symmetric, so its C ordered buffer is also S in Fortran
+            # order and can be factorised in place
+            factor, info = dpotrf(self.S.T, lower=1, overwrite_a=1, clean=0)
+            if info != 0:
+                raise Exception("Innovation covariance is not positive definite")
+            dpotrs(factor, self.solution, lower=1, overwrite_b=1)
+            # Kept for normalised_innovation_squared()
+            self.factor = factor
         else:
-            self.K = self.P_prior.dot(self.H.T.dot(np.linalg.inv(denominator)))
-        # Incorporate measurement
-        # x = x_prior + K(z - H x_prior)
-        self.x = self.x_prior + self.K.dot(self.z - self.H.dot(self.x_prior))
-        # Obtain posterior covariance
-        # P = (I - KH) P_prior
-        # We have to do the I differently if we're working with scalars
-        KH = self.K.dot(self.H)
-        if KH.shape is ():
-            self.P = np.asarray((1 - KH)*self.P_prior)
+            self.K[...] = np.linalg.solve(self.S, self.HP).T
+
+    def innovate(self, z):
+        # innovation = z - H x_prior
+        np.dot(self.H, self.x_prior, out=self.innovation)
+        np.subtract(z, self.innovation, out=self.innovation)
+
+    def normalised_innovation_squared(self):
+        # innovation^T S^-1 innovation, after gain() (or with a fixed gain)
+        if self.K_steady is not None:
+            np.dot(self.S_steady_inverse, self.innovation, out=self.whitened)
+            return self.innovation.dot(self.whitened)
+        if self.m == 1:
+            return self.innovation[0]*self.innovation[0]/self.S[0, 0]
+        if self.factor is not None:
+            # S has been overwritten by its Cholesky factor
+            self.whitened[...] = self.innovation
+            whitened = dpotrs(self.factor, self.whitened, lower=1, overwrite_b=1)[0]
+        else:
+            whitened = np.linalg.solve(self.S, self.innovation)
+        return self.innovation.dot(whitened)
+
+    def reseed(self, steady=False):
+        # Take the measurement almost as it is, after innovate(): widen
+        # P_prior by d d^T, where d = H_pinv innovation, so that
+        # H P_prior H^T grows by innovation innovation^T. With a fixed gain
+        # P isn't used, so x_prior is moved by d instead.
+        np.dot(self.H_pinv, self.innovation, out=self.direction)
+        if steady:
+            self.x_prior += self.direction
+        else:
+            np.multiply(self.direction_column, self.direction_column.T, out=self.AP)
+            self.P_prior += self.AP
+
+    def sequential_nis(self):
+        # The NIS of each element as it would be in a sequential update,
+        # after gain() and innovate(): the squares of L^-1 innovation
+        if self.m == 1:
+            self.whitened[0] = self.innovation[0]*self.innovation[0]/self.S[0, 0]
+            return self.whitened
+        if self.factor is not None and dtrtrs is not None:
+            # S has been overwritten by its Cholesky factor
+            self.whitened[...] = dtrtrs(self.factor, self.innovation, lower=1)[0]
+        else:
+            self.whitened[...] = np.linalg.solve(np.linalg.cholesky(self.S), self.innovation)
+        self.whitened *= self.whitened
+        return self.whitened
+
+    def correct_state(self, K, x):
+        # x = x_prior + K innovation
+        np.dot(K, self.innovation, out=x)
+        x += self.x_prior
+
+    def correct_covariance(self, P, joseph=False):
+        if joseph:
+            # P = (I - KH) P_prior (I - KH)^T + K R K^T
+            np.dot(self.K, self.H, out=self.I_KH)
+            np.subtract(self.I, self.I_KH, out=self.I_KH)
+            np.dot(self.I_KH, self.P_prior, out=self.AP)
+            np.dot(self.AP, self.I_KH.T, out=P)
+            np.dot(self.K, self.R, out=self.KR)
+            np.dot(self.KR, self.K.T, out=self.AP)
+            P += self.AP
         else:
-            self.P = (np.eye(KH.shape) - KH).dot(self.P_prior)
+            # P = (I - KH) P_prior = P_prior - K H P_prior
+            np.dot(self.K, self.HP, out=P)
+            np.subtract(self.P_prior, P, out=P)
+
+    def correct_sequential(self, z, x, P, joseph=False, gate=None, reseed=False):
+        # Incorporate the measurement one element at a time, each as a
+        # scalar measurement z_i = h_i^T x + v_i with variance r_i:
+        #    s = h_i^T P h_i + r_i,  k = P h_i / s
+        #    x = x + k(z_i - h_i^T x),  P = P - k (P h_i)^T
+        # For a diagonal R this gives the same result as the full update.
+        # NaN elements are missing and skipped, and elements whose
+        # (z_i - h_i^T x)^2 / s is above `gate` are outliers, rejected
+        # unless reseed is set, in which case P is first widened along h_i
+        # by the squared innovation (see reseed()) and the element's NIS is
+        # taken after that. Returns the NIS summed over the elements used,
+        # how many were used and how many were outliers.
+        #
+        # Element i's sequential NIS is the square of element i of
+        # L^-1 innovation, where S = L L^T, as long as every element before
+        # it was used. So if no element is missing or an outlier, the joint
+        # update is done instead, which gives the same result much more
+        # quickly than a loop of small operations.
+        if z.sum() == z.sum():
+            self.innovation_covariance()
+            self.gain()
+            self.innovate(z)
+            nis_elements = self.sequential_nis()
+            if gate is None or nis_elements.max() <= gate:
+                self.correct_state(self.K, x)
+                self.correct_covariance(P, joseph)
+                return nis_elements.sum(), self.m, 0
+        x[...] = self.x_prior
+        P[...] = self.P_prior
+        nis = 0.0
+        used = 0
+        outliers = 0
+        for i in range(self.m):
+            z_i = z[i]
+            if z_i != z_i:
+                continue
+            h = self.H[i]
+            np.dot(P, h, out=self.Ph)
+            s = h.dot(self.Ph) + self.R_diagonal[i]
+            innovation = z_i - h.dot(x)
+            nis_i = innovation*innovation/s
+            if gate is not None and nis_i > gate:
+                outliers += 1
+                if not reseed:
+                    continue
+                np.multiply(h, innovation/h.dot(h), out=self.k)
+                np.multiply(self.k_column, self.k_column.T, out=self.AP)
+                P += self.AP
+                np.dot(P, h, out=self.Ph)
+                s = h.dot(self.Ph) + self.R_diagonal[i]
+                nis_i = innovation*innovation/s
+            nis += nis_i
+            used += 1
+            np.divide(self.Ph, s, out=self.k)
+            np.multiply(self.k, innovation, out=self.k_innovation)
+            x += self.k_innovation
+            np.multiply(self.k_column, self.Ph_row, out=self.AP)
+            P -= self.AP
+            if joseph:
+                # Joseph form for a scalar measurement, which simplifies to
+                #    P = P - k (P h)^T - (P h) k^T + s k k^T
+                # and keeps P exactly symmetric
+                P -= self.AP.T
+                np.multiply(self.k_column, self.k_column.T, out=self.AP)
+                self.AP *= s
+                P += self.AP
+        return nis, used, outliers
+
+    def gain_converged(self, tolerance):
+        # Whether the gain has changed by no more than `tolerance` since
+        # the last call
+        np.subtract(self.K, self.K_previous, out=self.K_difference)
+        np.abs(self.K_difference, out=self.K_difference)
+        converged = self.K_difference.max() <= tolerance
+        self.K_previous[...] = self.K
+        return converged
+
 
+class KalmanFilterBank:
+    # K independent Kalman filters with the same structure, advanced
+    # together with batched matrix products so that a step costs a few
+    # NumPy calls however many filters there are. Use it to filter several
+    # channels at once (e.g. every axis of the IMU) or to run a whole grid
+    # of parameters over the same data.
+    #
+    # x_prior is (K, n), or (K,) for one-state filters. Each of P_prior,
+    # A, B, H, Q and R is shared by all the filters (a scalar or a matrix)
+    # unless it is named in per_filter, in which case it has a leading
+    # axis of length K (a (K,) array of scalars, or a (K, rows, cols)
+    # stack of matrices). A 1D H is a single measurement row, and a 1D B
+    # a single input column.
+    def __init__(self, x_prior, P_prior, A, B, H, Q, R, per_filter=()):
+        unknown = set(per_filter) - {'P_prior', 'A', 'B', 'H', 'Q', 'R'}
+        if unknown:
+            raise Exception("Unknown per-filter parameter(s): {}".format(', '.join(sorted(unknown))))
+        self.per_filter = frozenset(per_filter)
+        x_prior = np.asarray(x_prior, dtype=float)
+        self.num_filters = x_prior.shape[0]
+        self.n = x_prior.shape[1] if x_prior.ndim > 1 else 1
+        H_shape = self._shape('H', H)
+        self.m = H_shape[0] if len(H_shape) > 1 else 1
+        B_shape = self._shape('B', B)
+        self.p = B_shape[-1] if len(B_shape) > 1 else 1
+
+        n, m, p = self.n, self.m, self.p
+        self.A = self._matrix('A', A, n, n)
+        self.B = self._matrix('B', B, n, p)
+        self.H = self._matrix('H', H, m, n)
+        self.Q = self._matrix('Q', Q, n, n)
+        self.R = self._matrix('R', R, m, m)
+        self.A_T = np.swapaxes(self.A, -1, -2)
+        self.H_T = np.swapaxes(self.H, -1, -2)
+
+        # States are stored as (K, n, 1) column vectors for matmul
+        K = self.num_filters
+        self._x = x_prior.reshape(K, n, 1).copy()
+        self._P = np.broadcast_to(self._matrix('P_prior', P_prior, n, n), (K, n, n)).copy()
+
+        # Work buffers, reused every step
+        self._x_prior = np.empty((K, n, 1))
+        self._P_prior = np.empty((K, n, n))
+        self._AP = np.empty((K, n, n))
+        self._HP = np.empty((K, m, n))
+        self._S = np.empty((K, m, m))
+        self._K = np.empty((K, n, m))
+        self._innovation = np.empty((K, m, 1))
+        self._Bu = np.empty((K, n, 1))
+
+    def _shape(self, name, value):
+        # The shape of one filter's value
+        value = np.asarray(value, dtype=float)
+        if name not in self.per_filter:
+            return value.shape
+        if value.ndim == 0 or value.shape[0] != self.num_filters:
+            raise Exception("Per-filter {} needs a leading axis of length {}, not shape {}"
+                            .format(name, self.num_filters, value.shape))
+        return value.shape[1:]
+
+    def _matrix(self, name, value, rows, cols):
+        # Shared values become a 2D matrix, per-filter values a 3D stack
+        shape = self._shape(name, value)
+        value = np.asarray(value, dtype=float)
+        if name in self.per_filter:
+            return value.reshape(self.num_filters, rows, cols)
+        if not shape:
+            return np.broadcast_to(value, (rows, cols))
+        return value.reshape(rows, cols)
+
+    @property
+    def x(self):
+        # (K, n) states
+        return self._x[..., 0]
+
+    @property
+    def P(self):
+        # (K, n, n) covariances
+        return self._P
+
+    def update(self, us, zs, x_out=None, P_out=None):
+        # Advance every filter by one step. zs is (K, m) (or (K,)) and us
+        # is (K, p) (or (K,), or None for no input). Optionally writes the
+        # new states and covariances into x_out ((K, n, 1)) and P_out.
+        K, n, m = self.num_filters, self.n, self.m
+        x = self._x if x_out is None else x_out
+        P = self._P if P_out is None else P_out
+        if n == m == 1:
+            self._update_scalar(us, zs, x.reshape(K), P.reshape(K))
+            self._x = x
+            self._P = P
+            return self.x, self.P
+        zs = np.asarray(zs, dtype=float).reshape(K, m, 1)
+
+        # x_prior = Ax + Bu
+        np.matmul(self.A, self._x, out=self._x_prior)
+        if us is not None:
+            np.matmul(self.B, np.asarray(us, dtype=float).reshape(K, self.p, 1), out=self._Bu)
+            self._x_prior += self._Bu
+        # P_prior = APA^T + Q
+        np.matmul(self.A, self._P, out=self._AP)
+        np.matmul(self._AP, self.A_T, out=self._P_prior)
+        self._P_prior += self.Q
+        # S = H P_prior H^T + R
+        np.matmul(self.H, self._P_prior, out=self._HP)
+        np.matmul(self._HP, self.H_T, out=self._S)
+        self._S += self.R
+        # K = P_prior H^T S^-1 = (S^-1 H P_prior)^T, as S is symmetric
+        if m == 1:
+            np.divide(np.swapaxes(self._HP, -1, -2), self._S, out=self._K)
+        else:
+            self._K[...] = np.swapaxes(np.linalg.solve(self._S, self._HP), -1, -2)
+        # x = x_prior + K(z - H x_prior)
+        np.matmul(self.H, self._x_prior, out=self._innovation)
+        np.subtract(zs, self._innovation, out=self._innovation)
+        np.matmul(self._K, self._innovation, out=x)
+        x += self._x_prior
+        # P = P_prior - K H P_prior
+        np.matmul(self._K, self._HP, out=P)
+        np.subtract(self._P_prior, P, out=P)
+
+        self._x = x
+        self._P = P
         return self.x, self.P
 
+    def _update_scalar(self, us, zs, x, P):
+        # One-state, one-measurement filters only need element-wise
+        # arithmetic on (K,) arrays, which is much cheaper than matmul
+        a = self.A.reshape(-1)
+        h = self.H.reshape(-1)
+        x_prior = self._x_prior.reshape(-1)
+        P_prior = self._P_prior.reshape(-1)
+        gain = self._K.reshape(-1)
+        work = self._S.reshape(-1)
+
+        # x_prior = ax + bu
+        np.multiply(a, self._x.reshape(-1), out=x_prior)
+        if us is not None:
+            x_prior += self.B.reshape(-1)*np.asarray(us, dtype=float).reshape(-1)
+        # P_prior = aPa + q
+        np.multiply(a*a, self._P.reshape(-1), out=P_prior)
+        P_prior += self.Q.reshape(-1)
+        # K = P_prior h / (h P_prior h + r)
+        np.multiply(h*h, P_prior, out=work)
+        work += self.R.reshape(-1)
+        np.multiply(P_prior, h, out=gain)
+        gain /= work
+        # x = x_prior + K(z - h x_prior)
+        np.multiply(h, x_prior, out=work)
+        np.subtract(np.asarray(zs, dtype=float).reshape(-1), work, out=work)
+        work *= gain
+        np.add(x_prior, work, out=x)
+        # P = (1 - Kh) P_prior
+        np.multiply(gain, h, out=work)
+        np.subtract(1, work, out=work)
+        np.multiply(work, P_prior, out=P)
+
+    def filter(self, zs, us=None):
+        # Run every filter over N steps. zs is (N, K, m) (or (N, K)) and us
+        # is (N, K, p) (or (N, K), or None). Returns (N, K, n) states and
+        # (N, K, n, n) covariances.
+        zs = np.asarray(zs, dtype=float)
+        N = zs.shape[0]
+        K, n = self.num_filters, self.n
+        xs = np.empty((N, K, n, 1))
+        Ps = np.empty((N, K, n, n))
+        for k in range(N):
+            self.update(None if us is None else us[k], zs[k], xs[k], Ps[k])
+        # Leave the filter holding its own copy of the final state
+        if N:
+            self._x = xs[-1].copy()
+            self._P = Ps[-1].copy()
+        return xs[..., 0], Ps
+
 if __name__=='__main__':
+    import tracemalloc
+
+    # Check update() and filter() against the textbook equations, written
+    # out directly with inverses, on a random 9-state model
+    rng = np.random.default_rng(0)
+    n, m, p = 9, 6, 3
+    A = 0.95*np.eye(n) + 0.01*rng.standard_normal((n, n))
+    B = rng.standard_normal((n, p))
+    H = rng.standard_normal((m, n))
+    Q = np.diag(rng.uniform(1e-4, 1e-2, n))
+    R = np.diag(rng.uniform(0.1, 1, m))
+    zs = rng.standard_normal((200, m))
+    us = rng.standard_normal((200, p))
+
+    for joseph in (False, True):
+        x = np.zeros(n)
+        P = np.eye(n)
+        filt = KalmanFilter(np.zeros(n), np.eye(n), A, B, H, Q, R, joseph=joseph)
+        xs, Ps = KalmanFilter(np.zeros(n), np.eye(n), A, B, H, Q, R, joseph=joseph).filter(zs, us)
+        error = 0
+        for k in range(zs.shape[0]):
+            x_prior = A.dot(x) + B.dot(us[k])
+            P_prior = A.dot(P).dot(A.T) + Q
+            K = P_prior.dot(H.T).dot(np.linalg.inv(H.dot(P_prior).dot(H.T) + R))
+            x = x_prior + K.dot(zs[k] - H.dot(x_prior))
+            I_KH = np.eye(n) - K.dot(H)
+            if joseph:
+                P = I_KH.dot(P_prior).dot(I_KH.T) + K.dot(R).dot(K.T)
+            else:
+                P = I_KH.dot(P_prior)
+            x_update, P_update = filt.update(us[k], zs[k])
+            error = max(error, np.abs(x_update - x).max(), np.abs(P_update - P).max(),
+                        np.abs(xs[k] - x).max(), np.abs(Ps[k] - P).max())
+        print("Joseph form {}: max difference from textbook {:.2e}".format(joseph, error))
+        assert error < 1e-10
+
+    # update() returns copies, so earlier results aren't overwritten
+    x_first = filt.update(us[0], zs[0])[0]
+    x_second = filt.update(us[1], zs[1])[0]
+    assert x_first is not x_second and np.any(x_first != x_second)
+
+    # An in-place steady-state step should not allocate any arrays (a
+    # copy of x and P alone would take more than the bound here)
+    filt = KalmanFilter(np.zeros(n), np.eye(n), A, B, H, Q, R, steady_state=True)
+    filt.update(us[0], zs[0], in_place=True)
+    tracemalloc.start()
+    for k in range(1000):
+        x_update, P_update = filt.update(us[k % 200], zs[k % 200], in_place=True)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print("Peak memory over 1000 in-place steady-state steps: {} bytes".format(peak))
+    assert x_update is filt.x and peak < x_update.nbytes + P_update.nbytes
+
+    # A bank with per-filter 1D H rows, as many filters as states (so the
+    # rows can't be told from shared values by shape) and a shared A,
+    # against the same filters run separately
+    K = n
+    H_rows = rng.standard_normal((K, n))
+    Q_diagonals = rng.uniform(1e-4, 1e-2, (K, n))
+    Q_stack = np.array([np.diag(q) for q in Q_diagonals])
+    bank_zs = rng.standard_normal((50, K))
+    bank = KalmanFilterBank(np.zeros((K, n)), np.eye(n), A, 0, H_rows, Q_stack, 0.5,
+                            per_filter=('H', 'Q'))
+    bank_xs = bank.filter(bank_zs)[0]
+    error = 0
+    for k in range(K):
+        separate = KalmanFilter(np.zeros(n), np.eye(n), A, 0, H_rows[k], Q_stack[k], 0.5)
+        separate_xs = separate.filter(bank_zs[:, k])[0]
+        error = max(error, np.abs(bank_xs[:, k] - separate_xs).max())
+    print("Filter bank: max difference from separate filters {:.2e}".format(error))
+    assert bank.m == 1 and error < 1e-10
+
     # This example is taken from Welch & Bishop, 'An Introduction to the
     # Kalman Filter', University of North Carolina, Jul 2006
-
-    import matplotlib.pyplot as plt
+    try:
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print("matplotlib is not installed, so the example is not plotted")
+        raise SystemExit
 
     filt = KalmanFilter(0, 1, 1, 0, 1, 1e-5, 1)
     n = 100
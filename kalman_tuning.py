@@ -0,0 +1,243 @@
+########################################################################
+## Imports ##
+#############
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from kalman_filter import KalmanFilter
+
+########################################################################
+## Scores ##
+############
+# Both scores are "higher is better", so the tuner can maximise either
+METRICS = ('log_likelihood', 'step_response')
+
+
+def innovation_log_likelihood(kalman_filter, zs, xs, Ps, us=None):
+    # Log-likelihood of the measurements under the filter's model,
+    #    sum_k -1/2 (log det(2 pi S_k) + v_k^T S_k^-1 v_k)
+    # where v_k = z_k - H x_prior_k is the innovation and
+    # S_k = H P_prior_k H^T + R its covariance. `kalman_filter` must be in
+    # the state it was in before filtering; xs and Ps are the outputs of
+    # its filter(). The priors are rebuilt for every step at once.
+    zs = np.asarray(zs, dtype=float)
+    N = zs.shape[0]
+    zs = zs.reshape(N, -1)
+    m = zs.shape[1]
+    n = xs.shape[1]
+    A, H, Q, R = kalman_filter._matrices(m)
+
+    x_previous = np.concatenate((kalman_filter.x.reshape(1, n), xs[:-1]))
+    P_previous = np.concatenate((kalman_filter.P.reshape(1, n, n), Ps[:-1]))
+    x_prior = x_previous.dot(A.T)
+    if us is not None:
+        x_prior += kalman_filter._input_term(np.asarray(us, dtype=float).reshape(N, -1))
+    P_prior = np.matmul(np.matmul(A, P_previous), A.T) + Q
+    S = np.matmul(np.matmul(H, P_prior), H.T) + R
+    innovations = zs - x_prior.dot(H.T)
+
+    if m == 1:
+        S = S[:, 0, 0]
+        mahalanobis = innovations[:, 0]**2/S
+        log_det = np.log(S)
+    else:
+        mahalanobis = np.einsum('ki,ki->k', innovations,
+                                np.linalg.solve(S, innovations[..., np.newaxis])[..., 0])
+        log_det = np.linalg.slogdet(S)[1]
+    return -0.5*(N*m*np.log(2*np.pi) + log_det.sum() + mahalanobis.sum())
+
+
+def centred_median(zs, window=25):
+    # Zero-lag reference for a step response: the running median over a
+    # window centred on each sample (the ends use a shrinking window)
+    zs = np.asarray(zs, dtype=float)
+    half = window//2
+    padded = np.concatenate((np.full(half, np.nan), zs, np.full(half, np.nan)))
+    windows = np.lib.stride_tricks.sliding_window_view(padded, 2*half + 1)
+    return np.nanmedian(windows, axis=1)
+
+
+def step_response_score(xs, reference):
+    # Negative RMS error between the (first) filtered state and a zero-lag
+    # reference. A filter that is too sluggish lags behind steps and one
+    # that is too eager lets the noise through; both are penalised.
+    return -np.sqrt(np.mean((xs[:, 0] - reference)**2))
+
+
+########################################################################
+## Result cache ##
+##################
+def dataset_hash(*arrays):
+    # Identifies a dataset by its contents, shape and type
+    digest = hashlib.sha1()
+    for array in arrays:
+        if array is None:
+            digest.update(b'None')
+            continue
+        array = np.ascontiguousarray(array)
+        digest.update(str((array.shape, array.dtype.str)).encode())
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+class TuningCache:
+    # Scores of previously evaluated candidates, keyed by the dataset, the
+    # model, the metric and the Q and R scales. If a filename is given the
+    # cache is loaded from and saved to it as JSON, so repeated tuning runs
+    # over the same recording only evaluate new candidates.
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.scores = {}
+        if filename is not None and os.path.exists(filename):
+            with open(filename) as f:
+                self.scores = json.load(f)
+
+    @staticmethod
+    def key(dataset, model, metric, Q_scale, R_scale):
+        return '{}:{}:{}:{!r}:{!r}'.format(dataset, model, metric, float(Q_scale), float(R_scale))
+
+    def get(self, key):
+        return self.scores.get(key)
+
+    def put(self, key, score):
+        self.scores[key] = score
+
+    def save(self):
+        if self.filename is not None:
+            with open(self.filename, 'w') as f:
+                json.dump(self.scores, f)
+
+
+########################################################################
+## Candidate evaluation ##
+##########################
+# The model and dataset are sent to each worker process once, when it
+# starts, rather than with every candidate
+_worker = {}
+
+
+def _initialise_worker(kalman_filter, zs, us, metric, reference):
+    _worker.update(kalman_filter=kalman_filter, zs=zs, us=us, metric=metric,
+                   reference=reference)
+
+
+def _evaluate(scales):
+    Q_scale, R_scale = scales
+    template = _worker['kalman_filter']
+    kalman_filter = KalmanFilter(template.x, template.P, template.A, template.B,
+                                 template.H, template.Q*Q_scale, template.R*R_scale,
+                                 steady_state='auto')
+    xs, Ps = kalman_filter.filter(_worker['zs'], _worker['us'])
+    if _worker['metric'] == 'log_likelihood':
+        # filter() has moved kalman_filter on, so score against a fresh copy
+        start = KalmanFilter(template.x, template.P, template.A, template.B,
+                             template.H, template.Q*Q_scale, template.R*R_scale)
+        score = innovation_log_likelihood(start, _worker['zs'], xs, Ps, _worker['us'])
+    else:
+        score = step_response_score(xs, _worker['reference'])
+    # NaN (e.g. from a diverging filter) never wins
+    return float(score) if np.isfinite(score) else -np.inf
+
+
+########################################################################
+## Tuner ##
+###########
+def tune(kalman_filter, zs, us=None, metric='log_likelihood',
+         Q_scales=np.logspace(-3, 3, 13), R_scales=np.logspace(-3, 3, 13),
+         refinements=2, reference=None, processes=None, cache=None):
+    # Search for the Q and R that maximise `metric` for kalman_filter's
+    # model on a recorded dataset. Candidates are kalman_filter.Q and
+    # kalman_filter.R multiplied by every pair of Q_scales and R_scales.
+    # After the grid search, each refinement repeats it on a grid of the
+    # same size spanning one grid step either side of the best candidate.
+    #
+    # metric is 'log_likelihood' (innovation log-likelihood; needs no
+    # ground truth) or 'step_response' (RMS error against `reference`,
+    # which defaults to the centred median of zs; use it on recordings
+    # with steps in). Candidates are evaluated in parallel over
+    # `processes` worker processes (one per CPU by default; 1 runs them
+    # here). Pass a TuningCache to reuse earlier scores.
+    #
+    # Returns (Q, R, score), ready to pass to KalmanFilter or set_noise().
+    if metric not in METRICS:
+        raise Exception("Unknown metric '{}' (expected one of {})".format(metric, METRICS))
+    zs = np.asarray(zs, dtype=float)
+    if us is not None:
+        us = np.asarray(us, dtype=float)
+    if metric == 'step_response' and reference is None:
+        reference = centred_median(zs.reshape(zs.shape[0], -1)[:, 0])
+    if cache is None:
+        cache = TuningCache()
+    dataset = dataset_hash(zs, us, reference)
+    model = dataset_hash(kalman_filter.x, kalman_filter.P, kalman_filter.A, kalman_filter.B,
+                         kalman_filter.H, kalman_filter.Q, kalman_filter.R)
+
+    Q_scales = np.asarray(Q_scales, dtype=float)
+    R_scales = np.asarray(R_scales, dtype=float)
+    executor = None
+    if processes != 1:
+        executor = ProcessPoolExecutor(processes, initializer=_initialise_worker,
+                                       initargs=(kalman_filter, zs, us, metric, reference))
+    else:
+        _initialise_worker(kalman_filter, zs, us, metric, reference)
+
+    try:
+        for refinement in range(refinements + 1):
+            candidates = [(Q_scale, R_scale) for Q_scale in Q_scales for R_scale in R_scales]
+            keys = [cache.key(dataset, model, metric, *candidate) for candidate in candidates]
+            pending = [candidate for candidate, key in zip(candidates, keys)
+                       if cache.get(key) is None]
+            if executor is None:
+                scores = map(_evaluate, pending)
+            else:
+                chunksize = max(1, len(pending)//(4*(processes or os.cpu_count() or 1)))
+                scores = executor.map(_evaluate, pending, chunksize=chunksize)
+            for candidate, score in zip(pending, scores):
+                cache.put(cache.key(dataset, model, metric, *candidate), score)
+
+            scores = np.array([cache.get(key) for key in keys]).reshape(Q_scales.size, R_scales.size)
+            i, j = np.unravel_index(np.argmax(scores), scores.shape)
+            best = (Q_scales[i], R_scales[j], float(scores[i, j]))
+            Q_scales = _refine(Q_scales, i)
+            R_scales = _refine(R_scales, j)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        cache.save()
+
+    Q_scale, R_scale, score = best
+    return kalman_filter.Q*Q_scale, kalman_filter.R*R_scale, score
+
+
+def _refine(scales, i):
+    # A geometric grid of the same size from the neighbour below scales[i]
+    # to the neighbour above it
+    if scales.size < 2:
+        return scales
+    low = scales[max(i - 1, 0)]
+    high = scales[min(i + 1, scales.size - 1)]
+    return np.geomspace(low, high, scales.size)
+
+
+########################################################################
+## Main ##
+##########
+if __name__ == "__main__":
+    import time
+
+    # Tune the barometer filter used by remote_display.py on the recorded
+    # data in test_data
+    directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_data')
+    data = np.loadtxt(os.path.join(directory, 'barometer_data.txt'))
+    data_step = np.loadtxt(os.path.join(directory, 'barometer_data_step.txt'))
+    cache = TuningCache('kalman_tuning_cache.json')
+
+    for name, zs, metric in (('barometer_data', data, 'log_likelihood'),
+                             ('barometer_data_step', data_step, 'step_response')):
+        kalman_filter = KalmanFilter(zs[0], 2, 1, 0, 1, 0.005, 1.02958)
+        start = time.perf_counter()
+        Q, R, score = tune(kalman_filter, zs, metric=metric, cache=cache)
+        print("{} ({}): Q = {:.4g}, R = {:.4g}, score {:.6g}, {:.2f} s"
+              .format(name, metric, Q.item(), R.item(), score, time.perf_counter() - start))
@@ -70,6 +70,7 @@ class MainWindow(QtGui.QMainWindow):
 
         self.connected = False
         self.time_zero = time.time()
+        self.sender_time_offset = None
 
     def _initialise_gui_widgets(self):
         """
@@ -117,7 +118,11 @@ class MainWindow(QtGui.QMainWindow):
                 widget.add_item('altitude', pen='k')
                 widget.add_item('filtered', pen='r')
                 widget.add_item('altitude_gps', pen='b')
-                self.filter1 = KalmanFilter(x_prior=0, P_prior=2, A=1, B=0, H=1, Q=0.005, R=1.02958)
+                widget.add_item('fused', pen='g')
+                # Readings more than 4 sigma from the prediction are
+                # dropped as corrupt
+                self.filter1 = KalmanFilter(x_prior=0, P_prior=2, A=1, B=0, H=1, Q=0.005, R=1.02958,
+                                            steady_state='auto', gate=16)
             elif name == 'gps-pos':
                 widget.add_item('position', symbol='o')
             else:
@@ -214,7 +219,15 @@ class MainWindow(QtGui.QMainWindow):
         """
         data_source = received_data[0]
         values = received_data[1]
+        timestamp = received_data[2]
         t = time.time() - self.time_zero
+        if timestamp is not None:
+            # Frames are stamped when the sensors were read, which is more
+            # accurate than when they arrive. The sender's clock is lined
+            # up with ours on the first frame.
+            if self.sender_time_offset is None:
+                self.sender_time_offset = t - timestamp
+            t = timestamp + self.sender_time_offset
         if data_source == com.BAROMETER_UNFILTERED_ID:
             self.plot_widgets['barometer'].get_item('altitude').update_data(t, values[0])
             self.plot_widgets['barometer'].get_item('filtered').update_data(t, self.filter1.update(u_input=0, z_measurement=values[0])[0])
@@ -249,6 +262,18 @@ class MainWindow(QtGui.QMainWindow):
                 print("Error: Expected 1 value for GPS altitude, got {}".format(len(values)))
             else:
                 self.plot_widgets['barometer'].get_item('altitude_gps').update_data(t, values[0])
+        elif data_source == com.ALTITUDE_ID:
+            if len(values) != 2:
+                print("Error: Expected 2 values for fused altitude, got {}".format(len(values)))
+            else:
+                self.plot_widgets['barometer'].get_item('fused').update_data(t, values[0])
+        elif data_source == com.BAROMETER_VARIANCE_ID:
+            if len(values) != 1:
+                print("Error: Expected 1 value for barometer variance, got {}".format(len(values)))
+            else:
+                # Use the variance measured during calibration as the
+                # filter's measurement noise
+                self.filter1.set_noise(R=values[0])
 
 
 ###############################################################################
@@ -290,7 +315,7 @@ class ConnectionHandler(QtCore.QObject):
 class DataReceiver(QtCore.QObject):
 
     # Signals
-    data_received_signal = QtCore.pyqtSignal(list)  # [data_source, data]
+    data_received_signal = QtCore.pyqtSignal(list)  # [data_source, data, timestamp]
 
     def __init__(self, parent, connection_handler):
         super().__init__(parent)
@@ -301,11 +326,9 @@ class DataReceiver(QtCore.QObject):
         while True:
             self.connection_handler.mutex.lock()
             if self.connection_handler.connected:
-                   packets = self.connection_handler.client.read()
-                   for packet in packets:
-                       if packet:
-                           packet_length, data_source, data = packet
-                           self.data_received_signal.emit([data_source, data])
+                   records = self.connection_handler.client.read()
+                   for timestamp, data_source, data in records:
+                       self.data_received_signal.emit([data_source, data, timestamp])
             self.connection_handler.mutex.unlock()
 
 ###############################################################################
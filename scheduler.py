@@ -0,0 +1,135 @@
+########################################################################
+## Imports ##
+#############
+import time
+
+########################################################################
+## Scheduled task ##
+####################
+class ScheduledTask:
+    # A callback that should run at a fixed rate. Deadlines are absolute
+    # (start + n*period) so that the time taken by the callbacks does not
+    # make the rate drift.
+    def __init__(self, name, callback, rate):
+        self.name = name
+        self.callback = callback
+        self.rate = rate
+        self.period = 1/rate
+        self.next_deadline = None
+        self.reset_statistics()
+
+    def reset_statistics(self):
+        self.runs = 0
+        self.overruns = 0  # Number of deadlines skipped because we were late
+        self.max_jitter = 0
+        self.total_jitter = 0
+        self.total_squared_jitter = 0
+
+    def run(self, now):
+        # Jitter is how late the task started relative to its deadline
+        jitter = now - self.next_deadline
+        self.runs += 1
+        self.max_jitter = max(self.max_jitter, jitter)
+        self.total_jitter += jitter
+        self.total_squared_jitter += jitter**2
+
+        self.callback()
+
+        # Move on to the next deadline on the grid. If we're so late that
+        # it has already passed, skip ahead rather than running a burst of
+        # catch-up calls.
+        self.next_deadline += self.period
+        if self.next_deadline <= now:
+            missed = int((now - self.next_deadline) // self.period) + 1
+            self.overruns += missed
+            self.next_deadline += missed*self.period
+
+    def statistics(self):
+        if self.runs:
+            mean_jitter = self.total_jitter/self.runs
+            jitter_variance = max(self.total_squared_jitter/self.runs - mean_jitter**2, 0)
+        else:
+            mean_jitter = 0
+            jitter_variance = 0
+        return {'rate': self.rate,
+                'runs': self.runs,
+                'overruns': self.overruns,
+                'mean_jitter': mean_jitter,
+                'std_jitter': jitter_variance**0.5,
+                'max_jitter': self.max_jitter}
+
+
+########################################################################
+## Scheduler ##
+###############
+class Scheduler:
+    # Runs several tasks, each at its own rate, on absolute monotonic
+    # deadlines. The clock and sleep functions can be replaced (e.g. with
+    # a simulated clock) for testing.
+    def __init__(self, clock=time.monotonic, sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self.tasks = []
+        self.tick_callbacks = []
+
+    def add_task(self, name, callback, rate):
+        task = ScheduledTask(name, callback, rate)
+        self.tasks.append(task)
+        return task
+
+    def add_tick_callback(self, callback):
+        # Called after every pass of run_pending() that ran at least one
+        # task, e.g. to send everything the tasks of that tick produced
+        self.tick_callbacks.append(callback)
+
+    def start(self):
+        # All tasks are due straight away
+        now = self.clock()
+        for task in self.tasks:
+            task.next_deadline = now
+            task.reset_statistics()
+
+    def run_pending(self):
+        # Run every task whose deadline has passed, in deadline order.
+        # Returns the time of the next deadline.
+        ran = False
+        for task in sorted(self.tasks, key=lambda task: task.next_deadline):
+            now = self.clock()
+            if task.next_deadline <= now:
+                task.run(now)
+                ran = True
+        if ran:
+            for callback in self.tick_callbacks:
+                callback()
+        return min(task.next_deadline for task in self.tasks)
+
+    def run(self, duration=None):
+        # Run until interrupted, or for `duration` seconds
+        self.start()
+        end_time = None if duration is None else self.clock() + duration
+        while end_time is None or self.clock() < end_time:
+            next_deadline = self.run_pending()
+            if end_time is not None:
+                next_deadline = min(next_deadline, end_time)
+            delay = next_deadline - self.clock()
+            if delay > 0:
+                self.sleep(delay)
+
+    def statistics(self):
+        return {task.name: task.statistics() for task in self.tasks}
+
+
+########################################################################
+## Main ##
+##########
+if __name__ == "__main__":
+    # Run a few dummy tasks at different rates and report their timing
+    scheduler = Scheduler()
+    scheduler.add_task('fast', lambda: None, 50)
+    scheduler.add_task('medium', lambda: None, 12.5)
+    scheduler.add_task('slow', lambda: time.sleep(0.05), 1)
+
+    scheduler.run(duration=5)
+
+    for name, stats in scheduler.statistics().items():
+        print("{}: {}".format(name, stats))
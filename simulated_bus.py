@@ -0,0 +1,503 @@
+########################################################################
+## Imports ##
+#############
+import json
+import struct
+import time
+from collections import deque
+
+import numpy as np
+
+import accelerometer as lsm
+import gyroscope as lgd
+import barometer as lps
+from i2c import AUTO_INCREMENT
+
+# Register layouts of the simulated output samples
+XYZ_STRUCT = struct.Struct('<3h')
+PRESSURE_STRUCT = struct.Struct('<i')
+TEMPERATURE_STRUCT = struct.Struct('<h')
+
+########################################################################
+## Simulated clock ##
+#####################
+class SimulatedClock:
+    # Stands in for time.monotonic/time.sleep, so that simulated devices,
+    # the bus latency and the scheduler all run on the same virtual time
+    def __init__(self, start_time=0.0):
+        self.now = start_time
+
+    def time(self):
+        return self.now
+
+    def sleep(self, duration):
+        self.now += max(duration, 0)
+
+
+########################################################################
+## Simulated sample stream ##
+#############################
+class SimulatedChannel:
+    # One stream of samples from a device (e.g. the accelerometer or the
+    # magnetometer of the LSM303D). Samples are produced at the ODR from
+    # `source(t)`, which returns raw counts, and turned into register
+    # bytes by `pack`. The channel keeps the latest sample in its output
+    # registers and, if enabled, a stream-mode FIFO of the most recent
+    # samples.
+    def __init__(self, output_register, sample_length, pack, source,
+                 ready_mask, overrun_mask, fifo_depth=0):
+        self.output_register = output_register
+        self.sample_length = sample_length
+        self.pack = pack
+        self.source = source
+        self.ready_mask = ready_mask
+        self.overrun_mask = overrun_mask
+        self.fifo_depth = fifo_depth
+
+        self.odr = 0
+        self.fifo_enabled = False
+        self.fifo_watermark = 0
+        self.fifo = deque(maxlen=max(fifo_depth, 1))
+        self.fifo_overrun = False
+        self.output = bytes(self.sample_length)
+        self.ready = False
+        self.overrun = False
+        self.reset_timing(0)
+
+    def reset_timing(self, now):
+        self.start_time = now
+        self.samples_generated = 0
+
+    def set_odr(self, odr, now):
+        self.odr = odr
+        self.reset_timing(now)
+
+    def update(self, now):
+        # Generate every sample that is due by `now`
+        if not self.odr:
+            return
+        due = int((now - self.start_time)*self.odr)
+        # Anything older than a FIFO's worth of samples would have been
+        # overwritten anyway
+        backlog = due - self.samples_generated
+        if backlog > self.fifo_depth + 1:
+            self.samples_generated = due - (self.fifo_depth + 1)
+            self.overrun = True
+            self.fifo_overrun = self.fifo_overrun or self.fifo_enabled
+        while self.samples_generated < due:
+            t = self.start_time + self.samples_generated/self.odr
+            sample = self.pack(self.source(t))
+            self.samples_generated += 1
+            if self.fifo_enabled:
+                if len(self.fifo) == self.fifo_depth:
+                    self.fifo_overrun = True
+                self.fifo.append(sample)
+            else:
+                if self.ready:
+                    self.overrun = True
+                self.ready = True
+                self.output = sample
+
+    def status(self):
+        status = 0
+        if self.ready or (self.fifo_enabled and self.fifo):
+            status |= self.ready_mask
+        if self.overrun:
+            status |= self.overrun_mask
+        return status
+
+    def fifo_src(self):
+        # FTH | OVRN | EMPTY | FSS[4:0]
+        level = len(self.fifo)
+        fifo_src = level & 0b00011111
+        if level == self.fifo_depth:
+            fifo_src |= 0b01000000
+        if level == 0:
+            fifo_src |= 0b00100000
+        if level >= self.fifo_watermark:
+            fifo_src |= 0b10000000
+        return fifo_src
+
+    def contains(self, register):
+        return self.output_register <= register < self.output_register + self.sample_length
+
+    def read_output(self, register):
+        # Read one output byte. Reading the last byte of a sample pops it
+        # from the FIFO, or marks the output registers as read.
+        offset = register - self.output_register
+        if self.fifo_enabled:
+            sample = self.fifo[0] if self.fifo else self.output
+            if offset == self.sample_length - 1 and self.fifo:
+                self.output = self.fifo.popleft()
+                self.fifo_overrun = False
+            return sample[offset]
+        self.ready = False
+        self.overrun = False
+        return self.output[offset]
+
+    def next_register(self, register):
+        # With the FIFO enabled the address rolls back to the start of the
+        # output block, so whole batches can be read in one transfer
+        register += 1
+        if self.fifo_enabled and register == self.output_register + self.sample_length:
+            register = self.output_register
+        return register
+
+
+########################################################################
+## Simulated devices ##
+#######################
+class SimulatedDevice:
+    # A register map with WHOAMI, auto-increment, STATUS and FIFO
+    # behaviour. Subclasses add the channels and work out the ODR from
+    # the control registers.
+    def __init__(self, address, whoami_register, whoami_contents, clock):
+        self.address = address
+        self.clock = clock
+        self.registers = bytearray(256)
+        self.registers[whoami_register] = whoami_contents
+        self.channels = []
+        self.status_registers = {}  # status register -> channel
+        self.fifo_src_registers = {}  # FIFO_SRC register -> channel
+
+    def update(self):
+        now = self.clock()
+        for channel in self.channels:
+            channel.update(now)
+
+    def read_register(self, register):
+        if register in self.status_registers:
+            return self.status_registers[register].status()
+        if register in self.fifo_src_registers:
+            return self.fifo_src_registers[register].fifo_src()
+        for channel in self.channels:
+            if channel.contains(register):
+                return channel.read_output(register)
+        return self.registers[register]
+
+    def next_register(self, register):
+        for channel in self.channels:
+            if channel.contains(register):
+                return channel.next_register(register)
+        return register + 1
+
+    def read(self, register, length):
+        self.update()
+        auto_increment = register & AUTO_INCREMENT
+        register &= ~AUTO_INCREMENT
+        data = []
+        for _ in range(length):
+            data.append(self.read_register(register))
+            if auto_increment:
+                register = self.next_register(register)
+        return data
+
+    def write(self, register, data):
+        self.update()
+        auto_increment = register & AUTO_INCREMENT
+        register &= ~AUTO_INCREMENT
+        for value in data:
+            self.registers[register] = value
+            self.configure(register)
+            if auto_increment:
+                register += 1
+
+    def configure(self, register):
+        # Called after a control register is written
+        pass
+
+
+def pack_xyz(counts):
+    return XYZ_STRUCT.pack(*(int(c) for c in counts))
+
+
+def pack_pressure_temperature(counts):
+    # 24 bit pressure followed by 16 bit temperature
+    return PRESSURE_STRUCT.pack(int(counts[0]))[:3] + TEMPERATURE_STRUCT.pack(int(counts[1]))
+
+
+def constant_source(counts, noise=0):
+    # A sample source giving `counts` plus Gaussian noise (in counts)
+    counts = np.asarray(counts, dtype=float)
+    rng = np.random.default_rng(0)
+    return lambda t: np.round(counts + rng.normal(0, noise, counts.shape)) if noise else counts
+
+
+class LSM303DSimulator(SimulatedDevice):
+    def __init__(self, clock, acc_source=None, mag_source=None):
+        super().__init__(lsm.LSM, lsm.LSM_WHOAMI_ADDRESS, lsm.LSM_WHOAMI_CONTENTS, clock)
+        # By default: 1 g on z, and a plausible 0.5 gauss field
+        if acc_source is None:
+            acc_source = constant_source((0, 0, 1/lsm.LSM_ACC_SENS[2]), noise=20)
+        if mag_source is None:
+            mag_source = constant_source((0.2/lsm.LSM_MAG_SENS[4], 0, -0.45/lsm.LSM_MAG_SENS[4]), noise=5)
+        self.acc = SimulatedChannel(lsm.LSM_ACC_X_L, XYZ_STRUCT.size, pack_xyz, acc_source,
+                                    lsm.LSM_STATUS_DATA_READY, lsm.LSM_STATUS_OVERRUN,
+                                    fifo_depth=lsm.LSM_FIFO_DEPTH)
+        self.mag = SimulatedChannel(lsm.LSM_MAG_X_L, XYZ_STRUCT.size, pack_xyz, mag_source,
+                                    lsm.LSM_STATUS_DATA_READY, lsm.LSM_STATUS_OVERRUN)
+        self.channels = [self.acc, self.mag]
+        self.status_registers = {lsm.LSM_STATUS_A: self.acc, lsm.LSM_STATUS_M: self.mag}
+        self.fifo_src_registers = {lsm.LSM_FIFO_SRC: self.acc}
+
+    def configure(self, register):
+        value = self.registers[register]
+        now = self.clock()
+        if register == lsm.LSM_CTRL_1:
+            self.acc.set_odr(lookup_odr(lsm.LSM_ACC_SET_ODR, value & ~lsm.LSM_ACC_BDU), now)
+        elif register == lsm.LSM_CTRL_5:
+            self.mag.set_odr(lookup_odr(lsm.LSM_MAG_SET_ODR, value), now)
+        elif register in (lsm.LSM_CTRL_0, lsm.LSM_FIFO_CTRL):
+            configure_fifo(self.acc, self.registers[lsm.LSM_CTRL_0] & lsm.LSM_FIFO_ENABLE,
+                           self.registers[lsm.LSM_FIFO_CTRL])
+
+
+class L3GD20HSimulator(SimulatedDevice):
+    def __init__(self, clock, source=None, temperature=25):
+        super().__init__(lgd.LGD, lgd.LGD_WHOAMI_ADDRESS, lgd.LGD_WHOAMI_CONTENTS, clock)
+        # By default: a small bias on each axis
+        if source is None:
+            source = constant_source((20, -15, 5), noise=10)
+        self.gyro = SimulatedChannel(lgd.LGD_OUT_X_L, XYZ_STRUCT.size, pack_xyz, source,
+                                     lgd.LGD_STATUS_DATA_READY, lgd.LGD_STATUS_OVERRUN,
+                                     fifo_depth=lgd.LGD_FIFO_DEPTH)
+        self.channels = [self.gyro]
+        self.status_registers = {lgd.LGD_STATUS: self.gyro}
+        self.fifo_src_registers = {lgd.LGD_FIFO_SRC: self.gyro}
+        self.set_temperature(temperature)
+
+    def set_temperature(self, temperature):
+        # OUT_TEMP counts down by one per degree
+        self.registers[lgd.LGD_OUT_TEMP] = int(-temperature) & 0xFF
+
+    def configure(self, register):
+        now = self.clock()
+        if register in (lgd.LGD_CTRL_1, lgd.LGD_LOW_ODR):
+            ctrl_1 = self.registers[lgd.LGD_CTRL_1]
+            low_odr = self.registers[lgd.LGD_LOW_ODR]
+            odr = 0
+            for rate, value in lgd.LGD_SET_ODR.items():
+                if value == ctrl_1 and lgd.LGD_SET_LOW_ODR[rate] == low_odr:
+                    odr = rate
+            self.gyro.set_odr(odr, now)
+        elif register in (lgd.LGD_CTRL_5, lgd.LGD_FIFO_CTRL):
+            configure_fifo(self.gyro, self.registers[lgd.LGD_CTRL_5] & lgd.LGD_FIFO_ENABLE,
+                           self.registers[lgd.LGD_FIFO_CTRL])
+
+
+class LPS331APSimulator(SimulatedDevice):
+    def __init__(self, clock, source=None):
+        super().__init__(lps.LPS, lps.LPS_WHOAMI_ADDRESS, lps.LPS_WHOAMI_CONTENTS, clock)
+        # By default: sea level pressure at 20 deg C. Counts are
+        # (pressure*4096, (temperature - 42.5)*480), see the datasheet.
+        if source is None:
+            source = constant_source((lps.sealevel_pressure*4096, (20 - 42.5)*480), noise=200)
+        self.pressure = SimulatedChannel(lps.LPS_PRESS_OUT_XL, lps.LPS_OUTPUT_BLOCK_LENGTH,
+                                         pack_pressure_temperature, source,
+                                         lps.LPS_STATUS_PRESS_READY | lps.LPS_STATUS_TEMP_READY,
+                                         lps.LPS_STATUS_PRESS_OVERRUN | lps.LPS_STATUS_TEMP_OVERRUN)
+        self.channels = [self.pressure]
+        self.status_registers = {lps.LPS_STATUS: self.pressure}
+
+    def configure(self, register):
+        if register == lps.LPS_CTRL_1:
+            value = self.registers[register] & ~lps.LPS_BDU
+            self.pressure.set_odr(lookup_odr(lps.LPS_SET_ODR, value), self.clock())
+
+
+def lookup_odr(odr_table, value):
+    # Find the ODR that a control register value selects (0 if powered down)
+    for odr, setting in odr_table.items():
+        if setting == value:
+            return odr
+    return 0
+
+
+def configure_fifo(channel, enabled, fifo_ctrl):
+    stream_mode = fifo_ctrl & 0b11100000 == 0b01000000
+    channel.fifo_enabled = bool(enabled) and stream_mode
+    channel.fifo_watermark = fifo_ctrl & 0b00011111
+    if not channel.fifo_enabled:
+        channel.fifo.clear()
+
+
+########################################################################
+## Simulated bus ##
+###################
+class SimulatedBus:
+    # Drop-in replacement for smbus.SMBus that talks to simulated devices.
+    # Every transaction takes `latency` seconds, spent with `sleep`. Pass
+    # a SimulatedClock's time and sleep to run entirely in virtual time.
+    def __init__(self, devices=None, clock=time.monotonic, sleep=time.sleep, latency=0.0):
+        self.clock = clock
+        self.sleep = sleep
+        self.latency = latency
+        if devices is None:
+            devices = [LSM303DSimulator(clock), L3GD20HSimulator(clock), LPS331APSimulator(clock)]
+        self.devices = {device.address: device for device in devices}
+
+    def _device(self, address):
+        if self.latency:
+            self.sleep(self.latency)
+        try:
+            return self.devices[address]
+        except KeyError:
+            raise OSError("No device at address {}".format(address))
+
+    def read_byte_data(self, address, register):
+        return self._device(address).read(register, 1)[0]
+
+    def write_byte_data(self, address, register, value):
+        self._device(address).write(register, [value])
+
+    def read_i2c_block_data(self, address, register, length):
+        return self._device(address).read(register, length)
+
+    def write_i2c_block_data(self, address, register, data):
+        self._device(address).write(register, data)
+
+    def close(self):
+        pass
+
+
+########################################################################
+## Recording and replay ##
+##########################
+class RecordingBus:
+    # Wraps a bus (real or simulated) and writes every transaction to a
+    # file, one JSON object per line, so the session can be replayed later
+    def __init__(self, bus, filename, clock=time.monotonic):
+        self.bus = bus
+        self.clock = clock
+        self.file = open(filename, 'w')
+
+    def _record(self, operation, args, result=None):
+        self.file.write(json.dumps({'time': self.clock(), 'op': operation,
+                                    'args': list(args), 'result': result}) + '\n')
+        return result
+
+    def read_byte_data(self, address, register):
+        return self._record('read_byte_data', (address, register),
+                            self.bus.read_byte_data(address, register))
+
+    def write_byte_data(self, address, register, value):
+        self.bus.write_byte_data(address, register, value)
+        self._record('write_byte_data', (address, register, value))
+
+    def read_i2c_block_data(self, address, register, length):
+        return self._record('read_i2c_block_data', (address, register, length),
+                            list(self.bus.read_i2c_block_data(address, register, length)))
+
+    def write_i2c_block_data(self, address, register, data):
+        self.bus.write_i2c_block_data(address, register, data)
+        self._record('write_i2c_block_data', (address, register, list(data)))
+
+    def close(self):
+        self.file.close()
+        self.bus.close()
+
+
+class ReplayBus:
+    # Plays back a session recorded by RecordingBus. Transactions must be
+    # made in the same order as they were recorded; anything else raises
+    # an exception, so a replay either reproduces the session exactly or
+    # fails loudly. time() gives the recorded time of the latest
+    # transaction, for use as a deterministic clock.
+    def __init__(self, filename):
+        with open(filename) as f:
+            self.transactions = [json.loads(line) for line in f if line.strip()]
+        self.position = 0
+        self.now = self.transactions[0]['time'] if self.transactions else 0.0
+
+    def _replay(self, operation, args):
+        if self.position >= len(self.transactions):
+            raise Exception("Replay finished: no recorded transaction for {}{}"
+                            .format(operation, tuple(args)))
+        transaction = self.transactions[self.position]
+        if transaction['op'] != operation or transaction['args'] != list(args):
+            raise Exception("Replay mismatch at transaction {}: expected {}{}, got {}{}"
+                            .format(self.position, transaction['op'], tuple(transaction['args']),
+                                    operation, tuple(args)))
+        self.position += 1
+        self.now = transaction['time']
+        return transaction['result']
+
+    def time(self):
+        return self.now
+
+    def sleep(self, duration):
+        pass
+
+    def read_byte_data(self, address, register):
+        return self._replay('read_byte_data', (address, register))
+
+    def write_byte_data(self, address, register, value):
+        self._replay('write_byte_data', (address, register, value))
+
+    def read_i2c_block_data(self, address, register, length):
+        return self._replay('read_i2c_block_data', (address, register, length))
+
+    def write_i2c_block_data(self, address, register, data):
+        self._replay('write_i2c_block_data', (address, register, list(data)))
+
+    def close(self):
+        pass
+
+
+########################################################################
+## Main ##
+##########
+if __name__ == "__main__":
+    # Benchmark one tick of sensor reads on a simulated bus with a
+    # realistic per-transaction latency, then record and replay it
+    import os
+    import tempfile
+    from i2c import CountingBus
+
+    clock = SimulatedClock()
+    bus = CountingBus(SimulatedBus(clock=clock.time, sleep=clock.sleep, latency=200e-6))
+
+    gyroscope1 = lgd.Gyroscope(bus, odr=200, clock=clock.time, sleep=clock.sleep)
+    accelerometer1 = lsm.Accelerometer(bus, acc_odr=400)
+    barometer1 = lps.Barometer(bus, sleep=clock.sleep)
+
+    clock.sleep(0.1)
+    bus.reset()
+    start = clock.time()
+    print(gyroscope1.read(), accelerometer1.read_acc(), accelerometer1.read_mag(), barometer1.read())
+    print("Single reads: {} transactions, {:.2f} ms of bus time"
+          .format(bus.transactions, (clock.time() - start)*1e3))
+
+    gyroscope1.enable_fifo()
+    clock.sleep(0.1)
+    bus.reset()
+    start = clock.time()
+    timestamps, rates = gyroscope1.read_fifo()
+    print("FIFO read: {} samples in {} transactions, {:.2f} ms of bus time"
+          .format(len(rates), bus.transactions, (clock.time() - start)*1e3))
+
+    # Calibration waits for samples in virtual time, and gives up on a
+    # sensor whose data-ready never asserts (here, because time stands still)
+    start = clock.time()
+    barometer1.calibrate()
+    print("Barometer calibration: {:.2f} s of virtual time".format(clock.time() - start))
+    frozen_clock = SimulatedClock()
+    stalled = lps.Barometer(SimulatedBus(clock=frozen_clock.time, sleep=frozen_clock.sleep),
+                            sleep=lambda duration: None)
+    try:
+        stalled.calibrate()
+    except Exception as e:
+        print("Stalled barometer: {}".format(e))
+    else:
+        raise Exception("Calibration of a stalled barometer should have failed")
+
+    filename = os.path.join(tempfile.mkdtemp(), 'session.jsonl')
+    clock = SimulatedClock()
+    recorder = RecordingBus(SimulatedBus(clock=clock.time, sleep=clock.sleep), filename,
+                            clock=clock.time)
+    gyroscope2 = lgd.Gyroscope(recorder)
+    clock.sleep(0.1)
+    recorded = gyroscope2.read()
+    recorder.close()
+    replayed = lgd.Gyroscope(ReplayBus(filename)).read()
+    print("Recorded {}, replayed {}".format(recorded, replayed))
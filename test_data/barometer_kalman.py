@@ -23,9 +23,11 @@ def filter_data(data, x0, P, Q, R):
     
     x_out = np.zeros(data.size)
     P_out = np.zeros(data.size)
-        
-    for k in np.arange(1, data.size):
-            x_out[k], P_out[k] = filter1.update(0, data[k])
+    
+    # The first sample is skipped, as it always has been here
+    xs, Ps = filter1.filter(data[1:])
+    x_out[1:] = xs[:, 0]
+    P_out[1:] = Ps[:, 0, 0]
 
     return x_out, P_out
 
@@ -0,0 +1,225 @@
+import sys
+import os
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import communications as com
+from accelerometer import LSM_ACC_SENS, LSM_MAG_SENS
+from gyroscope import LGD_SENS
+
+# A recorded stream as the sensor loop sends it: a frame per tick, plus
+# the odd single-record packet. The same stream is also encoded as compact
+# frames, with the scales test_data_transmission.py uses.
+ticks = 20000
+rng = np.random.default_rng(0)
+packets = []
+compact_packets = []
+for k in range(ticks):
+    records = [(com.ACCELEROMETER_ID, rng.standard_normal(3), LSM_ACC_SENS[2]),
+               (com.GYROSCOPE_ID, rng.standard_normal(3), LGD_SENS[245])]
+    if k % 2 == 0:
+        records.append((com.MAGNETOMETER_ID, rng.standard_normal(3), LSM_MAG_SENS[4]))
+    if k % 4 == 0:
+        records.append((com.BAROMETER_UNFILTERED_ID, np.asarray(rng.standard_normal()), 1e-2))
+        records.append((com.ALTITUDE_ID, rng.standard_normal(2), 1e-2))
+    packets.append(com.encode_frame(k*0.02, [(data_source, data) for data_source, data, _ in records]))
+    compact_packets.append(com.encode_compact_frames(k*0.02, [com.encode_compact_record(*record)
+                                                              for record in records]))
+    if k % 50 == 0:
+        packet = com.encode(com.GPS_ALT_ID, np.asarray(rng.standard_normal()))
+        packets.append(packet)
+        compact_packets.append(packet)
+stream = b''.join(packets)
+compact_stream = b''.join(compact_packets)
+
+
+class ReplayConnection:
+    # Hands out the stream `chunk_size` bytes at a time, as a socket with
+    # that much data waiting would
+    def __init__(self, data, chunk_size):
+        self.data = memoryview(data)
+        self.position = 0
+        self.chunk_size = chunk_size
+
+    def recv(self, size):
+        end = min(self.position + min(size, self.chunk_size), len(self.data))
+        chunk = self.data[self.position:end].tobytes()
+        self.position = end
+        return chunk
+
+    def recv_into(self, buffer):
+        size = min(len(buffer), self.chunk_size, len(self.data) - self.position)
+        buffer[:size] = self.data[self.position:self.position + size]
+        self.position += size
+        return size
+
+
+class PreChangeSocket(com.StreamingSocket):
+    # read() and read_packet_from_buffer() as they were before the ring
+    # buffer: recv() a new bytes object of at most READ_BUFFER_SIZE, join
+    # any part packet on to the front and slice each packet off the buffer
+    def __init__(self):
+        super().__init__()
+        self.part_packet = b''
+
+    def read(self):
+        try:
+            self.buffer = self.connection.recv(com.READ_BUFFER_SIZE)
+        except com.socket.error as e:
+            self.buffer = b''
+            if e.errno == com.errno.ECONNRESET or e.errno == com.errno.EPIPE:
+                print("Connection reset. Attempting to reconnect...")
+                self.connect()
+            else:
+                raise
+
+        self.received_records = []
+        while self.buffer:
+            self.received_records.extend(com.decode_records(self.read_packet_from_buffer()))
+        return self.received_records
+
+    def read_packet_from_buffer(self):
+        # If the buffer's empty, return empty
+        if not self.buffer:
+            return b''
+
+        # Append any existing part packet to the beginning of the buffer
+        if self.part_packet:
+            self.buffer = b''.join([self.part_packet, self.buffer])
+            # Clear the part_packet variable
+            self.part_packet = b''
+
+        # Extract the length of the first packet from the buffer
+        packet_length = self.buffer[com.PACKET_LENGTH_BYTE]
+
+        # If the whole packet is in the buffer, extract it
+        if len(self.buffer) >= packet_length:
+            # Remove the packet from the buffer
+            packet = self.buffer[:packet_length]
+            self.buffer = self.buffer[packet_length:]
+            return packet
+
+        else:
+            # Save the part packet for later
+            self.part_packet = self.buffer
+            # Empty the buffer
+            self.buffer = b''
+            # Return empty
+            return b''
+
+
+def read_records(socket_class, chunk_size):
+    # Every record in the stream, through read()
+    socket = socket_class()
+    socket.connection = ReplayConnection(stream, chunk_size)
+    count = 0
+    while socket.connection.position < len(stream):
+        count += len(socket.read())
+    return count
+
+
+def ring_packets(chunk_size):
+    # Framing only: recv_into the ring buffer and slice memoryviews
+    socket = com.StreamingSocket()
+    socket.connection = ReplayConnection(stream, chunk_size)
+    count = 0
+    while socket.connection.position < len(stream):
+        socket.receive()
+        while socket.read_packet_from_buffer() is not None:
+            count += 1
+    return count
+
+
+def pre_change_packets(chunk_size):
+    # Framing only, the way the pre-change read() drove it
+    socket = PreChangeSocket()
+    socket.connection = ReplayConnection(stream, chunk_size)
+    count = 0
+    while socket.connection.position < len(stream):
+        socket.buffer = socket.connection.recv(com.READ_BUFFER_SIZE)
+        while socket.buffer:
+            if socket.read_packet_from_buffer():
+                count += 1
+    return count
+
+
+def benchmark(name, function):
+    # Best of 3 runs
+    times = []
+    for _ in range(3):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    print("{:<36} {:8.1f} ms  {:9.0f} packets/s"
+          .format(name, min(times)*1e3, len(packets)/min(times)))
+    return min(times)
+
+
+print("{} packets, {} bytes".format(len(packets), len(stream)))
+assert ring_packets(4096) == pre_change_packets(4096) == len(packets)
+assert read_records(com.StreamingSocket, 4096) == read_records(PreChangeSocket, 4096)
+# The pre-change read() asks for READ_BUFFER_SIZE bytes at a time however
+# much is waiting, so past 1 KiB it makes more, smaller reads; the ring
+# buffer takes whatever fits. Framing gets faster, but decode_records()
+# is nearly all of read(), which comes out the same within run-to-run
+# noise (0.66-1.05x here), 1 KiB reads included.
+for chunk_size in (com.READ_BUFFER_SIZE, 16384, com.RECEIVE_BUFFER_SIZE - com.READ_BUFFER_SIZE):
+    print("")
+    print("{} bytes waiting per read".format(chunk_size))
+    before = benchmark("pre-change, framing only", lambda: pre_change_packets(chunk_size))
+    ring = benchmark("ring buffer, framing only", lambda: ring_packets(chunk_size))
+    print("Speedup: {:.2f}x".format(before/ring))
+    before = benchmark("pre-change read()", lambda: read_records(PreChangeSocket, chunk_size))
+    ring = benchmark("ring buffer read()", lambda: read_records(com.StreamingSocket, chunk_size))
+    print("Speedup: {:.2f}x".format(before/ring))
+
+# Whole-capture decoding, for log replay
+print("")
+print("Bulk decode")
+records = benchmark("decode_records() per packet",
+                    lambda: [com.decode_records(packet) for packet in packets])
+bulk = benchmark("decode_buffer()", lambda: com.decode_buffer(stream))
+print("Speedup: {:.1f}x, {:.1f} s per 100 MB".format(records/bulk, bulk*100e6/len(stream)))
+
+# Compact frames, for the bandwidth they save
+print("")
+print("Compact frames")
+# Bytes per tick for the sensor loop's mix: accelerometer, magnetometer
+# and gyroscope every tick, barometer and fused altitude every 4th, GPS
+# every 50th
+single_bytes = frame_bytes = compact_bytes = 0
+for k in range(ticks):
+    records = [(com.ACCELEROMETER_ID, rng.standard_normal(3), LSM_ACC_SENS[2]),
+               (com.MAGNETOMETER_ID, rng.standard_normal(3), LSM_MAG_SENS[4]),
+               (com.GYROSCOPE_ID, rng.standard_normal(3), LGD_SENS[245])]
+    if k % 4 == 0:
+        records.append((com.BAROMETER_UNFILTERED_ID, np.asarray(rng.standard_normal()), 1e-2))
+        records.append((com.ALTITUDE_ID, rng.standard_normal(2), 1e-2))
+    if k % 50 == 0:
+        records.append((com.GPS_POS_ID, np.array([52.2, 0.12]), None))
+        records.append((com.GPS_ALT_ID, np.asarray(50.0), None))
+    single_bytes += sum(len(com.encode(data_source, data)) for data_source, data, _ in records)
+    frame_bytes += len(com.encode_frames(k*0.02, [com.encode_record(data_source, data)
+                                                  for data_source, data, _ in records]))
+    compact_bytes += len(com.encode_compact_frames(k*0.02, [com.encode_compact_record(*record)
+                                                            for record in records]))
+print("Bytes per tick: {:.1f} as single-record packets, {:.1f} as frames, {:.1f} as compact frames "
+      "({:.0%} of single-record packets, {:.0%} of frames)"
+      .format(single_bytes/ticks, frame_bytes/ticks, compact_bytes/ticks,
+              compact_bytes/single_bytes, compact_bytes/frame_bytes))
+arrays = com.decode_buffer(stream)[0]
+compact_arrays = com.decode_buffer(compact_stream)[0]
+print("Largest difference in physical units: accelerometer {:.1e} g, gyroscope {:.1e} dps"
+      .format(np.abs(arrays[com.ACCELEROMETER_ID]['values'] - compact_arrays[com.ACCELEROMETER_ID]['values']).max(),
+              np.abs(arrays[com.GYROSCOPE_ID]['values'] - compact_arrays[com.GYROSCOPE_ID]['values']).max()))
+benchmark("decode_records() per compact packet",
+          lambda: [com.decode_records(packet) for packet in compact_packets])
+benchmark("decode_buffer(), compact", lambda: com.decode_buffer(compact_stream))
+
+# A FIFO batch of 32 accelerometer samples, as counts batches
+samples = np.cumsum(rng.normal(0, 2e-3, (32, 3)), axis=0)
+print("32 sample batch: {} bytes as floats, {} as counts, {} as deltas"
+      .format(len(com.encode_extended(com.ACCELEROMETER_ID, samples)),
+              len(com.encode_batch(com.ACCELEROMETER_ID, samples, LSM_ACC_SENS[2], 0, 1/400, delta=False)),
+              len(com.encode_batch(com.ACCELEROMETER_ID, samples, LSM_ACC_SENS[2], 0, 1/400))))
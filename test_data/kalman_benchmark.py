@@ -0,0 +1,92 @@
+import sys
+import os
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from kalman_filter import KalmanFilter, KalmanFilterBank
+
+data = np.loadtxt(os.path.join(os.path.dirname(os.path.abspath(__file__)), "barometer_data.txt"))
+
+# Same model as the barometer filter in remote_display.py
+P0 = 2
+Q0 = 0.005
+R0 = 1.02958
+
+
+def benchmark(name, function, repeats=3):
+    # Best of `repeats` runs, in seconds
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    print("{:<30} {:10.2f} ms  ({:.0f} samples/s)"
+          .format(name, min(times)*1e3, data.size/min(times)))
+    return min(times), result
+
+
+def update_loop():
+    filter1 = KalmanFilter(0, P0, 1, 0, 1, Q0, R0)
+    x_out = np.zeros(data.size)
+    for k in range(data.size):
+        x_out[k] = filter1.update(0, data[k])[0]
+    return x_out
+
+
+def batch():
+    filter1 = KalmanFilter(0, P0, 1, 0, 1, Q0, R0)
+    return filter1.filter(data)[0][:, 0]
+
+
+def steady_state():
+    filter1 = KalmanFilter(0, P0, 1, 0, 1, Q0, R0, steady_state=True)
+    return filter1.filter(data)[0][:, 0]
+
+
+def steady_state_auto():
+    filter1 = KalmanFilter(0, P0, 1, 0, 1, Q0, R0, steady_state='auto')
+    return filter1.filter(data)[0][:, 0]
+
+
+print("{} samples".format(data.size))
+loop_time, loop_result = benchmark("update() loop", update_loop)
+batch_time, batch_result = benchmark("filter()", batch)
+print("Speedup: {:.1f}x, max difference {:.2e}"
+      .format(loop_time/batch_time, np.abs(loop_result - batch_result).max()))
+steady_time, steady_result = benchmark("filter(), steady state", steady_state)
+auto_time, auto_result = benchmark("filter(), steady state auto", steady_state_auto)
+# Fixing the gain from the start changes the initial transient, so the
+# difference here is expected to be larger
+print("Steady state speedup: {:.1f}x, max difference {:.2e}"
+      .format(loop_time/steady_time, np.abs(loop_result - steady_result).max()))
+print("Auto steady state speedup: {:.1f}x, max difference {:.2e}"
+      .format(loop_time/auto_time, np.abs(loop_result - auto_result).max()))
+
+# A grid of Q values, one filter each
+Q_grid = np.logspace(-5, -2, 100)
+
+
+def separate_filters():
+    return np.column_stack([KalmanFilter(0, P0, 1, 0, 1, Q, R0).filter(data)[0][:, 0]
+                            for Q in Q_grid])
+
+
+def filter_bank():
+    bank = KalmanFilterBank(np.zeros(Q_grid.size), P0, 1, 0, 1, Q_grid, R0, per_filter=('Q',))
+    return bank.filter(np.broadcast_to(data[:, np.newaxis], (data.size, Q_grid.size)))[0][:, :, 0]
+
+
+print("")
+print("{} filters".format(Q_grid.size))
+separate_time, separate_result = benchmark("filter() per filter", separate_filters, repeats=1)
+bank_time, bank_result = benchmark("KalmanFilterBank.filter()", filter_bank, repeats=1)
+print("Speedup: {:.1f}x, max difference {:.2e}"
+      .format(separate_time/bank_time, np.abs(separate_result - bank_result).max()))
+
+# Forward filter then RTS smoother, as for post-flight processing
+filter1 = KalmanFilter(0, P0, 1, 0, 1, Q0, R0, steady_state='auto')
+xs, Ps = filter1.filter(data)
+print("")
+benchmark("smooth()", lambda: filter1.smooth(xs, Ps))
+benchmark("smooth(), chunks of 4096", lambda: filter1.smooth(xs, Ps, chunk_size=4096))
@@ -1,12 +1,24 @@
 import communications as com
 from smbus import SMBus
-from gyroscope import Gyroscope
-from accelerometer import Accelerometer
+from gyroscope import Gyroscope, GYROSCOPE_CALIBRATION_FILE
+from accelerometer import Accelerometer, MAGNETOMETER_CALIBRATION_FILE
 from barometer import Barometer
 from gps import GPSSensor
+from scheduler import Scheduler
+from attitude import MahonyFilter
+from vertical import VerticalFilter, vertical_acceleration
 
 import numpy as np
-from time import sleep
+import os
+from time import monotonic
+
+# The GPS only produces a new fix once per second
+GPS_RATE = 1
+# Each sensor is polled at this multiple of its output rate. Polling at
+# exactly the output rate beats against the sensor's own clock: whenever
+# a poll lands just before a sample arrives, read_new() returns None and
+# the sample is overwritten before the next poll.
+POLL_FACTOR = 2
 
 # Initialise the i2c bus
 I2CBUS_NUMBER = 1
@@ -14,9 +26,21 @@ bus = SMBus(I2CBUS_NUMBER)
 
 # Initialise the gyroscope
 gyroscope1 = Gyroscope(bus)
+# Load the bias calibration, or calibrate if there isn't one
+if os.path.exists(GYROSCOPE_CALIBRATION_FILE):
+    gyroscope1.load_calibration(GYROSCOPE_CALIBRATION_FILE)
+else:
+    gyroscope1.calibrate()
+    gyroscope1.save_calibration(GYROSCOPE_CALIBRATION_FILE)
 
 # Initialise the accelerometer
 accelerometer1 = Accelerometer(bus)
+# Load the magnetometer calibration, or calibrate if there isn't one
+if os.path.exists(MAGNETOMETER_CALIBRATION_FILE):
+    accelerometer1.load_mag_calibration(MAGNETOMETER_CALIBRATION_FILE)
+else:
+    accelerometer1.calibrate_mag()
+    accelerometer1.save_mag_calibration(MAGNETOMETER_CALIBRATION_FILE)
 
 # Initialise the barometer
 barometer1 = Barometer(bus)
@@ -29,17 +53,78 @@ gps1.initialise()
 # Initialise the server
 server = com.ServerSocket()
 server.connect()
+# Send compact frames: readings go as counts of each sensor's sensitivity
+# (and altitudes in cm), which takes about 61% of the bytes per tick of
+# separate packets (49% of plain frames)
+server.compact = True
+
+# Tell the display how noisy the barometer is, so it can tune its filter
+server.write(com.BAROMETER_VARIANCE_ID, np.asarray(barometer1.altitude_variance))
+
+# Attitude, and altitude and climb rate fused from the accelerometer,
+# barometer and GPS, estimated here in the sensor loop
+attitude_filter = MahonyFilter()
+vertical_filter = VerticalFilter(barometer_variance=barometer1.altitude_variance, gate=16)
+latest = {'acc': None, 'mag': None, 'gps_time': None}
+
+# Sending functions, one per sensor. Each only sends when the sensor has
+# a new sample.
+def send_acc():
+    acc = accelerometer1.read_acc_new()
+    if acc is not None:
+        server.queue(com.ACCELEROMETER_ID, np.asarray(acc), accelerometer1.acc_sens)
+        latest['acc'] = acc
+        quaternion = attitude_filter.quaternion if attitude_filter.initialised else None
+        vertical_filter.predict(vertical_acceleration(acc, quaternion), monotonic())
+
+def send_mag():
+    mag = accelerometer1.read_mag_new()
+    if mag is not None:
+        server.queue(com.MAGNETOMETER_ID, np.asarray(mag), accelerometer1.mag_sens)
+        latest['mag'] = mag
+
+def send_gyro():
+    gyro = gyroscope1.read_new()
+    if gyro is not None:
+        server.queue(com.GYROSCOPE_ID, np.asarray(gyro), gyroscope1.sens)
+        attitude_filter.update(gyro, 1/gyroscope1.odr, latest['acc'], latest['mag'])
+
+def send_baro():
+    if barometer1.read_new() is not None:
+        server.queue(com.BAROMETER_UNFILTERED_ID, np.asarray(barometer1.relative_altitude), 1e-2)
+        vertical_filter.update_barometer(barometer1.relative_altitude, monotonic())
+        if vertical_filter.initialised:
+            server.queue(com.ALTITUDE_ID, np.asarray([vertical_filter.altitude, vertical_filter.climb_rate]),
+                         1e-2)
+
+def send_gps():
+    # Only send each fix once, and only once there is one (the mode is
+    # 'n/a' until gpsd reports)
+    if gps1.mode not in (2, 3) or gps1.time == latest['gps_time']:
+        return
+    latest['gps_time'] = gps1.time
+    server.queue(com.GPS_POS_ID, np.asarray([gps1.lat, gps1.lon]))
+    # Only a 3D fix has an altitude
+    if gps1.mode == 3:
+        server.queue(com.GPS_ALT_ID, np.asarray(gps1.alt))
+        epv = gps1.epv
+        vertical_filter.update_gps(gps1.alt, monotonic(),
+                                   variance=epv**2 if isinstance(epv, float) else None)
+
+# Poll each sensor at POLL_FACTOR times its own ODR. The readings from
+# each tick are queued and sent together as one frame.
+scheduler = Scheduler()
+scheduler.add_tick_callback(server.flush)
+scheduler.add_task('accelerometer', send_acc, POLL_FACTOR*accelerometer1.acc_odr)
+scheduler.add_task('magnetometer', send_mag, POLL_FACTOR*accelerometer1.mag_odr)
+scheduler.add_task('gyroscope', send_gyro, POLL_FACTOR*gyroscope1.odr)
+scheduler.add_task('barometer', send_baro, POLL_FACTOR*barometer1.odr)
+scheduler.add_task('gps', send_gps, POLL_FACTOR*GPS_RATE)
 
 try:
-    while True:
-        server.write(com.ACCELEROMETER_ID, np.asarray(accelerometer1.read_acc()))
-        server.write(com.MAGNETOMETER_ID, np.asarray(accelerometer1.read_mag()))
-        server.write(com.GYROSCOPE_ID, np.asarray(gyroscope1.read()))
-        server.write(com.BAROMETER_UNFILTERED_ID, np.asarray(barometer1.read_relative_altitude()))
-        # TODO fix so that GPS only sends when it's got a new value
-        server.write(com.GPS_POS_ID, np.asarray([gps1.lat, gps1.lon]))
-        server.write(com.GPS_ALT_ID, np.asarray(gps1.alt))
-        sleep(1/25)
+    scheduler.run()
 
 except KeyboardInterrupt:
     print("Exiting...")
+    for name, stats in scheduler.statistics().items():
+        print("{}: {}".format(name, stats))
@@ -0,0 +1,303 @@
+########################################################################
+## Imports ##
+#############
+from time import perf_counter
+import numpy as np
+from kalman_filter import FilterHealth
+
+########################################################################
+## Vertical acceleration ##
+###########################
+GRAVITY = 9.80665  # m/s^2
+
+
+def vertical_acceleration(acc, quaternion=None):
+    # Upward acceleration in m/s^2 from an accelerometer reading in g. The
+    # accelerometer measures specific force, so a stationary sensor reads
+    # 1 g upwards; that is removed. With an attitude quaternion (e.g. from
+    # attitude.MahonyFilter) the reading is rotated into the world frame
+    # first, otherwise the sensor is assumed to be level.
+    ax, ay, az = acc
+    if quaternion is None:
+        up = az
+    else:
+        q0, q1, q2, q3 = quaternion
+        # Bottom row of the body to world rotation matrix
+        up = (2*(q1*q3 - q0*q2)*ax + 2*(q2*q3 + q0*q1)*ay +
+              (1 - 2*(q1*q1 + q2*q2))*az)
+    return float(up - 1)*GRAVITY
+
+
+########################################################################
+## Vertical channel filter ##
+#############################
+# State vector elements
+ALTITUDE = 0
+CLIMB_RATE = 1
+ACCELERATION_BIAS = 2
+BAROMETER_OFFSET = 3
+NUM_STATES = 4
+
+
+class VerticalFilter:
+    # Kalman filter for altitude and climb rate, fusing the vertical
+    # acceleration with barometer and GPS altitudes, which all arrive at
+    # different rates. The state is
+    #    altitude (m, as GPS), climb rate (m/s), accelerometer bias
+    #    (m/s^2) and barometer offset (barometer altitude - altitude, m)
+    # predict() is called for every accelerometer sample, with its
+    # timestamp, so dt can vary from step to step. update_barometer() and
+    # update_gps() are called whenever those readings arrive; if they are
+    # newer than the last accelerometer sample the state is first carried
+    # forward to them.
+    #
+    # Noise parameters are standard deviations: acceleration_noise in
+    # m/s^2, and the bias and offset random walks per square root second.
+    # Measurement variances are in m^2, and can be overridden per reading
+    # (e.g. with the GPS's own error estimate). All of the arithmetic
+    # writes into preallocated arrays, and the measurement updates are
+    # scalar, so no matrices are ever inverted.
+    #
+    # Readings whose normalised innovation squared is above `gate` (e.g. 16
+    # for 4 sigma) are rejected, so a barometer spike or a bad GPS fix
+    # doesn't pull the estimate away; see KalmanFilter. If max_rejections
+    # readings in a row from one sensor are rejected it is the estimate
+    # that is wrong (e.g. it missed a real step), so the filter re-seeds
+    # from that sensor's next failing reading, widening the covariance
+    # along the measured direction by the squared innovation so the
+    # reading is taken almost as it is. That sensor's readings are then
+    # accepted ungated, re-seeding from any that fail, until
+    # recovery_passes in a row have passed the gate. The filter starts out
+    # recovering, as its first reading could itself be an outlier. None
+    # never stops gating. self.health keeps running statistics of the
+    # barometer and GPS updates.
+    def __init__(self, acceleration_noise=0.5, bias_noise=0.01, offset_noise=0.02,
+                 barometer_variance=1.0, gps_variance=25.0, offset_variance=1e4,
+                 climb_rate_variance=1.0, bias_variance=0.1, gate=None, max_rejections=10,
+                 recovery_passes=3):
+        self.acceleration_noise = acceleration_noise
+        self.bias_noise = bias_noise
+        self.offset_noise = offset_noise
+        self.barometer_variance = barometer_variance
+        self.gps_variance = gps_variance
+        self.offset_variance = offset_variance
+        self.climb_rate_variance = climb_rate_variance
+        self.bias_variance = bias_variance
+        self.gate = gate
+        self.max_rejections = max_rejections
+        self.recovery_passes = recovery_passes
+        self.health = FilterHealth()
+
+        self.x = np.zeros(NUM_STATES)
+        self.P = np.zeros((NUM_STATES, NUM_STATES))
+        self.initialised = False
+        self.time = None
+        self.acceleration = 0.0
+
+        # Work buffers. F is the identity except for the dt terms, which
+        # are filled in on every step.
+        self._F = np.eye(NUM_STATES)
+        self._FP = np.empty((NUM_STATES, NUM_STATES))
+        self._Ph = np.empty(NUM_STATES)
+        self._k = np.empty(NUM_STATES)
+        self._k_column = self._k.reshape(NUM_STATES, 1)
+        self._Ph_row = self._Ph.reshape(1, NUM_STATES)
+        self._kPh = np.empty((NUM_STATES, NUM_STATES))
+        self._barometer_h = np.array([1.0, 0.0, 0.0, 1.0])
+        self._gps_h = np.array([1.0, 0.0, 0.0, 0.0])
+        # Consecutive rejections, and passes still needed before gating
+        # again, per sensor
+        self._rejections = {'barometer': 0, 'gps': 0}
+        self._recovering = {'barometer': 0, 'gps': 0}
+
+    @property
+    def altitude(self):
+        return self.x[ALTITUDE]
+
+    @property
+    def climb_rate(self):
+        return self.x[CLIMB_RATE]
+
+    @property
+    def barometer_altitude(self):
+        # Fused altitude on the barometer's scale (relative to its datum)
+        return self.x[ALTITUDE] + self.x[BAROMETER_OFFSET]
+
+    def predict(self, acceleration, timestamp):
+        # Carry the state forward to `timestamp` (seconds) under the
+        # previous acceleration, then hold this one (m/s^2, upwards, e.g.
+        # from vertical_acceleration()) until the next sample
+        self._propagate(timestamp)
+        self.acceleration = acceleration
+
+    def update_barometer(self, altitude, timestamp=None, variance=None):
+        # Barometer altitude (m, relative to its datum) = altitude + offset.
+        # Returns False if the reading was rejected by the gate.
+        if variance is None:
+            variance = self.barometer_variance
+        if not self.initialised:
+            # The barometer pins down altitude + offset; until the GPS
+            # arrives the offset is taken as 0 (so the altitude is on the
+            # barometer's scale) but with a large variance
+            self._initialise(altitude, variance + self.offset_variance)
+            self.P[ALTITUDE, BAROMETER_OFFSET] = self.P[BAROMETER_OFFSET, ALTITUDE] = -self.offset_variance
+            return True
+        return self._update('barometer', self._barometer_h, altitude, variance, timestamp)
+
+    def update_gps(self, altitude, timestamp=None, variance=None):
+        # GPS altitude (m). Returns False if the reading was rejected.
+        if variance is None:
+            variance = self.gps_variance
+        if not self.initialised:
+            self._initialise(altitude, variance)
+            return True
+        return self._update('gps', self._gps_h, altitude, variance, timestamp)
+
+    def _initialise(self, altitude, variance):
+        self.x[...] = 0
+        self.x[ALTITUDE] = altitude
+        self.P[...] = 0
+        self.P[ALTITUDE, ALTITUDE] = variance
+        self.P[CLIMB_RATE, CLIMB_RATE] = self.climb_rate_variance
+        self.P[ACCELERATION_BIAS, ACCELERATION_BIAS] = self.bias_variance
+        self.P[BAROMETER_OFFSET, BAROMETER_OFFSET] = self.offset_variance
+        self.initialised = True
+        for sensor in self._recovering:
+            self._rejections[sensor] = 0
+            self._recovering[sensor] = self.recovery_passes
+
+    def _propagate(self, timestamp):
+        # Predict from self.time to timestamp
+        if timestamp is None:
+            return
+        if self.time is None or not self.initialised:
+            self.time = timestamp
+            return
+        dt = timestamp - self.time
+        if dt <= 0:
+            # Late reading: apply it to the current state
+            return
+        self.time = timestamp
+
+        # x = F x + G a, with
+        #    altitude += climb_rate dt + (a - bias) dt^2/2
+        #    climb_rate += (a - bias) dt
+        x = self.x
+        half_dt2 = 0.5*dt*dt
+        a = self.acceleration - x[ACCELERATION_BIAS]
+        x[ALTITUDE] += x[CLIMB_RATE]*dt + a*half_dt2
+        x[CLIMB_RATE] += a*dt
+
+        # P = F P F^T + Q
+        F = self._F
+        F[ALTITUDE, CLIMB_RATE] = dt
+        F[ALTITUDE, ACCELERATION_BIAS] = -half_dt2
+        F[CLIMB_RATE, ACCELERATION_BIAS] = -dt
+        np.dot(F, self.P, out=self._FP)
+        np.dot(self._FP, F.T, out=self.P)
+        # Acceleration noise enters through G = (dt^2/2, dt, 0, 0); the
+        # bias and offset are random walks
+        q = self.acceleration_noise**2
+        P = self.P
+        P[ALTITUDE, ALTITUDE] += q*half_dt2*half_dt2
+        P[ALTITUDE, CLIMB_RATE] += q*half_dt2*dt
+        P[CLIMB_RATE, ALTITUDE] += q*half_dt2*dt
+        P[CLIMB_RATE, CLIMB_RATE] += q*dt*dt
+        P[ACCELERATION_BIAS, ACCELERATION_BIAS] += self.bias_noise**2*dt
+        P[BAROMETER_OFFSET, BAROMETER_OFFSET] += self.offset_noise**2*dt
+
+    def _update(self, sensor, h, z, r, timestamp):
+        # Scalar measurement z = h^T x + v, v ~ N(0, r), at `timestamp`
+        start = perf_counter()
+        self._propagate(timestamp)
+        np.dot(self.P, h, out=self._Ph)
+        s = h.dot(self._Ph) + r
+        innovation = z - h.dot(self.x)
+        nis = innovation*innovation/s
+        if self.gate is not None:
+            if nis <= self.gate:
+                self._rejections[sensor] = 0
+                if self._recovering[sensor]:
+                    self._recovering[sensor] -= 1
+            elif not self._recovering[sensor] and (self.max_rejections is None
+                                                   or self._rejections[sensor] < self.max_rejections):
+                self._rejections[sensor] += 1
+                self.health.record(nis, 0, 1, perf_counter() - start)
+                return False
+            else:
+                # Re-seed: P += innovation^2 h h^T / (h^T h)^2, so that
+                # h^T P h grows by innovation^2
+                hh = h.dot(h)
+                np.multiply(h.reshape(NUM_STATES, 1), h.reshape(1, NUM_STATES), out=self._kPh)
+                self._kPh *= innovation*innovation/(hh*hh)
+                self.P += self._kPh
+                np.dot(self.P, h, out=self._Ph)
+                s = h.dot(self._Ph) + r
+                nis = innovation*innovation/s
+                self._rejections[sensor] = 0
+                self._recovering[sensor] = self.recovery_passes
+        np.divide(self._Ph, s, out=self._k)
+        np.multiply(self._k_column, self._Ph_row, out=self._kPh)
+        self.P -= self._kPh
+        self._k *= innovation
+        self.x += self._k
+        self.health.record(nis, 1, 0, perf_counter() - start)
+        return True
+
+
+########################################################################
+## Main ##
+##########
+if __name__ == "__main__":
+    import time
+
+    # Simulate a climb and descent, with noisy acceleration at 50 Hz (and
+    # a bias), the barometer at 12.5 Hz (with an offset) and the GPS at 1 Hz
+    rng = np.random.default_rng(0)
+    duration = 120
+    t = np.arange(0, duration, 0.02) + rng.uniform(-0.002, 0.002, int(duration/0.02))
+    true_altitude = 50 + 20*np.sin(2*np.pi*t/60)
+    true_climb_rate = 20*2*np.pi/60*np.cos(2*np.pi*t/60)
+    true_acceleration = -20*(2*np.pi/60)**2*np.sin(2*np.pi*t/60)
+    acceleration = true_acceleration + 0.2 + rng.normal(0, 0.3, t.size)
+
+    vertical_filter = VerticalFilter(barometer_variance=0.5**2, gps_variance=3**2, gate=16)
+    altitude = np.empty(t.size)
+    climb_rate = np.empty(t.size)
+    start = time.perf_counter()
+    for k in range(t.size):
+        vertical_filter.predict(acceleration[k], t[k])
+        if k % 4 == 0:
+            # With the occasional spike
+            spike = 30 if k % 1000 == 500 else 0
+            vertical_filter.update_barometer(true_altitude[k] - 40 + spike + rng.normal(0, 0.5), t[k])
+        if k % 50 == 0:
+            vertical_filter.update_gps(true_altitude[k] + rng.normal(0, 3), t[k])
+        altitude[k] = vertical_filter.altitude
+        climb_rate[k] = vertical_filter.climb_rate
+    elapsed = time.perf_counter() - start
+
+    settled = t > 30
+    print("{:.1f} us per accelerometer sample (including measurement updates)"
+          .format(elapsed/t.size*1e6))
+    print("Altitude RMS error {:.2f} m, climb rate RMS error {:.2f} m/s"
+          .format(np.sqrt(np.mean((altitude - true_altitude)[settled]**2)),
+                  np.sqrt(np.mean((climb_rate - true_climb_rate)[settled]**2))))
+    print("Estimated barometer offset {:.1f} m (true -40), accelerometer bias {:.2f} m/s^2 (true 0.2)"
+          .format(vertical_filter.x[BAROMETER_OFFSET], vertical_filter.x[ACCELERATION_BIAS]))
+    print("Health: {}".format(vertical_filter.health.summary()))
+
+    # A spike on the very first barometer reading, which the filter
+    # starts from, should be recovered from within a few readings
+    startup_filter = VerticalFilter(barometer_variance=0.5**2, gps_variance=3**2, gate=16)
+    rejected = []
+    for k in range(0, 400, 4):
+        startup_filter.predict(acceleration[k], t[k])
+        spike = 30 if k == 0 else 0
+        if not startup_filter.update_barometer(true_altitude[k] - 40 + spike + rng.normal(0, 0.5), t[k]):
+            rejected.append(k//4)
+        if k == 12:
+            recovered_error = abs(startup_filter.barometer_altitude - (true_altitude[k] - 40))
+    print("Startup spike: {:.2f} m barometer altitude error after 4 readings, readings rejected {}"
+          .format(recovered_error, rejected))
+    assert recovered_error < 2 and not rejected